@@ -0,0 +1,134 @@
+import os
+import random
+import zipfile
+
+import numpy as np
+
+from frontier import SPILL_RECORD
+from sparse import CsrMatrixBuilder
+
+# Checkpoints of the solver's exploration (see solver.min_probability_subsp), so that a long run
+# that is killed can be resumed. A checkpoint is a single .npz file, which is written to a
+# temporary file first and then renamed over the last one, so there is always a complete
+# checkpoint on disk.
+#
+# The .npz is written and read with zipfile directly, so that the arrays of the state store are
+# copied CHECKPOINT_CHUNK states at a time: with a store that spills to disk (see StateStore),
+# they are never all in memory, neither when saving nor when resuming.
+
+# The default number of seconds between checkpoints
+CHECKPOINT_INTERVAL = 600.0
+# The number of states of the store copied at once
+CHECKPOINT_CHUNK = 1 << 16
+# The arrays of the model in a checkpoint, which must match the model of the run that resumes it.
+# The rate constants are only known for compiled CRNs (see Crn.propensities).
+MODEL_ARRAYS = ["init_state", "stoichiometry", "lower_bounds", "upper_bounds", "rate_constants"]
+# The arrays of the state store in a checkpoint (and its residuals, if it keeps them)
+STORE_ARRAYS = ["vecs", "order", "epsilon", "perimeter", "exit_rate"]
+
+def model_arrays(crn) -> dict:
+	'''
+	The arrays of a model in a checkpoint
+	'''
+	return { name : np.asarray(getattr(crn, name)) for name in MODEL_ARRAYS if hasattr(crn, name) }
+
+def store_arrays(state_store) -> list:
+	'''
+	The names of the arrays of a state store in a checkpoint
+	'''
+	return STORE_ARRAYS + (["residuals"] if state_store.residuals is not None else [])
+
+def write_array(archive : zipfile.ZipFile, name : str, array, start : int = 0, stop : int = None):
+	'''
+	Writes array[start:stop] to an open archive as name.npy, CHECKPOINT_CHUNK rows at a time
+	'''
+	array = np.asarray(array) if not isinstance(array, np.ndarray) else array
+	stop = len(array) if array.ndim > 0 and stop is None else stop
+	with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+		if array.ndim == 0:
+			np.lib.format.write_array(f, array)
+			return
+		header = { "descr" : np.lib.format.dtype_to_descr(array.dtype), "fortran_order" : False, "shape" : (stop - start,) + array.shape[1:] }
+		np.lib.format.write_array_header_2_0(f, header)
+		for i in range(start, stop, CHECKPOINT_CHUNK):
+			f.write(np.ascontiguousarray(array[i:min(i + CHECKPOINT_CHUNK, stop)]).tobytes())
+
+def read_chunks(archive : zipfile.ZipFile, name : str):
+	'''
+	Lazily reads name.npy from an open archive, CHECKPOINT_CHUNK rows at a time
+	'''
+	with archive.open(f"{name}.npy") as f:
+		version = np.lib.format.read_magic(f)
+		read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+		shape, fortran_order, dtype = read_header(f)
+		assert(not fortran_order)
+		row_shape = shape[1:]
+		row_size = dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+		for i in range(0, shape[0], CHECKPOINT_CHUNK):
+			count = min(CHECKPOINT_CHUNK, shape[0] - i)
+			yield np.frombuffer(f.read(count * row_size), dtype=dtype).reshape((count,) + row_shape)
+
+def save_checkpoint(path : str, crn, state_store, pq, matrixBuilder : CsrMatrixBuilder, sat_states : list, deadlock_idxs : list, num_explored : int, elapsed : float, options : dict):
+	'''
+	Writes the state store, frontier, matrix triples, satisfying and deadlock indexes, counters
+	and RNG states of an exploration to path, along with the model and the search options (a
+	dict of the names and values of the options that change which states are explored)
+	'''
+	size = len(state_store)
+	rows, cols, vals = matrixBuilder.triples()
+	py_version, py_state, py_gauss = random.getstate()
+	np_name, np_keys, np_pos, np_has_gauss, np_gauss = np.random.get_state()
+	tmp_path = f"{path}.tmp.npz"
+	arrays = { "frontier" : pq.entries()
+			, "tiebreak" : np.asarray(pq.tiebreak)
+			, "rows" : rows
+			, "cols" : cols
+			, "vals" : vals
+			, "sat_states" : np.array(sat_states, dtype=np.int64)
+			, "deadlock_idxs" : np.array(deadlock_idxs, dtype=np.int64)
+			, "num_explored" : np.asarray(num_explored)
+			, "elapsed" : np.asarray(elapsed)
+			, "py_random_version" : np.asarray(py_version)
+			, "py_random_state" : np.array(py_state, dtype=np.uint64)
+			, "py_random_gauss" : np.array([py_gauss is not None, 0.0 if py_gauss is None else py_gauss])
+			, "np_random_keys" : np_keys
+			, "np_random" : np.array([np_pos, np_has_gauss, np_gauss]) }
+	arrays.update(model_arrays(crn))
+	for name, value in options.items():
+		arrays[f"option_{name}"] = np.asarray(value)
+	with zipfile.ZipFile(tmp_path, "w", allowZip64=True) as archive:
+		for name in store_arrays(state_store):
+			write_array(archive, name, getattr(state_store, name), 1, size)
+		for name, array in arrays.items():
+			write_array(archive, name, array)
+	os.replace(tmp_path, path)
+
+def load_checkpoint(path : str, crn, state_store, pq, matrixBuilder : CsrMatrixBuilder, options : dict) -> tuple:
+	'''
+	Restores a checkpoint written by save_checkpoint into an empty state store, frontier and
+	matrix builder, and restores the RNG states. The checkpoint must be of the same model, with
+	the same search options. Returns (sat_states, deadlock_idxs, num_explored, elapsed).
+	'''
+	with np.load(path) as checkpoint:
+		for name, array in model_arrays(crn).items():
+			if name not in checkpoint.files or not np.array_equal(checkpoint[name], array):
+				raise Exception(f"Checkpoint {path} is of a different model (its {name} differ)")
+		for name, value in options.items():
+			if f"option_{name}" not in checkpoint.files or checkpoint[f"option_{name}"].item() != value:
+				raise Exception(f"Checkpoint {path} was made with different search options (here {name} is {value})")
+		assert(len(state_store) == 1 and pq.empty())
+		with zipfile.ZipFile(path) as archive:
+			names = store_arrays(state_store)
+			if any(f"{name}.npy" not in archive.namelist() for name in names):
+				raise Exception(f"Checkpoint {path} does not have the subspace residuals of its states")
+			for chunks in zip(*(read_chunks(archive, name) for name in names)):
+				state_store.load(*chunks)
+		pq.restore(checkpoint["frontier"].astype(SPILL_RECORD), int(checkpoint["tiebreak"]))
+		# The triples include the absorbing state's self loop
+		matrixBuilder.count = 0
+		matrixBuilder.add_values(checkpoint["rows"], checkpoint["cols"], checkpoint["vals"])
+		py_gauss = checkpoint["py_random_gauss"]
+		random.setstate((int(checkpoint["py_random_version"]), tuple(int(v) for v in checkpoint["py_random_state"]), float(py_gauss[1]) if py_gauss[0] else None))
+		np_random = checkpoint["np_random"]
+		np.random.set_state(("MT19937", checkpoint["np_random_keys"], int(np_random[0]), int(np_random[1]), float(np_random[2])))
+		return checkpoint["sat_states"].tolist(), checkpoint["deadlock_idxs"].tolist(), int(checkpoint["num_explored"]), float(checkpoint["elapsed"])
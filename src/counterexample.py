@@ -1,7 +1,13 @@
 from distance import *
 from crn import *
 from subspace import *
+from frontier import Frontier
+from store import StateEncoder
+from walkers import random_walks, NUM_WALKERS, UNIFORM
+from traces import Trace, TraceWriter, DEFAULT_TRACE_FILE, log_sum, format_probability
 
+import heapq
+import math
 import sys
 
 # from numpy import
@@ -9,140 +15,305 @@ import sys
 # Nagini currently does not support numpy (or floats, or later versions of python)
 # from nagini_contracts.contracts import *
 
-import queue
 import random
 
-sys.setrecursionlimit(sys.getrecursionlimit() * 50)
-
-TRACEBACK_BOUND=1 # 10 # 10000 # 100000
 DESIRED_NUMBER_COUNTEREXAMPLES=2
 
-force_end_traceback=False
-backward_pointers = {}
+backward_pointers = None
 reaches = {}
 counterexamples = []
 num_counterexamples = 0
+# The ids (in backward_pointers) of the satisfying states found so far, which the
+# counterexamples end in
+satisfying_ids = []
 
 all_transitions = []
 
+# If set, states are keyed by their packed integer in backward_pointers rather than by the bytes
+# of their int32 vectors (as in StateStore.key)
+state_encoder = None
+
+def state_key(state):
+	'''
+	The key of a state in backward_pointers
+	'''
+	if state_encoder is None:
+		return np.asarray(state, dtype=np.int32).tobytes()
+	return state_encoder.encode(state)
+
+def key_state(key) -> np.ndarray:
+	'''
+	The state vector of a key made by state_key
+	'''
+	if state_encoder is None:
+		return np.frombuffer(key, dtype=np.int32).astype(np.int64)
+	return np.array(state_encoder.decode(key), dtype=np.int64)
+
+class BackwardPointers:
+	'''
+	The backward-pointer graph of a search, in typed arrays. Each discovered state gets an id
+	(the initial state is 0), and each edge into a state is a (predecessor id, reaction index,
+	log probability) record. The states themselves are not stored: the traces are rebuilt from
+	the initial state and the reactions along them.
+
+	States are found by their key (see state_key), so the visited index still holds one key per
+	state (which is a single integer with packed keys).
+	'''
+	def __init__(self, crn, capacity : int = 1024):
+		self.init_state = np.array(crn.init_state, dtype=np.int64)
+		self.stoichiometry = crn.stoichiometry
+		self.ids = {}
+		self.num_states = 0
+		self.dst = np.zeros(capacity, dtype=np.int64)
+		self.src = np.zeros(capacity, dtype=np.int64)
+		self.reaction = np.zeros(capacity, dtype=np.int32)
+		self.log_prob = np.zeros(capacity)
+		self.num_edges = 0
+		self.add_state(state_key(crn.init_state))
+
+	def __contains__(self, key) -> bool:
+		return key in self.ids
+
+	def __len__(self):
+		return self.num_states
+
+	def get(self, key) -> int:
+		'''
+		The id of the state with a key, or None if it has not been discovered
+		'''
+		return self.ids.get(key)
+
+	def add_state(self, key) -> int:
+		idx = self.num_states
+		self.ids[key] = idx
+		self.num_states += 1
+		return idx
+
+	def add_edge(self, src : int, reaction : int, log_prob : float, key) -> int:
+		'''
+		Adds an edge from the state with id src, through a reaction, into the state with a key
+		(which is discovered if it is new). Returns the id of that state, or None if it was
+		already discovered.
+		'''
+		if self.num_edges == len(self.dst):
+			capacity = 2 * len(self.dst)
+			self.dst = np.resize(self.dst, capacity)
+			self.src = np.resize(self.src, capacity)
+			self.reaction = np.resize(self.reaction, capacity)
+			self.log_prob = np.resize(self.log_prob, capacity)
+		edge = self.num_edges
+		self.num_edges += 1
+		dst = self.ids.get(key)
+		new_idx = None
+		if dst is None:
+			dst = new_idx = self.add_state(key)
+		self.dst[edge] = dst
+		self.src[edge] = src
+		self.reaction[edge] = reaction
+		self.log_prob[edge] = log_prob
+		return new_idx
+
+	def predecessors(self):
+		'''
+		The edges grouped by the state they lead to, as (order, ptr): the edges into state i are
+		order[ptr[i]:ptr[i + 1]]
+		'''
+		dst = self.dst[:self.num_edges]
+		order = np.argsort(dst, kind="stable")
+		ptr = np.searchsorted(dst[order], np.arange(self.num_states + 1))
+		return order, ptr
+
+def log_probabilities(rates, total_rate : float) -> np.ndarray:
+	'''
+	The log of each rate normalized by total_rate (-inf for zero rates). Normalizing is a
+	subtraction of logs, so no rate is divided.
+	'''
+	rates = np.asarray(rates, dtype=float)
+	with np.errstate(divide="ignore"):
+		return np.log(rates) - np.log(total_rate)
+
 def reset():
 	# global DESIRED_NUMBER_COUNTEREXAMPLES
 	global backward_pointers
 	global reaches
 	global counterexamples
 	global num_counterexamples
+	global satisfying_ids
+	global state_encoder
+	state_encoder = None
 	num_counterexamples = 0
 	counterexamples = []
+	satisfying_ids = []
 	reaches = {}
-	backward_pointers = {}
+	backward_pointers = None
 
-def traceback(c_state, tail=[], tail_probability = 1.0):
+def k_best_paths(target_ids, k : int):
 	'''
-recursive algorithm to get SOME (not all) tracebacks to init state from current state
+Finds the k most probable paths from the initial state to any of the target states in the
+backward-pointer graph. The probability of a path is the product of the normalized rates of its
+edges, so with edge weights of -log(normalized rate) this is a k shortest paths problem:
+
+1. One Dijkstra pass backward from the targets (along the backward pointers) finds the weight
+   of the best path from each state to a target, and collects the forward edges on the way.
+2. A best-first search over paths from the initial state, ordered by the weight so far plus the
+   best weight to a target (an exact heuristic), then pops complete paths in order of probability.
+
+Paths are stored as parent pointers, so no path is copied until it is returned, and nothing
+is recursive. Paths may revisit states (they are still distinct traces), but never pass through
+a target before their end. Lazily yields (log probability, Trace) in order of probability, so
+deep traces whose probability underflows a float are still found.
 	'''
-	# TODO: Dynamic programming version of this
 	global backward_pointers
+	bp = backward_pointers
+	is_target = np.zeros(len(bp), dtype=bool)
+	is_target[list(target_ids)] = True
+	order, ptr = bp.predecessors()
+	# Best weight to a target, and the forward edges (weight, next state, reaction) of each state
+	dist = np.full(len(bp), np.inf)
+	dist[is_target] = 0.0
+	forward = {}
+	heap = [(0.0, int(idx)) for idx in np.flatnonzero(is_target)]
+	heapq.heapify(heap)
+	done = np.zeros(len(bp), dtype=bool)
+	while len(heap) > 0:
+		d, idx = heapq.heappop(heap)
+		if done[idx]:
+			continue
+		done[idx] = True
+		for edge in order[ptr[idx]:ptr[idx + 1]]:
+			pred, log_prob = int(bp.src[edge]), bp.log_prob[edge]
+			if log_prob == -np.inf or is_target[pred]:
+				continue
+			forward.setdefault(pred, []).append((-log_prob, idx, int(bp.reaction[edge])))
+			if d - log_prob < dist[pred]:
+				dist[pred] = d - log_prob
+				heapq.heappush(heap, (d - log_prob, pred))
+	if dist[0] == np.inf:
+		return
+	# The popped partial paths, as the reaction into each one's last state and its parent
+	reactions = []
+	parents = []
+	num_paths = 0
+	heap = [(dist[0], 0, 0.0, 0, -1, -1)]
+	tiebreak = 1
+	while len(heap) > 0 and num_paths < k:
+		_, _, weight, idx, reaction, parent = heapq.heappop(heap)
+		reactions.append(reaction)
+		parents.append(parent)
+		if is_target[idx]:
+			path = []
+			i = len(reactions) - 1
+			while parents[i] >= 0:
+				path.append(reactions[i])
+				i = parents[i]
+			num_paths += 1
+			yield -weight, Trace(bp.init_state, path[::-1], bp.stoichiometry)
+			continue
+		for edge_weight, next_idx, next_reaction in forward.get(idx, []):
+			heapq.heappush(heap, (weight + edge_weight + dist[next_idx], tiebreak, weight + edge_weight, next_idx, next_reaction, len(reactions) - 1))
+			tiebreak += 1
+
+def extract_counterexamples(number : int, trace_writer : TraceWriter = None):
+	'''
+Sets the counterexamples to the `number` most probable paths from the initial state to the
+satisfying states found, as (log probability, Trace). If trace_writer is given, each one is
+written to it as soon as it is found.
+	'''
 	global counterexamples
-	global DESIRED_NUMBER_COUNTEREXAMPLES
 	global num_counterexamples
-	global force_end_traceback
-	if force_end_traceback or num_counterexamples >= DESIRED_NUMBER_COUNTEREXAMPLES + TRACEBACK_BOUND:
-		return
-	# If our tail probability is too small to handle or is zero we shouldn't continue exploring
-	if tail_probability == 0.0:
-		# We've probably found all of the counterexamples we can
-		print("Found tail probability of zero. Stopping traceback")
-		force_end_traceback=True
-		return
-	# We can afford a copy of the tail on every call, since traceback is only called from
-	# satisfying states and works BACKWARDS
-	new_tail = tail.copy()
-	new_tail.append(c_state)
-	backward_pointers[c_state].sort(reverse=True)
-	for normalized_rate, state in backward_pointers[c_state]:
-		if not state in backward_pointers:
-			new_tail.append(state)
-			counterexamples.append((tail_probability * normalized_rate, new_tail))
-			num_counterexamples = len(counterexamples)
-			print(f"Found counterexample! Now we have {len(counterexamples)}")
-			force_end_traceback = True
-		else:
-			traceback(state, new_tail, tail_probability * normalized_rate)
-	# print(f"ERROR: found no counterexample in traceback!")
-
-def find_counterexamples(crn, number=1, print_when_done=False, include_flow_angle=False):
+	for log_probability, trace in k_best_paths(satisfying_ids, number):
+		counterexamples.append((log_probability, trace))
+		if trace_writer is not None:
+			trace_writer.write(log_probability, trace)
+	num_counterexamples = len(counterexamples)
+
+def find_counterexamples(crn, number=1, print_when_done=False, include_flow_angle=False, packed_keys=False, trace_writer=None):
+	'''
+Finds at most `number` counterexamples. As in the original traceback (which gave a counterexample
+per satisfying state), the search stops once it has found `number` satisfying states. The
+counterexamples are then the `number` most probable paths through everything explored (see
+k_best_paths), which may share their satisfying state. Since a path ends at the first satisfying
+state it reaches (so no counterexample is counted twice in the lower bound), there may be fewer.
+
+The frontier only holds the ids of the states, and the keys of the states in it are kept until
+they are popped.
+	'''
 	reset()
 	global DESIRED_NUMBER_COUNTEREXAMPLES
 	global backward_pointers
-	global num_counterexamples
-	global force_end_traceback
+	global state_encoder
 	DESIRED_NUMBER_COUNTEREXAMPLES = number
+	if packed_keys:
+		state_encoder = StateEncoder(crn)
 	boundary = crn.boundary
 	init_state = crn.init_state
-	# According to https://docs.python.org/3/library/queue.html, the priority queue
-	# is, by default, a min queue
-	pq = queue.PriorityQueue()
-	# TODO: according to the same docs, these queues are threadsafe, so
-	# we can eventually multithread this
+	backward_pointers = BackwardPointers(crn)
+	# Min queue
+	pq = Frontier()
+	# The keys of the states in the frontier, by id
+	frontier_keys = {0 : state_key(init_state)}
 	curr_state = None
 	state_priority = vass_priority(init_state, boundary, crn, include_flow_angle=include_flow_angle)
 	# print(f"State {init_state} has priority {state_priority}")
 	reaches[tuple(init_state)] = 1.0
-	pq.put((state_priority, tuple(init_state)))
+	pq.put((state_priority,), 0)
 	num_explored = 0
-	while (not pq.empty()) and num_counterexamples < number and not force_end_traceback:
-		# print(num_counterexamples)
+	while (not pq.empty()) and len(satisfying_ids) < number:
 		num_explored += 1
-		curr_priority, curr_state = pq.get()
-		# print(f"Got state {curr_state} at priority {curr_priority}")
-		if satisfies(curr_state, boundary):
-			print(f"Found satisfying state {curr_state} (explored {num_explored} states)")
-			force_end_traceback = False
-			traceback(curr_state)
+		curr_idx = pq.get()
+		curr_state = key_state(frontier_keys.pop(curr_idx))
+		# print(f"Got state {curr_state}")
+		if crn.satisfies(curr_state):
+			print(f"Found satisfying state {tuple(int(v) for v in curr_state)} (explored {num_explored} states)")
+			satisfying_ids.append(curr_idx)
 		# else:
 			# print(f"State {curr_state} does not satisfy condition")
-		transitions = get_transitions(curr_state, crn)
-		total_rate = 0.0
-		# reach = reaches[curr_state]
-		for rate, _ in transitions:
-			total_rate += rate
-		for rate, next_state in transitions:
-			if rate == 0.0:
+		enabled, rates = crn.propensities(curr_state)
+		reactions = np.flatnonzero(enabled)
+		total_rate = rates[reactions].sum()
+		log_probs = log_probabilities(rates[reactions], total_rate)
+		for reaction, log_prob in zip(reactions, log_probs):
+			if rates[reaction] == 0.0:
 				continue
-			if not tuple(next_state) in backward_pointers:
-				# print(f"State {next_state} has priority {priority}")
-				next_state_tuple = tuple(next_state)
+			next_state = curr_state + crn.stoichiometry[reaction]
+			next_key = state_key(next_state)
+			next_idx = backward_pointers.add_edge(curr_idx, reaction, log_prob, next_key)
+			if next_idx is not None:
 				# Only explore new states
-				# if not next_state_tuple in reaches:
-				# curr_reach = rate / total_rate * reach
-				priority = vass_priority(next_state, boundary, crn, include_flow_angle=include_flow_angle) # , curr_reach)
-				# reaches[next_state_tuple] = curr_reach
-				pq.put((priority, next_state_tuple))
-				backward_pointers[next_state_tuple] = [((rate) / (total_rate), curr_state)]
-			else:
-				backward_pointers[tuple(next_state)].append(((rate) / (total_rate), curr_state))
+				priority = vass_priority(next_state, boundary, crn, include_flow_angle=include_flow_angle)
+				frontier_keys[next_idx] = next_key
+				pq.put((priority,), next_idx)
+	extract_counterexamples(number, trace_writer)
 	if print_when_done:
 		print(f"Explored {num_explored} states")
 		print_counterexamples()
 
-def find_counterexamples_subsp(crn, dep, number=1, print_when_done=False, write_when_done=False):
+def find_counterexamples_subsp(crn, dep, number=1, print_when_done=False, write_when_done=False, packed_keys=False, trace_writer=None):
+	'''
+Finds `number` counterexamples by the subspace heuristic, with the same meaning of `number` as
+find_counterexamples. If write_when_done is set (and no trace_writer is given), the traces are
+written as text to DEFAULT_TRACE_FILE
+	'''
 	reset()
 	State.initialize_static_vars(crn, dep)
 	global DESIRED_NUMBER_COUNTEREXAMPLES
 	global backward_pointers
-	global num_counterexamples
-	global force_end_traceback
+	global state_encoder
 	DESIRED_NUMBER_COUNTEREXAMPLES = number
+	if packed_keys:
+		state_encoder = StateEncoder(crn)
+	backward_pointers = BackwardPointers(crn)
 	# Min queue
 	boundary = crn.boundary
 	num_explored = 0
-	pq = queue.PriorityQueue()
+	pq = Frontier()
 	curr_state = None
-	init_state = crn.init_state
-	reaches[tuple(init_state)] = 1.0
-	pq.put((State(init_state)))
-	while (not pq.empty()) and num_counterexamples < number: # and not force_end_traceback:
-		# Invariant(not pq.empty() or MustTerminate(num_counterexamples < number))
+	init_state = State(crn.init_state)
+	init_state.idx = 0
+	reaches[tuple(crn.init_state)] = 1.0
+	pq.put(init_state.priority, init_state)
+	while (not pq.empty()) and len(satisfying_ids) < number:
+		# Invariant(not pq.empty() or MustTerminate(len(satisfying_ids) < number))
 		# print(pq.qsize())
 		num_explored += 1
 		if num_explored % 20000 == 0:
@@ -152,65 +323,46 @@ def find_counterexamples_subsp(crn, dep, number=1, print_when_done=False, write_
 		curr_state = curr_state_data.vec
 		# print(curr_state, curr_state_data.order)
 		# print(f"\tEpsilon: {curr_state_data.epsilon}") # [len(curr_state_data.epsilon) - 1]}")
-		if satisfies(curr_state, boundary):
+		if crn.satisfies(curr_state):
 			print(f"Found satisfying state {tuple(curr_state)}")
-			force_end_traceback = False
-			traceback(tuple(curr_state))
+			satisfying_ids.append(curr_state_data.idx)
 		# else:
 		# 	print(f"{curr_state} does NOT satisfy")
-		successors, total_rate = curr_state_data.successors()
-		for s, rate in successors:
-			next_state = s.vec
-			if not tuple(next_state) in backward_pointers:
-				# print(f"State {next_state} has priority {priority}")
-				next_state_tuple = tuple(next_state)
+		successors, total_rate = curr_state_data.successors(reactions=True)
+		log_probs = log_probabilities([rate for _, rate, _ in successors], total_rate)
+		for (s, rate, reaction), log_prob in zip(successors, log_probs):
+			next_idx = backward_pointers.add_edge(curr_state_data.idx, reaction, log_prob, state_key(s.vec))
+			if next_idx is not None:
+				# print(f"State {s.vec} has priority {s.priority}")
 				# Only explore new states
-				pq.put(s)
-				backward_pointers[next_state_tuple] = [((rate) / (total_rate), tuple(curr_state))]
-			else:
-				backward_pointers[tuple(next_state)].append(((rate) / (total_rate), tuple(curr_state)))
+				s.idx = next_idx
+				pq.put(s.priority, s)
+	if write_when_done and trace_writer is None:
+		with TraceWriter(DEFAULT_TRACE_FILE, crn) as trace_writer:
+			extract_counterexamples(number, trace_writer)
+	else:
+		extract_counterexamples(number, trace_writer)
 	if print_when_done:
 		print(f"Explored {num_explored} states")
 		print_counterexamples()
-	if write_when_done:
-		print_counterexamples(True, True, True)
 
-def find_counterexamples_randomly(crn, number=1, print_when_done=False, trace_length=100):
+def find_counterexamples_randomly(crn, number=1, print_when_done=False, trace_length=100, trace_writer=None, num_walkers=NUM_WALKERS, selection=UNIFORM, workers=None, seed=None):
+	'''
+Finds `number` distinct counterexamples by random exploration, with batches of num_walkers
+walkers of at most trace_length steps simulated at once (see walkers.random_walks), optionally
+on several worker processes
+	'''
 	reset()
 	global DESIRED_NUMBER_COUNTEREXAMPLES
-	global backward_pointers
 	global num_counterexamples
 	global counterexamples
-	ces_set = {}
 	DESIRED_NUMBER_COUNTEREXAMPLES = number
-	boundary = crn.boundary
-	init_state = crn.init_state
-	while num_counterexamples < number:
-		ce = [tuple(init_state)]
-		curr_state = init_state
-		prob = 1.0
-		for _ in range(trace_length):
-			transitions = get_transitions(curr_state, crn)
-			total_rate = 0.0
-			for rate, _ in transitions:
-				total_rate += rate
-			chosen_transition = transitions[random.randint(0, len(transitions) - 1)]
-			next_state = tuple(chosen_transition[1])
-			next_rate = chosen_transition[0]
-			prob *= next_rate / total_rate
-			ce.append(next_state)
-			if satisfies(next_state, boundary):
-				# print(next_state, " satisfies")
-				num_counterexamples += 1
-				ce_tup = tuple(ce)
-				# print(ce_tup)
-				if not ce_tup in ces_set:
-					counterexamples.append((prob, ce))
-					ces_set[ce_tup] = True
-					break
-			else:
-				# print(next_state, " does not satisfy")
-				curr_state = next_state
+	for log_prob, reactions in random_walks(crn, number, trace_length=trace_length, num_walkers=num_walkers, selection=selection, workers=workers, seed=seed):
+		trace = Trace(crn.init_state, reactions, crn.stoichiometry)
+		counterexamples.append((log_prob, trace))
+		if trace_writer is not None:
+			trace_writer.write(log_prob, trace)
+	num_counterexamples = len(counterexamples)
 	if print_when_done:
 		print_counterexamples()
 
@@ -227,18 +379,17 @@ def print_counterexamples(show_entire_trace=False, write_when_done=False, single
 	if single_line:
 		end=" "
 	print(f"Finished finding {len(counterexamples)} counterexamples", file=out_file)
-	lower_bound = 0.0
-	for est_prob, ce in counterexamples:
-		lower_bound += est_prob
-		print(f"Counterexample size {len(ce)} (esimated probability {est_prob})", file=out_file, end=end)
+	for log_prob, ce in counterexamples:
+		print(f"Counterexample size {len(ce)} (esimated probability {format_probability(log_prob)})", file=out_file, end=end)
 		# print(ce)
 		if show_entire_trace:
-			for i in range(len(ce)):
-				state = ce[i]
+			states = ce.states()
+			for i in range(len(states)):
+				state = states[i]
 				additional_message = ""
 				if i == 0:
 					additional_message = " (satisfying state)"
-				elif i == len(ce) - 1:
+				elif i == len(states) - 1:
 					additional_message = " (initial state)"
 				if single_line:
 					print(f"State: {state}{additional_message}", file=out_file, end=end)
@@ -246,6 +397,8 @@ def print_counterexamples(show_entire_trace=False, write_when_done=False, single
 					print(f"\tState: {state}{additional_message}", file=out_file, end=end)
 		if single_line:
 			print(file=out_file)
-	print(f"Total lower bound probability: {lower_bound}", file=out_file)
+	# Summed in log space, since the probabilities of the counterexamples may underflow
+	lower_bound = log_sum([log_prob for log_prob, _ in counterexamples])
+	print(f"Total lower bound probability: {format_probability(lower_bound)}", file=out_file)
 	if write_when_done:
 		out_file.close()
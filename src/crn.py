@@ -19,11 +19,36 @@ class Bound:
 	def to_mask(self):
 		return 0.0 if self.bound_type == BoundTypes.DONT_CARE else 1.0
 
+def boundary_arrays(boundary) -> tuple:
+	'''
+	Compiles a boundary (a list of Bounds) into arrays (lower, upper) of the smallest and largest
+	count of each species that satisfies it, with -inf and inf for unbounded sides (e.g., don't
+	cares). Since counts are integers, strict bounds are tightened by one.
+	'''
+	lower = np.full(len(boundary), -np.inf)
+	upper = np.full(len(boundary), np.inf)
+	for i, b in enumerate(boundary):
+		if b.bound_type == BoundTypes.EQUAL:
+			lower[i] = upper[i] = b.bound
+		elif b.bound_type == BoundTypes.LESS_THAN:
+			upper[i] = b.bound - 1
+		elif b.bound_type == BoundTypes.LESS_THAN_EQ:
+			upper[i] = b.bound
+		elif b.bound_type == BoundTypes.GREATER_THAN:
+			lower[i] = b.bound + 1
+		elif b.bound_type == BoundTypes.GREATER_THAN_EQ:
+			lower[i] = b.bound
+		elif b.bound_type != BoundTypes.DONT_CARE:
+			raise Exception(f"bound_type not supported: '{b.bound_type}'!")
+	return lower, upper
+
 class Transition:
 	# vector      #: np.vector
 	# enabled     #: lambda
 	# rate_finder #: lambda
-	def __init__(self, vector, enabled, rate_finder, name=None, rate_constant=None):
+	# reactants   #: list of species indexes that must be nonzero for the transition to fire
+	# rate_orders #: np.vector of the exponent of each species in the rate law
+	def __init__(self, vector, enabled, rate_finder, name=None, rate_constant=None, reactants=None, rate_orders=None):
 		self.vector = np.array(vector)
 		self.vec_as_mat = np.matrix(vector).T
 		self.enabled_lambda = enabled
@@ -31,6 +56,12 @@ class Transition:
 		self.can_eliminate = False
 		self.name = name
 		self.rate_constant = rate_constant
+		# If both of these are known (i.e., the transition is mass-action and came from the
+		# parser) the transition can be compiled into the Crn's propensity tables
+		self.reactants = reactants
+		self.rate_orders = rate_orders
+		# Index into the Crn's transition list (set by the Crn)
+		self.idx = None
 
 	def enabled(self, state):
 		return self.enabled_lambda(state)
@@ -46,13 +77,87 @@ class Crn:
 		else:
 			self.transitions = transitions
 		self.init_state = init_state
+		self.lower_bounds, self.upper_bounds = boundary_arrays(boundary)
 		# self.prune_transitions()
 		self.react_depriority = np.array([0.0 if self.boundary[i].bound_type == BoundTypes.DONT_CARE else 1.0 for i in range(len(boundary))])
 		self.all_trans_always_enabled = all_trans_always_enabled
 		self.all_rates_const = all_rates_const
+		self.compile()
 
 	def add_transition(self, transition : Transition):
 		self.transitions.append(transition)
+		self.compile()
+
+	def compile(self):
+		'''
+	Builds the compiled representation of the CRN: a stoichiometry matrix (one row per transition),
+	a reactant-index table with the order of each reactant in the rate law, and a vector of rate
+	constants. This allows the enabled mask and propensities of every transition to be computed in
+	one vectorized call. If any transition is not mass-action (i.e., only has lambdas), we fall back
+	on evaluating the lambdas one at a time.
+		'''
+		for i in range(len(self.transitions)):
+			self.transitions[i].idx = i
+		num_species = len(self.boundary)
+		self.stoichiometry = np.array([t.vector for t in self.transitions]).reshape(len(self.transitions), num_species)
+		self.compiled = len(self.transitions) > 0 and all([t.reactants is not None and t.rate_orders is not None for t in self.transitions])
+		if not self.compiled:
+			return
+		# The reactant table is padded with index num_species, which points at a constant 1 appended
+		# to the state, and does not require anything to be enabled nor contributes to the rate
+		table_species = [sorted(set(t.reactants) | set(np.flatnonzero(t.rate_orders))) for t in self.transitions]
+		width = max(1, max([len(species) for species in table_species]))
+		self.reactant_table = np.full((len(self.transitions), width), num_species, dtype=np.int64)
+		self.reactant_orders = np.zeros((len(self.transitions), width), dtype=np.int64)
+		self.reactant_needs = np.zeros((len(self.transitions), width))
+		for i in range(len(self.transitions)):
+			t = self.transitions[i]
+			species = table_species[i]
+			self.reactant_table[i, :len(species)] = species
+			self.reactant_orders[i, :len(species)] = [int(t.rate_orders[j]) for j in species]
+			# All reactants must be strictly greater than zero
+			self.reactant_needs[i, :len(species)] = [float(j in t.reactants) for j in species]
+		self.rate_constants = np.array([t.rate_constant for t in self.transitions], dtype=float)
+
+	def propensities(self, state):
+		'''
+	Evaluates every transition at a state. Returns a tuple of the enabled mask and the vector of
+	rates (propensities) of each transition, which are zero for disabled transitions.
+
+	If state is a (k x species) array of states, the mask and rates are (k x transitions) arrays.
+		'''
+		state = np.asarray(state)
+		if not self.compiled:
+			if state.ndim == 2:
+				results = [self.propensities(s) for s in state]
+				return np.array([e for e, _ in results]).reshape(len(state), len(self.transitions)) \
+					, np.array([r for _, r in results]).reshape(len(state), len(self.transitions))
+			enabled = np.array([bool(t.enabled(state)) for t in self.transitions])
+			rates = np.array([t.rate_finder(state) if enabled[t.idx] else 0.0 for t in self.transitions], dtype=float)
+			return enabled, rates
+		ones = np.ones(state.shape[:-1] + (1,), dtype=state.dtype)
+		vals = np.concatenate([state, ones], axis=-1)[..., self.reactant_table]
+		enabled = np.all(vals >= self.reactant_needs, axis=-1)
+		# Integer powers (rather than float powers) keep the rates exact
+		rates = self.rate_constants * np.prod(np.power(vals.astype(np.int64), self.reactant_orders), axis=-1)
+		return enabled, np.where(enabled, rates, 0.0)
+
+	def satisfies(self, state):
+		'''
+	Checks to see if a state satisfies (or is within) the boundary. If state is a (k x species)
+	array of states, returns a mask with one entry per state.
+		'''
+		state = np.asarray(state)
+		return np.all((state >= self.lower_bounds) & (state <= self.upper_bounds), axis=-1)
+
+	def boundary_distance(self, state):
+		'''
+	The distance of each species from the nearest count that satisfies its bound (so it is zero
+	exactly when the bound is satisfied). If state is a (k x species) array of states, returns a
+	(k x species) array.
+		'''
+		state = np.asarray(state)
+		return np.maximum(self.lower_bounds - state, 0.0) + np.maximum(state - self.upper_bounds, 0.0)
 
 	def find_transition_by_name(self, name):
 		for t in self.transitions:
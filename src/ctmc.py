@@ -0,0 +1,221 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import breadth_first_order
+from scipy.sparse.linalg import bicgstab, spsolve_triangular
+
+# A native solver for reachability probabilities on the partial CTMC, working directly on the
+# CSR arrays built by the CsrMatrixBuilder (so stormpy is not needed).
+
+# Iterative methods for unbounded reachability
+GAUSS_SEIDEL = "gauss-seidel"
+BICGSTAB = "bicgstab"
+METHODS = [GAUSS_SEIDEL, BICGSTAB]
+
+# Relative precision of unbounded reachability (per state, for Gauss-Seidel)
+PRECISION = 1e-10
+MAX_ITERATIONS = 100000
+# Truncation error of the Poisson weights in uniformization
+POISSON_EPSILON = 1e-12
+# Largest number of maybe states for which uniformization skips to the left truncation point
+# with dense matrix squaring
+DENSE_LIMIT = 512
+
+def rate_matrix(row_ptr, cols, vals) -> sp.csr_matrix:
+	size = len(row_ptr) - 1
+	return sp.csr_matrix((vals, cols, row_ptr), shape=(size, size))
+
+def backward_reachable(rates : sp.csr_matrix, targets) -> np.ndarray:
+	'''
+	Returns a mask of the states from which some state in targets is reachable (including
+	the targets themselves)
+	'''
+	size = rates.shape[0]
+	targets = np.asarray(targets, dtype=np.int64)
+	# Reverse the edges, and add a source vertex (index size) with an edge to every target
+	edges = rates.tocoo()
+	graph = sp.csr_matrix((np.ones(len(edges.data) + len(targets)),
+			(np.concatenate([edges.col, np.full(len(targets), size)]), np.concatenate([edges.row, targets]))),
+			shape=(size + 1, size + 1))
+	reached = breadth_first_order(graph, size, directed=True, return_predecessors=False)
+	mask = np.zeros(size + 1, dtype=bool)
+	mask[reached] = True
+	return mask[:size]
+
+def maybe_states(rates : sp.csr_matrix, targets) -> np.ndarray:
+	'''
+	The indexes of the states whose reachability probability is not trivially 0 or 1
+	(i.e., they can reach a target but are not one)
+	'''
+	mask = backward_reachable(rates, targets)
+	mask[targets] = False
+	return np.flatnonzero(mask)
+
+def reachability(row_ptr, cols, vals, targets, time_bound=None, method=GAUSS_SEIDEL, x0=None, absorbing=None):
+	'''
+	Computes the probability of eventually reaching (or, if time_bound is given, reaching
+	within time_bound) one of the target states, from every state of the CTMC. Returns the
+	vector of probabilities, which may be passed back as x0 to warm start the next solve.
+
+	If absorbing (a state whose only transition is a self loop) is given, the probability of
+	reaching either a target or the absorbing state is computed in the same solve, and an array
+	with two columns (without and with the absorbing state as a target) is returned instead.
+	For unbounded reachability, the second column is computed as 1 - the probability of reaching
+	a state that can reach neither, which keeps its precision when it is close to 1.
+
+	Transitions are given as rates, and each row's exit rate is its row sum.
+	'''
+	rates = rate_matrix(row_ptr, cols, vals)
+	size = rates.shape[0]
+	targets = np.asarray(targets, dtype=np.int64)
+	target_sets = [targets]
+	complement = absorbing is not None and time_bound is None
+	if complement:
+		# The states that can reach neither a target nor the absorbing state
+		target_sets.append(np.flatnonzero(~backward_reachable(rates, np.append(targets, absorbing))))
+		if x0 is not None:
+			x0 = np.column_stack([x0[:, 0], 1.0 - x0[:, 1]])
+	elif absorbing is not None:
+		target_sets.append(np.append(targets, absorbing))
+	maybe = maybe_states(rates, np.concatenate(target_sets))
+	x = np.zeros((size, len(target_sets)))
+	for j, t in enumerate(target_sets):
+		x[t, j] = 1.0
+	if len(maybe) > 0:
+		sub = rates[maybe]
+		exit_rates = np.asarray(sub.sum(axis=1)).ravel()
+		to_maybe = sub[:, maybe]
+		# The rate of reaching each set of targets in one step from each maybe state
+		to_targets = np.column_stack([np.asarray(sub[:, t].sum(axis=1)).ravel() for t in target_sets])
+		if time_bound is None:
+			# Embedded DTMC: x = P x + b on the maybe states
+			inv_exit = sp.diags(1.0 / exit_rates)
+			P = inv_exit @ to_maybe
+			b = to_targets / exit_rates[:, np.newaxis]
+			guess = None if x0 is None else np.asarray(x0).reshape(size, -1)[maybe]
+			if method == GAUSS_SEIDEL:
+				x[maybe] = gauss_seidel(P, b, guess)
+			elif method == BICGSTAB:
+				x[maybe] = solve_bicgstab(P, b, guess)
+			else:
+				raise Exception(f"Unknown method {method}")
+		else:
+			x[maybe] = uniformization(to_maybe, to_targets, exit_rates, float(time_bound))
+	if absorbing is None:
+		return x[:, 0]
+	if complement:
+		x[:, 1] = 1.0 - x[:, 1]
+	return x
+
+def gauss_seidel(P : sp.csr_matrix, b : np.ndarray, x0 : np.ndarray = None) -> np.ndarray:
+	'''
+	Solves (I - P) x = b (b may have several columns). Starting from x0 = 0, every iterate is a
+	lower bound on the solution.
+	Stops when no entry changes by more than PRECISION relative to its value.
+	'''
+	A = (sp.eye(P.shape[0], format="csr") - P).tocsr()
+	lower = sp.tril(A, format="csr")
+	upper = -sp.triu(A, k=1, format="csr")
+	x = np.zeros(b.shape) if x0 is None else np.minimum(np.maximum(x0, 0.0), 1.0)
+	for _ in range(MAX_ITERATIONS):
+		x_next = spsolve_triangular(lower, upper @ x + b, lower=True)
+		converged = np.all(np.abs(x_next - x) <= PRECISION * np.abs(x_next))
+		x = x_next
+		if converged:
+			break
+	else:
+		print(f"Warning: Gauss-Seidel did not converge in {MAX_ITERATIONS} iterations")
+	return x
+
+def solve_bicgstab(P : sp.csr_matrix, b : np.ndarray, x0 : np.ndarray = None) -> np.ndarray:
+	'''
+	Solves (I - P) x = b with BiCGSTAB
+	'''
+	A = (sp.eye(P.shape[0], format="csr") - P).tocsr()
+	x = np.zeros(b.shape)
+	# BiCGSTAB only takes one right hand side at a time
+	for j in range(b.shape[1]):
+		x[:, j], info = bicgstab(A, b[:, j], x0=None if x0 is None else x0[:, j], rtol=PRECISION, maxiter=MAX_ITERATIONS)
+		if info != 0:
+			print(f"Warning: BiCGSTAB did not converge (info = {info})")
+	return np.minimum(np.maximum(x, 0.0), 1.0)
+
+def uniformization(to_maybe : sp.csr_matrix, to_targets : np.ndarray, exit_rates : np.ndarray, time_bound : float) -> np.ndarray:
+	'''
+	Computes the time bounded reachability probabilities of the maybe states, with the targets
+	made absorbing. The uniformized DTMC is stepped backward from the target indicator, and the
+	steps are weighted by the (Fox-Glynn truncated) Poisson probabilities.
+	'''
+	q = 1.02 * np.max(exit_rates)
+	# Uniformized DTMC restricted to the maybe states, plus the column into the targets
+	# (whose value is always 1)
+	P = (to_maybe / q + sp.diags(1.0 - exit_rates / q)).tocsr()
+	b = to_targets / q
+	left, weights = fox_glynn(q * time_bound, POISSON_EPSILON)
+	# v_k is the probability of having reached a target within k steps
+	v = np.zeros(b.shape)
+	result = np.zeros(b.shape)
+	start = 0
+	if left > len(weights) and len(b) <= DENSE_LIMIT:
+		v = power_step(P, b, left)
+		start = left
+	for k in range(start, left + len(weights)):
+		if k >= left:
+			result += weights[k - left] * v
+		v = P @ v + b
+	return np.minimum(result, 1.0)
+
+def power_step(P : sp.csr_matrix, b : np.ndarray, steps : int) -> np.ndarray:
+	'''
+	Applies v <- P v + b to v = 0 steps times, by repeatedly squaring the (dense) matrix of the
+	affine step. Since every matrix is nonnegative there is no cancellation, so (unlike with a
+	matrix exponential) even very small probabilities keep their relative precision.
+	'''
+	n, k = b.shape
+	step = np.zeros((n + k, n + k))
+	step[:n, :n] = P.toarray()
+	step[:n, n:] = b
+	step[n:, n:] = np.eye(k)
+	result = np.eye(n + k)
+	while steps > 0:
+		if steps & 1:
+			result = step @ result
+		steps >>= 1
+		if steps > 0:
+			step = step @ step
+	return result[:n, n:]
+
+def fox_glynn(rate : float, epsilon : float):
+	'''
+	Returns the left truncation point L and the normalized Poisson(rate) weights w_L, ..., w_R
+	such that the truncated mass is at most epsilon. As in Fox and Glynn, weights are computed
+	relative to the mode by recursion in both directions (so they do not underflow), and only
+	normalized at the end.
+	'''
+	mode = int(np.floor(rate))
+	right_weights = [1.0]
+	left_weights = []
+	total = 1.0
+	# Right tail: each step multiplies by rate / (k + 1) < 1, so the remaining mass is bounded
+	# by a geometric series
+	k = mode
+	while True:
+		ratio = rate / (k + 1)
+		w = right_weights[-1] * ratio
+		if ratio < 1.0 and w / (1.0 - ratio) <= epsilon / 2 * total:
+			break
+		right_weights.append(w)
+		total += w
+		k += 1
+	# Left tail: each step multiplies by k / rate < 1
+	k = mode
+	w = 1.0
+	while k > 0:
+		ratio = k / rate
+		w *= ratio
+		if ratio < 1.0 and w / (1.0 - ratio) <= epsilon / 2 * total:
+			break
+		left_weights.append(w)
+		total += w
+		k -= 1
+	weights = np.array(left_weights[::-1] + right_weights) / total
+	return mode - len(left_weights), weights
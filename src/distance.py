@@ -9,12 +9,8 @@ def get_transitions(state, crn : Crn):
 Use properties of a VASS to get the enabled transitions of a particular
 	'''
 	# global all_transitions
-	transitions = []
-	for transition in crn.transitions:
-		if transition.enabled(state):
-			next_state = state + transition.vector
-			transitions.append((transition.rate_finder(state), next_state))
-	return transitions
+	enabled, rates = crn.propensities(state)
+	return [(rates[i], state + crn.stoichiometry[i]) for i in np.flatnonzero(enabled)]
 
 def species_distance(value, bound, bound_type=BoundTypes.EQUAL, normalize=True):
 	norm_factor = 1 if normalize else abs(value - bound)
@@ -22,9 +18,13 @@ def species_distance(value, bound, bound_type=BoundTypes.EQUAL, normalize=True):
 		return 0.0
 	elif bound_type == BoundTypes.EQUAL:
 		return abs(value - bound) / norm_factor
-	elif bound_type == BoundTypes.LESS_THAN or bound_type == BoundTypes.LESS_THAN_EQ: # LESS_THAN_EQ is counted here too
+	elif bound_type == BoundTypes.LESS_THAN:
+		return max(value - bound + 1, 0) / norm_factor
+	elif bound_type == BoundTypes.LESS_THAN_EQ:
 		return max(value - bound, 0) / norm_factor
-	elif bound_type == BoundTypes.GREATER_THAN or bound_type == BoundTypes.GREATER_THAN:
+	elif bound_type == BoundTypes.GREATER_THAN:
+		return max(bound + 1 - value, 0) / norm_factor
+	elif bound_type == BoundTypes.GREATER_THAN_EQ:
 		return max(bound - value, 0) / norm_factor
 	else:
 		raise Exception(f"bound_type not supported: '{bound_type}'!")
@@ -40,23 +40,21 @@ def species_satisfies(value, bound, bound_type=BoundTypes.EQUAL):
 		return value <= bound
 	elif bound_type == BoundTypes.GREATER_THAN:
 		return value > bound
-	elif bound_type == BoundTypes.GREATER_THAN:
+	elif bound_type == BoundTypes.GREATER_THAN_EQ:
 		return value >= bound
 	else:
 		raise Exception(f"bound_type not supported: '{bound_type}'!")
 
 def satisfies(state, boundary):
 	'''
-Checks to see if a state satisfies (or is within) the boundary
+Checks to see if a state satisfies (or is within) the boundary. If state is a (k x species) array
+of states, returns a mask with one entry per state. Crn.satisfies does the same with the Crn's
+precompiled boundary.
 	'''
-	assert(len(state) == len(boundary))
-	for i in range(len(state)):
-		# dist = species_distance(state[i], boundary[i].bound, boundary[i].bound_type)
-		# print(f"Distance = {dist}")
-		if not species_satisfies(state[i], boundary[i].bound, boundary[i].bound_type):# dist != 0:
-			# print(f"failed on index {i}: val {state[i]}, bound type: {boundary[i].bound_type}")
-			return False
-	return True
+	lower, upper = boundary_arrays(boundary)
+	state = np.asarray(state)
+	assert(state.shape[-1] == len(boundary))
+	return np.all((state >= lower) & (state <= upper), axis=-1)
 
 def averaging_total_distance(state, bounds, bound_types, weights=None, normalize=True):
 	assert(len(state) == len(bounds) == len(bound_types))
@@ -101,27 +99,25 @@ def angle(v1, v2):
 def vass_distance(state, boundary, exact_equal=False):
 	'''
 Parameters:
-state: the current state we're in
-boundary: The variable boundaries
+state: the current state we're in (or a (k x species) array of states)
+boundary: The variable boundaries (a list of Bounds), or a Crn, whose precompiled boundary is used
 	'''
 	# The shortest distance to the boundary is a superposition of the individual species'
 	# boundary distance vectors, and since each species is an element in the vector, we just
 	# need a vector with each species' distance in its index
-	assert(len(state) == len(boundary))
-	return np.array([
-			species_distance(
-				state[i]
-				, boundary[i].bound
-				, boundary[i].bound_type
-			) for i in range(len(state))
-		])
+	if isinstance(boundary, Crn):
+		return boundary.boundary_distance(state)
+	lower, upper = boundary_arrays(boundary)
+	state = np.asarray(state)
+	assert(state.shape[-1] == len(boundary))
+	return np.maximum(lower - state, 0.0) + np.maximum(state - upper, 0.0)
 
 def vass_priority(state, boundary, crn, reach=1.0, include_flow_angle=False, include_flow_mag=False, deprioritize_dont_cares=False):
 	'''
 Creates a priority from a state based on a boundary. The lower the priority, the sooner we should explore the state.
 This means you should use a min queue
 	'''
-	dist_vector = vass_distance(state, boundary)
+	dist_vector = vass_distance(state, crn)
 	v_dist = None
 	if deprioritize_dont_cares:
 		v_dist = np.linalg.norm(np.multiply(dist_vector, crn.react_depriority))
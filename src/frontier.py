@@ -0,0 +1,180 @@
+import heapq
+import math
+import os
+
+import numpy as np
+
+from spill import SPILL_LIMIT
+
+# The width of the epsilon range of each bucket of a SpillingFrontier
+EPSILON_QUANTUM = 1.0
+
+# How a (order, epsilon, tiebreak, index) entry of a SpillingFrontier is written to disk
+SPILL_RECORD = np.dtype([("order", np.int64), ("epsilon", np.float64), ("tiebreak", np.int64), ("item", np.int64)])
+
+class Frontier:
+	'''
+	A min-heap frontier for the search. Each entry is a tuple of the item's precomputed
+	priority, followed by a tiebreak counter and the item itself, i.e., (order, epsilon[0],
+	tiebreak, index) for a State. Since the tiebreak is unique, sifting only ever compares
+	floats and ints, and never calls the rich comparison methods of the item.
+
+	Unlike queue.PriorityQueue, this is not threadsafe, so it takes no locks.
+	'''
+	def __init__(self):
+		self.heap = []
+		self.tiebreak = 0
+
+	def put(self, priority : tuple, item):
+		'''
+		Pushes an item with a priority tuple. Lower priorities are popped first, and items
+		with equal priorities are popped in the order they were pushed.
+		'''
+		heapq.heappush(self.heap, priority + (self.tiebreak, item))
+		self.tiebreak += 1
+
+	def get(self):
+		'''
+		Pops the item with the lowest priority
+		'''
+		return heapq.heappop(self.heap)[-1]
+
+	def entries(self) -> np.ndarray:
+		'''
+		All of the (order, epsilon, tiebreak, index) entries, as SPILL_RECORDs (e.g., for a
+		checkpoint). Only valid for (order, epsilon) priorities and integer items.
+		'''
+		return np.array(self.heap, dtype=SPILL_RECORD)
+
+	def restore(self, records : np.ndarray, tiebreak : int):
+		'''
+		Adds the entries returned by entries(), and continues the tiebreak counter from tiebreak
+		'''
+		self.heap.extend(records.tolist())
+		heapq.heapify(self.heap)
+		self.tiebreak = max(self.tiebreak, tiebreak)
+
+	def empty(self) -> bool:
+		return len(self.heap) == 0
+
+	def __len__(self):
+		return len(self.heap)
+
+class SpillingFrontier:
+	'''
+	An external memory version of Frontier, for (order, epsilon) priorities and integer items
+	(i.e., StateStore indexes). Entries are grouped in buckets by order and quantized epsilon,
+	and each bucket is a heap of the same entries as a Frontier's. Buckets are popped in
+	priority order, so entries are popped in exactly the same order as from a Frontier.
+
+	When more than limit entries are in memory, the coldest (highest priority) buckets are
+	appended to a file each, until at most half of limit are left. A spilled bucket is read back
+	once it becomes the lowest one.
+	'''
+	def __init__(self, directory : str, limit : int = SPILL_LIMIT, quantum : float = EPSILON_QUANTUM):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		self.limit = limit
+		self.quantum = quantum
+		# The in-memory heap of each bucket
+		self.buckets = {}
+		# The number of entries on disk of each bucket
+		self.spilled = {}
+		# Min heap of the keys of the buckets with any entries
+		self.keys = []
+		self.tiebreak = 0
+		self.size = 0
+		self.in_memory = 0
+
+	def bucket(self, priority : tuple) -> tuple:
+		return (int(priority[0]), math.floor(priority[1] / self.quantum))
+
+	def path(self, key : tuple) -> str:
+		return os.path.join(self.directory, f"bucket_{key[0]}_{key[1]}")
+
+	def put(self, priority : tuple, item : int):
+		'''
+		Pushes an item with an (order, epsilon) priority
+		'''
+		self.push(priority + (self.tiebreak, item))
+		self.tiebreak += 1
+
+	def push(self, entry : tuple):
+		'''
+		Pushes an (order, epsilon, tiebreak, index) entry into its bucket
+		'''
+		key = self.bucket(entry)
+		heap = self.buckets.get(key)
+		if heap is None:
+			if key not in self.spilled:
+				heapq.heappush(self.keys, key)
+			heap = self.buckets[key] = []
+		heapq.heappush(heap, entry)
+		self.size += 1
+		self.in_memory += 1
+		if self.in_memory > self.limit:
+			self.spill()
+
+	def get(self):
+		'''
+		Pops the item with the lowest priority
+		'''
+		key = self.keys[0]
+		if key in self.spilled:
+			self.load(key)
+		heap = self.buckets[key]
+		entry = heapq.heappop(heap)
+		self.size -= 1
+		self.in_memory -= 1
+		if len(heap) == 0:
+			del self.buckets[key]
+			heapq.heappop(self.keys)
+		return entry[-1]
+
+	def spill(self):
+		'''
+		Appends the coldest buckets in memory to their files, until at most half of limit
+		entries are left in memory. The lowest bucket is never spilled.
+		'''
+		for key in sorted(self.buckets, reverse=True):
+			if self.in_memory <= self.limit // 2 or key == self.keys[0]:
+				break
+			heap = self.buckets.pop(key)
+			with open(self.path(key), "ab") as f:
+				np.array(heap, dtype=SPILL_RECORD).tofile(f)
+			self.spilled[key] = self.spilled.get(key, 0) + len(heap)
+			self.in_memory -= len(heap)
+
+	def load(self, key : tuple):
+		'''
+		Reads a spilled bucket back into memory
+		'''
+		records = np.fromfile(self.path(key), dtype=SPILL_RECORD)
+		os.remove(self.path(key))
+		del self.spilled[key]
+		heap = self.buckets.setdefault(key, [])
+		heap.extend(records.tolist())
+		heapq.heapify(heap)
+		self.in_memory += len(records)
+
+	def entries(self) -> np.ndarray:
+		'''
+		All of the entries (including the spilled ones), as SPILL_RECORDs
+		'''
+		records = [np.array(heap, dtype=SPILL_RECORD) for heap in self.buckets.values()]
+		records += [np.fromfile(self.path(key), dtype=SPILL_RECORD) for key in self.spilled]
+		return np.concatenate(records) if len(records) > 0 else np.zeros(0, dtype=SPILL_RECORD)
+
+	def restore(self, records : np.ndarray, tiebreak : int):
+		'''
+		Adds the entries returned by entries(), and continues the tiebreak counter from tiebreak
+		'''
+		for entry in records.tolist():
+			self.push(entry)
+		self.tiebreak = max(self.tiebreak, tiebreak)
+
+	def empty(self) -> bool:
+		return self.size == 0
+
+	def __len__(self):
+		return self.size
@@ -0,0 +1,228 @@
+import math
+import multiprocessing
+
+import numpy as np
+
+from subspace import State
+from walkers import sample_reactions, NUM_WALKERS
+from traces import format_probability
+
+# Importance sampling of the probability of reaching the boundary. Like the random walkers
+# (see walkers.py), batches of walkers are simulated at once, but each walker is biased toward
+# the boundary. The reactions whose successor has a better priority than the walker's current
+# state (by the subspace heuristic, or by the single order distance to the boundary) are
+# "closer". Each step is drawn from a defensive mixture: with probability bias from the closer
+# reactions (in proportion to their rates), and otherwise from the embedded DTMC of the CTMC.
+# Since a multiplicative bias on the rates is no match for fast reactions that undo the progress
+# of slow ones, the mixture makes progress however stiff the model is, while the likelihood ratio
+# of each step stays below 1 / (1 - bias).
+#
+# Each walker carries the likelihood ratio of its trace under the DTMC and under the biased
+# chain, so the mean of the ratios of the walkers that reach the boundary (and zero for those
+# that do not) is an unbiased estimate of the probability of reaching it within the trace length.
+
+# The heuristics that decide which reactions are closer
+SUBSPACE = "subspace"
+DISTANCE = "distance"
+HEURISTICS = [SUBSPACE, DISTANCE]
+
+# The default probability of taking a closer reaction (when there is one)
+IMPORTANCE_BIAS = 0.9
+# The default number of walkers simulated in total
+NUM_SAMPLES = 100000
+# The default trace length (the largest number of steps a walker takes)
+TRACE_LENGTH = 1000
+# The normal quantile of the confidence intervals (95%)
+CONFIDENCE_Z = 1.96
+# The largest number of elements of the successor (and successor residual) arrays built at once,
+# which bounds their memory however many walkers, reactions and subspaces there are
+SUCCESSOR_CHUNK = 1 << 22
+
+# The CRN of the batches run by worker processes. Set before the workers are forked, so it
+# never needs to be pickled (and the workers inherit State's static variables).
+worker_crn = None
+
+def priorities(crn, vecs, heuristic : str, residuals=None) -> tuple:
+	'''
+	The (order, distance) of each row of the (k x species) array vecs, which is compared
+	lexicographically. With the subspace heuristic, the residuals of the states may be given
+	(see State.priority_batch). With the distance heuristic, the order is always zero.
+	'''
+	if heuristic == SUBSPACE:
+		return State.priority_batch(vecs, residuals)
+	return np.zeros(len(vecs), dtype=int), np.linalg.norm(crn.boundary_distance(vecs), axis=1)
+
+def closer_reactions(crn, vecs, heuristic : str, residuals=None) -> np.ndarray:
+	'''
+	Whether each reaction takes each row of the (k x species) array vecs to a successor with a
+	better priority, as a (k x transitions) boolean array. The successors are built for only as
+	many states at a time as fit in SUCCESSOR_CHUNK elements.
+	'''
+	num_transitions = len(crn.transitions)
+	order, dist = priorities(crn, vecs, heuristic, residuals)
+	closer = np.zeros((len(vecs), num_transitions), dtype=bool)
+	row_size = vecs.shape[1] + (int(np.prod(residuals.shape[1:])) if residuals is not None else 0)
+	chunk = max(1, SUCCESSOR_CHUNK // (num_transitions * row_size))
+	for start in range(0, len(vecs), chunk):
+		stop = min(start + chunk, len(vecs))
+		succs = (vecs[start:stop, np.newaxis, :] + crn.stoichiometry[np.newaxis, :, :]).reshape(-1, vecs.shape[1])
+		succ_residuals = None
+		if residuals is not None:
+			succ_residuals = (residuals[start:stop, np.newaxis] + State.transition_residuals[np.newaxis]).reshape((-1,) + residuals.shape[1:])
+		next_order, next_dist = priorities(crn, succs, heuristic, succ_residuals)
+		next_order = next_order.reshape(stop - start, num_transitions)
+		next_dist = next_dist.reshape(stop - start, num_transitions)
+		order_chunk, dist_chunk = order[start:stop, np.newaxis], dist[start:stop, np.newaxis]
+		closer[start:stop] = (next_order < order_chunk) | ((next_order == order_chunk) & (next_dist < dist_chunk))
+	return closer
+
+def simulate_batch(crn, num_walkers : int, trace_length : int, heuristic : str, bias : float, rng : np.random.Generator) -> np.ndarray:
+	'''
+	Simulates num_walkers biased walkers from the initial state for at most trace_length steps
+	each. Returns the log likelihood ratios of the walkers that reached a satisfying state (the
+	others have a ratio of zero).
+	'''
+	if heuristic not in HEURISTICS:
+		raise Exception(f"Unknown heuristic {heuristic}. Must be one of {', '.join(HEURISTICS)}")
+	if not 0.0 <= bias < 1.0:
+		raise Exception(f"The bias must be a probability below 1, not {bias}")
+	states = np.tile(np.asarray(crn.init_state, dtype=np.int64), (num_walkers, 1))
+	log_ratios = np.zeros(num_walkers)
+	running = np.arange(num_walkers)
+	hits = []
+	if crn.satisfies(crn.init_state):
+		return log_ratios
+	# The subspace residuals of each walker's state, updated with the residual of each reaction
+	# taken (see State.transition_residuals), so they are never recomputed from scratch
+	subspace = heuristic == SUBSPACE and len(State.subspaces) > 0
+	if subspace:
+		residuals = np.repeat(State.subspace_residuals((states[:1] - State.offset_vec).astype(float)), num_walkers, axis=0)
+	for _ in range(trace_length):
+		enabled, rates = crn.propensities(states[running])
+		total_rates = rates.sum(axis=1)
+		live = total_rates > 0.0
+		running, rates, total_rates = running[live], rates[live], total_rates[live]
+		if len(running) == 0:
+			break
+		closer = closer_reactions(crn, states[running], heuristic, residuals[running] if subspace else None)
+		# The DTMC and the mixture (for walkers with no closer reactions, just the DTMC)
+		probs = rates / total_rates[:, np.newaxis]
+		closer_rates = np.where(closer, rates, 0.0)
+		closer_totals = closer_rates.sum(axis=1)
+		has_closer = closer_totals > 0.0
+		weights = probs.copy()
+		weights[has_closer] = (1.0 - bias) * probs[has_closer] + bias * closer_rates[has_closer] / closer_totals[has_closer, np.newaxis]
+		chosen = sample_reactions(weights, rng)
+		rows = np.arange(len(running))
+		log_ratios[running] += np.log(probs[rows, chosen]) - np.log(weights[rows, chosen])
+		states[running] += crn.stoichiometry[chosen]
+		if subspace:
+			residuals[running] += State.transition_residuals[chosen]
+		satisfied = crn.satisfies(states[running])
+		hits.append(log_ratios[running[satisfied]])
+		running = running[~satisfied]
+		if len(running) == 0:
+			break
+	return np.concatenate(hits) if len(hits) > 0 else np.zeros(0)
+
+def run_batch(args : tuple) -> np.ndarray:
+	'''
+	Runs simulate_batch on worker_crn in a worker process, with args (num_walkers,
+	trace_length, heuristic, bias, seed sequence)
+	'''
+	num_walkers, trace_length, heuristic, bias, seed = args
+	return simulate_batch(worker_crn, num_walkers, trace_length, heuristic, bias, np.random.default_rng(seed))
+
+class Estimate:
+	'''
+	The running mean and variance of the likelihood ratios of the samples, kept in log space
+	since the ratios (and their squares) may underflow
+	'''
+	def __init__(self):
+		self.num_samples = 0
+		self.num_hits = 0
+		self.log_sum = -math.inf
+		self.log_sum_sq = -math.inf
+
+	def add(self, num_samples : int, log_ratios : np.ndarray):
+		self.num_samples += num_samples
+		self.num_hits += len(log_ratios)
+		if len(log_ratios) > 0:
+			self.log_sum = np.logaddexp(self.log_sum, np.logaddexp.reduce(log_ratios))
+			self.log_sum_sq = np.logaddexp(self.log_sum_sq, np.logaddexp.reduce(2.0 * log_ratios))
+
+	def log_mean(self) -> float:
+		return self.log_sum - math.log(self.num_samples)
+
+	def log_std_error(self) -> float:
+		'''
+		The log of the standard error of the mean (from the sample variance of all of the samples,
+		including those that did not hit). It is -inf with no hits, and nan with fewer than two
+		samples.
+		'''
+		if self.num_hits == 0:
+			return -math.inf
+		if self.num_samples < 2:
+			return math.nan
+		# The sample variance is (sum X^2 - (sum X)^2 / n) / (n - 1)
+		ratio = math.exp(2.0 * self.log_sum - math.log(self.num_samples) - self.log_sum_sq)
+		if ratio >= 1.0:
+			return -math.inf
+		log_variance = self.log_sum_sq + math.log1p(-ratio) - math.log(self.num_samples - 1)
+		return 0.5 * (log_variance - math.log(self.num_samples))
+
+	def log_interval(self, z : float = CONFIDENCE_Z) -> tuple:
+		'''
+		The logs of the bounds of the (normal) confidence interval of the mean
+		'''
+		log_mean = self.log_mean()
+		log_half_width = self.log_std_error() + math.log(z)
+		upper = np.logaddexp(log_mean, log_half_width)
+		relative = math.exp(log_half_width - log_mean) if log_mean > -math.inf else 0.0
+		lower = log_mean + math.log1p(-relative) if relative < 1.0 else -math.inf
+		return lower, upper
+
+	def relative_error(self) -> float:
+		if self.num_hits == 0:
+			return math.inf
+		return math.exp(self.log_std_error() - self.log_mean())
+
+def estimate_probability(crn, num_samples : int = NUM_SAMPLES, trace_length : int = TRACE_LENGTH, heuristic : str = SUBSPACE, bias : float = IMPORTANCE_BIAS, num_walkers : int = NUM_WALKERS, workers : int = None, seed : int = None, rtol : float = None, print_when_done : bool = False) -> Estimate:
+	'''
+	Estimates the probability of reaching the boundary within trace_length steps by importance
+	sampling, with batches of num_walkers walkers (with workers, one batch on each worker
+	process at a time) until num_samples walkers have been simulated, or the relative standard
+	error falls below rtol. With the subspace heuristic, State's static variables must be
+	initialized for the CRN. Returns the Estimate.
+	'''
+	global worker_crn
+	seeds = np.random.SeedSequence(seed)
+	estimate = Estimate()
+	pool = None
+	if workers is not None and workers > 1:
+		worker_crn = crn
+		pool = multiprocessing.get_context("fork").Pool(workers)
+	try:
+		while estimate.num_samples < num_samples:
+			if rtol is not None and estimate.num_hits >= 2 and estimate.relative_error() < rtol:
+				break
+			sizes = [min(num_walkers, num_samples - estimate.num_samples)]
+			if pool is not None:
+				sizes = [min(num_walkers, max(0, num_samples - estimate.num_samples - i * num_walkers)) for i in range(workers)]
+				sizes = [size for size in sizes if size > 0]
+				batches = pool.map(run_batch, [(size, trace_length, heuristic, bias, s) for size, s in zip(sizes, seeds.spawn(len(sizes)))])
+			else:
+				batches = [simulate_batch(crn, sizes[0], trace_length, heuristic, bias, np.random.default_rng(seeds.spawn(1)[0]))]
+			for size, log_ratios in zip(sizes, batches):
+				estimate.add(size, log_ratios)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	if print_when_done:
+		lower, upper = estimate.log_interval()
+		print(f"{estimate.num_hits} of {estimate.num_samples} samples reached the boundary")
+		print(f"Estimated probability: {format_probability(estimate.log_mean())}")
+		print(f"Standard error: {format_probability(estimate.log_std_error())} (relative {estimate.relative_error()})")
+		print(f"95% confidence interval: [{format_probability(lower)}, {format_probability(upper)}]")
+	return estimate
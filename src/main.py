@@ -5,20 +5,43 @@ from counterexample import *
 from parser import *
 from solver import *
 from subspace import Subspace
+from parallel import min_probability_parallel, EXPAND_BATCH
+from portfolio import run_portfolio, VARIANTS
+from store import PROPENSITY_CACHE_SIZE
+from spill import SPILL_LIMIT
+from checkpoint import CHECKPOINT_INTERVAL
+from traces import TraceWriter, DEFAULT_TRACE_FILE, TEXT, FORMATS, COMPRESSIONS
+from walkers import NUM_WALKERS, UNIFORM, SELECTIONS
+from importance import estimate_probability, IMPORTANCE_BIAS, NUM_SAMPLES, TRACE_LENGTH, SUBSPACE, HEURISTICS
 
 import argparse
 import time
 
 store_traces = False
+trace_file = DEFAULT_TRACE_FILE
+trace_format = TEXT
+trace_compression = None
 
-def basic_priority(filename, num):
+def open_trace_writer(crn):
+	'''
+	The TraceWriter that traces are streamed to if they are stored (-t), or None
+	'''
+	if not store_traces:
+		return None
+	print(f"Writing traces to {trace_file}")
+	return TraceWriter(trace_file, crn, fmt=trace_format, compression=trace_compression)
+
+def basic_priority(filename, num, packed_keys=False):
 	crn = parse_ragtimer(filename)
 
 	print("========================================================")
 	print("Targeted Exploration (just distance)")
 	print("========================================================")
 	start_time = time.time()
-	find_counterexamples(crn, number=num, print_when_done=True)
+	trace_writer = open_trace_writer(crn)
+	find_counterexamples(crn, number=num, print_when_done=True, packed_keys=packed_keys, trace_writer=trace_writer)
+	if trace_writer is not None:
+		trace_writer.close()
 	end_time = time.time()
 	print(f"Total time {end_time - start_time} s")
 	# print("========================================================")
@@ -29,27 +52,33 @@ def basic_priority(filename, num):
 	# end_time = time.time()
 	# print(f"Total time {end_time - start_time} s")
 
-def random(filename, num):
+def random(filename, num, trace_length=100, num_walkers=NUM_WALKERS, selection=UNIFORM, workers=None, seed=None):
 	crn = parse_ragtimer(filename)
 	print("========================================================")
 	print("Random Exploration")
 	print("========================================================")
 	start_time = time.time()
-	find_counterexamples_randomly(crn, number=num, print_when_done=True)
+	trace_writer = open_trace_writer(crn)
+	find_counterexamples_randomly(crn, number=num, print_when_done=True, trace_length=trace_length, trace_writer=trace_writer, num_walkers=num_walkers, selection=selection, workers=workers, seed=seed)
+	if trace_writer is not None:
+		trace_writer.close()
 	end_time = time.time()
 	print(f"Total time {end_time - start_time} s")
 
-def subspace_priority(filename, num):
+def subspace_priority(filename, num, packed_keys=False):
 	dep, crn = parse_dependency_ragtimer(filename)
 	print("========================================================")
 	print("Targeted Exploration (Subspace)")
 	print("========================================================")
 	start_time = time.time()
-	find_counterexamples_subsp(crn, dep, number=num, print_when_done=True, write_when_done=store_traces)
+	trace_writer = open_trace_writer(crn)
+	find_counterexamples_subsp(crn, dep, number=num, print_when_done=True, packed_keys=packed_keys, trace_writer=trace_writer)
+	if trace_writer is not None:
+		trace_writer.close()
 	end_time = time.time()
 	print(f"Total time {end_time - start_time} s")
 
-def subspace_priority_solver(filename, num, time_bound, agnostic=False, piped=False, all_expand=False, single_order=False, use_rate_const=False):
+def subspace_priority_solver(filename, num, time_bound, agnostic=False, piped=False, all_expand=False, single_order=False, use_rate_const=False, batch_size=None, packed_keys=False, backend=STORM, check_every=None, check_interval=None, rtol=ANYTIME_RTOL, budget=None, workers=None, propensity_cache=None, spill_dir=None, spill_limit=SPILL_LIMIT, checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL, resume=False):
 	dep, crn = parse_dependency_ragtimer(filename, agnostic=agnostic)
 	print("========================================================")
 	print("Targeted Exploration (Subspace - With Solver)")
@@ -59,7 +88,33 @@ def subspace_priority_solver(filename, num, time_bound, agnostic=False, piped=Fa
 		piped_matrix = create_piped(crn, use_rate_const)
 		Subspace.initialize_piped(piped_matrix)
 	start_time = time.time()
-	min_probability_subsp(crn, dep, number=num, print_when_done=True, write_when_done=store_traces, time_bound=time_bound, expand_all_states=all_expand, single_order=single_order)
+	if workers is not None and workers > 1:
+		min_probability_parallel(crn, dep, number=num, num_workers=workers, print_when_done=True, time_bound=time_bound, expand_all_states=all_expand, single_order=single_order, batch_size=EXPAND_BATCH if batch_size is None else batch_size, packed_keys=packed_keys, backend=backend)
+	else:
+		# In anytime mode, only the bound decides when to stop
+		anytime = check_every is not None or check_interval is not None
+		min_probability_subsp(crn, dep, number=None if anytime else num, print_when_done=True, write_when_done=store_traces, time_bound=time_bound, expand_all_states=all_expand, single_order=single_order, batch_size=batch_size, packed_keys=packed_keys, backend=backend, check_every=check_every, check_interval=check_interval, rtol=rtol, budget=budget, propensity_cache=propensity_cache, spill_dir=spill_dir, spill_limit=spill_limit, checkpoint=checkpoint, checkpoint_interval=checkpoint_interval, resume=resume)
+	end_time = time.time()
+	print(f"Total time {end_time - start_time} s")
+
+def importance(filename, num_samples, trace_length=TRACE_LENGTH, heuristic=SUBSPACE, bias=IMPORTANCE_BIAS, agnostic=False, num_walkers=NUM_WALKERS, workers=None, seed=None, rtol=None):
+	dep, crn = parse_dependency_ragtimer(filename, agnostic=agnostic)
+	print("========================================================")
+	print(f"Importance Sampling ({heuristic})")
+	print("========================================================")
+	if heuristic == SUBSPACE:
+		State.initialize_static_vars(crn, dep)
+	start_time = time.time()
+	estimate_probability(crn, num_samples=num_samples, trace_length=trace_length, heuristic=heuristic, bias=bias, num_walkers=num_walkers, workers=workers, seed=seed, rtol=rtol, print_when_done=True)
+	end_time = time.time()
+	print(f"Total time {end_time - start_time} s")
+
+def portfolio(filename, num, time_bound, variants, use_rate_const=False, backend=STORM, target=None, time_limit=None):
+	print("========================================================")
+	print("Portfolio (" + ", ".join(variants) + ")")
+	print("========================================================")
+	start_time = time.time()
+	run_portfolio(filename, num, variants, time_bound=time_bound, backend=backend, target=target, time_limit=time_limit, use_rate_const=use_rate_const)
 	end_time = time.time()
 	print(f"Total time {end_time - start_time} s")
 
@@ -82,8 +137,28 @@ if __name__=="__main__":
 			help="Single order priority with CTMC analysis in StormPy")
 	parser.add_argument("-m", "--random", action="store_true",
 			help="Random exploration")
+	parser.add_argument("-I", "--importance", default=None,
+			help=f"Estimate the probability of reaching the boundary by importance sampling with this many walkers (or `default` for {NUM_SAMPLES}), biased toward the boundary by the heuristic given by --bias_heuristic. Reports the estimate with its standard error and a 95%% confidence interval. -a, --walkers, --seed and -w apply, and --trace_length (which defaults to {TRACE_LENGTH} here) bounds the number of steps.")
+	parser.add_argument("--bias", default=IMPORTANCE_BIAS,
+			help=f"With -I, the probability of taking one of the reactions that move toward the boundary (when there are any) at each step, rather than a reaction of the unbiased chain. Must be below 1. Lower biases give better estimates of probabilities that are not small. Defaults to {IMPORTANCE_BIAS}.")
+	parser.add_argument("--bias_heuristic", default=SUBSPACE, choices=HEURISTICS,
+			help="With -I, how reactions that move toward the boundary are chosen: `subspace` uses the priority (order and epsilon) of the dependency graph subspaces, while `distance` uses the single order distance to the boundary.")
+	parser.add_argument("--walkers", default=NUM_WALKERS,
+			help=f"With -m, the number of random walkers simulated at once (as one array) in each batch. Defaults to {NUM_WALKERS}.")
+	parser.add_argument("--walk_selection", default=UNIFORM, choices=SELECTIONS,
+			help="With -m, how walkers choose their next reaction: `uniform` picks any enabled reaction, while `proportional` picks reactions in proportion to their rates.")
+	parser.add_argument("--trace_length", default=None,
+			help="With -m, the largest number of steps in a trace. Defaults to 100.")
+	parser.add_argument("--seed", default=None,
+			help="With -m or -I, the seed of the random walkers.")
 	parser.add_argument("-t", "--traces", action="store_true",
 			help="Store traces to a file") # Store traces to a file
+	parser.add_argument("--trace_file", default=DEFAULT_TRACE_FILE,
+			help=f"With -t, the file traces are written to (as soon as they are found). Defaults to {DEFAULT_TRACE_FILE}.")
+	parser.add_argument("--trace_format", default=TEXT, choices=FORMATS,
+			help="With -t, the format of the trace file. `text` prints every state of every trace, while `binary` stores each trace as its initial state and the varint encoded indexes of its reactions (read it with traces.read_traces).")
+	parser.add_argument("--trace_compression", default=None, choices=COMPRESSIONS,
+			help="With -t, compress the trace file (zstd needs the zstandard module).")
 	parser.add_argument("-T", "--time", default=None,
 			help="If doing CTMC analysis, the time bound on the eventually property. "
 			+ "If this is not provided, checks `P=? [ true U \"satisfy\" ]`")
@@ -97,14 +172,57 @@ if __name__=="__main__":
 			help="When expanding states, expand ALL transitions rather than just those which the dependency graph specifies will get the shortest traces. This may help find higher probability traces.")
 	parser.add_argument("-Q", "--rate_constant", action="store_true",
 			help="Use rate constant in piped method.")
+	parser.add_argument("-b", "--batch", default=None,
+			help="When doing CTMC analysis, pop and expand this many states from the queue at once, computing their successors as a single array operation. This amortizes interpreter overhead on large explorations, but may change the exploration order slightly.")
+	parser.add_argument("-k", "--packed_keys", action="store_true",
+			help="Key the visited-state index on state vectors packed into a single integer, with bit widths per species derived from the initial state and reaction vectors. This makes deduplication cheaper and the index smaller.")
+	parser.add_argument("--backend", default=STORM, choices=BACKENDS,
+			help="The backend used for CTMC analysis. `storm` builds the model in StormPy, while `native` solves it directly with SciPy (Gauss-Seidel on the embedded DTMC, or uniformization with Fox-Glynn truncation if a time bound is given), and does not need StormPy to be installed.")
+	parser.add_argument("--check_every", default=None,
+			help="Anytime mode: when doing CTMC analysis, re-check the lower bound every this many expanded states (ignoring -n), and print each improved bound.")
+	parser.add_argument("--check_interval", default=None,
+			help="Anytime mode: when doing CTMC analysis, re-check the lower bound every this many seconds (ignoring -n), and print each improved bound.")
+	parser.add_argument("--rtol", default=None,
+			help=f"In anytime mode, stop once a check changes the lower bound by less than this (relative) amount. Defaults to {ANYTIME_RTOL}. With -I, stop once the relative standard error of the estimate is below this.")
+	parser.add_argument("--budget", default=None,
+			help="When doing CTMC analysis, stop exploring after this many seconds and check the partial CTMC explored so far.")
+	parser.add_argument("-w", "--workers", default=None,
+			help="When doing CTMC analysis, explore with this many worker processes, each of which owns a hash partition of the state space (with its own frontier and index) and exchanges successors with the others in batches. With -b, sets the number of states each worker expands at once. Anytime mode and the time budget are not supported with more than one worker. With -m, simulates a batch of walkers on each of this many worker processes at once.")
+	parser.add_argument("--propensity_cache", default=None,
+			help=f"When doing CTMC analysis, cache the propensities of up to this many perimeter states, so they are not evaluated again at every check (in anytime mode) and when the states are expanded. Use `default` for {PROPENSITY_CACHE_SIZE} states.")
+	parser.add_argument("--spill", default=None,
+			help="When doing CTMC analysis, explore in external memory mode: the frontier, the visited-state index and the state arrays spill to (memory mapped) files in a temporary directory in this directory, so explorations larger than RAM can finish. The triples of the rate matrix (see CsrMatrixBuilder) are still kept in memory, and so are the backward pointers of -p and -s (see BackwardPointers), which never spill. Not supported with more than one worker, and ignores -k.")
+	parser.add_argument("--spill_limit", default=SPILL_LIMIT,
+			help=f"With --spill, the number of frontier entries and of index entries kept in memory. Defaults to {SPILL_LIMIT}.")
+	parser.add_argument("--checkpoint", default=None,
+			help="When doing CTMC analysis, periodically save the exploration (the state store, frontier, matrix and satisfying states) to this .npz file, and once more when exploration stops.")
+	parser.add_argument("--checkpoint_interval", default=CHECKPOINT_INTERVAL,
+			help=f"With --checkpoint, the number of seconds between checkpoints. Defaults to {CHECKPOINT_INTERVAL}.")
+	parser.add_argument("--resume", action="store_true",
+			help="With --checkpoint, continue from the checkpoint if it exists (e.g., after the run was killed, or with a larger -n). The model and options must be the same as the run that saved it.")
+	parser.add_argument("--portfolio", default=None,
+			help=f"Run several CTMC analysis heuristics at once, each in its own process, and report the best bounds found by any of them. Either `all` or a comma separated list of: {', '.join(VARIANTS.keys())}. The time bound, -Q and --backend apply to every variant.")
+	parser.add_argument("--target", default=None,
+			help="With --portfolio, stop all of the heuristics once one of them finds a lower bound of at least this much. Use --budget to limit the time.")
 	args = parser.parse_args()
 	store_traces = args.traces
+	trace_file = args.trace_file
+	trace_format = args.trace_format
+	trace_compression = args.trace_compression
 	if args.ragtimer is None:
 		print("Missing args.")
 		sys.exit(1)
 	num = int(args.number)
+	batch_size = None if args.batch is None else int(args.batch)
+	check_every = None if args.check_every is None else int(args.check_every)
+	check_interval = None if args.check_interval is None else float(args.check_interval)
+	budget = None if args.budget is None else float(args.budget)
+	workers = None if args.workers is None else int(args.workers)
+	propensity_cache = None
+	if args.propensity_cache is not None:
+		propensity_cache = PROPENSITY_CACHE_SIZE if args.propensity_cache == "default" else int(args.propensity_cache)
 	if args.subspace:
-		subspace_priority(args.ragtimer, num)
+		subspace_priority(args.ragtimer, num, packed_keys=args.packed_keys)
 
 	if args.subspace_with_solver:
 		t = None
@@ -118,7 +236,21 @@ if __name__=="__main__":
 						, agnostic=args.agnostic
 						, piped=args.piped
 						, all_expand=args.expand_all
-						, use_rate_const=args.rate_constant)
+						, use_rate_const=args.rate_constant
+						, batch_size=batch_size
+						, packed_keys=args.packed_keys
+						, backend=args.backend
+						, check_every=check_every
+						, check_interval=check_interval
+						, rtol=ANYTIME_RTOL if args.rtol is None else float(args.rtol)
+						, budget=budget
+						, workers=workers
+						, propensity_cache=propensity_cache
+						, spill_dir=args.spill
+						, spill_limit=int(args.spill_limit)
+						, checkpoint=args.checkpoint
+						, checkpoint_interval=float(args.checkpoint_interval)
+						, resume=args.resume)
 
 	if args.solver:
 		t = None
@@ -133,11 +265,58 @@ if __name__=="__main__":
 						, piped=args.piped
 						, all_expand=args.expand_all
 						, single_order=True
-						, use_rate_const=args.rate_constant)
+						, use_rate_const=args.rate_constant
+						, batch_size=batch_size
+						, packed_keys=args.packed_keys
+						, backend=args.backend
+						, check_every=check_every
+						, check_interval=check_interval
+						, rtol=ANYTIME_RTOL if args.rtol is None else float(args.rtol)
+						, budget=budget
+						, workers=workers
+						, propensity_cache=propensity_cache
+						, spill_dir=args.spill
+						, spill_limit=int(args.spill_limit)
+						, checkpoint=args.checkpoint
+						, checkpoint_interval=float(args.checkpoint_interval)
+						, resume=args.resume)
+
+	if args.portfolio is not None:
+		t = None
+		if args.time is not None and not args.time.isnumeric():
+			print(f"Time bound {args.time} is invalid. Will ignore.")
+		elif args.time is not None:
+			t = int(args.time)
+		variants = list(VARIANTS.keys()) if args.portfolio == "all" else args.portfolio.split(",")
+		portfolio(args.ragtimer
+						, num
+						, time_bound=t
+						, variants=variants
+						, use_rate_const=args.rate_constant
+						, backend=args.backend
+						, target=None if args.target is None else float(args.target)
+						, time_limit=budget)
 
 	if args.primitive:
-		basic_priority(args.ragtimer, num)
+		basic_priority(args.ragtimer, num, packed_keys=args.packed_keys)
 
 	if args.random:
-		random(args.ragtimer, num)
+		random(args.ragtimer
+						, num
+						, trace_length=100 if args.trace_length is None else int(args.trace_length)
+						, num_walkers=int(args.walkers)
+						, selection=args.walk_selection
+						, workers=workers
+						, seed=None if args.seed is None else int(args.seed))
 
+	if args.importance is not None:
+		importance(args.ragtimer
+						, NUM_SAMPLES if args.importance == "default" else int(args.importance)
+						, trace_length=TRACE_LENGTH if args.trace_length is None else int(args.trace_length)
+						, heuristic=args.bias_heuristic
+						, bias=float(args.bias)
+						, agnostic=args.agnostic
+						, num_walkers=int(args.walkers)
+						, workers=workers
+						, seed=None if args.seed is None else int(args.seed)
+						, rtol=None if args.rtol is None else float(args.rtol))
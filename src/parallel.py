@@ -0,0 +1,302 @@
+import multiprocessing
+import os
+import queue
+import traceback
+
+import numpy as np
+
+from subspace import State
+from frontier import Frontier
+from store import StateStore, StateEncoder
+from sparse import CsrMatrixBuilder
+import solver
+
+# How many states each worker pops and expands at once (by default)
+EXPAND_BATCH = 16
+# How long (in seconds) an idle or waiting worker blocks on its inbox
+POLL_INTERVAL = 0.001
+# A worker only expands states whose priority is close to the best priority at the top of any
+# worker's frontier, so that the workers together still roughly follow the global priority order:
+# the order must be the same as the best order, and epsilon may be at most this much (relative)
+# larger than the best epsilon
+EPSILON_SLACK = 0.1
+
+class SharedSearch:
+	'''
+	The state shared by all workers through shared memory: the best (lowest) priority at the
+	top of each worker's frontier, the number of satisfying states found, the stop flag, and
+	the counters used to detect termination (all frontiers empty and no batches in flight).
+	'''
+	def __init__(self, ctx, num_workers : int):
+		self.lock = ctx.Lock()
+		# (order, epsilon) of the top of each frontier, inf if it is empty
+		self.best = ctx.Array("d", [np.inf] * (2 * num_workers), lock=False)
+		self.idle = ctx.Array("b", [0] * num_workers, lock=False)
+		# Batches sent and received
+		self.sent = ctx.Value("q", 0, lock=False)
+		self.received = ctx.Value("q", 0, lock=False)
+		self.num_satstates = ctx.Value("q", 0, lock=False)
+		self.stop = ctx.Value("b", 0, lock=False)
+
+	def best_priority(self) -> tuple:
+		return min(zip(self.best[0::2], self.best[1::2]))
+
+	def should_expand(self, priority : tuple) -> bool:
+		'''
+		Whether a worker whose best state has this priority may expand it now
+		'''
+		order, epsilon = self.best_priority()
+		return priority[0] < order or (priority[0] == order and priority[1] <= epsilon * (1.0 + EPSILON_SLACK))
+
+	def finished(self) -> bool:
+		'''
+		Whether every worker is idle with no batches left in flight
+		'''
+		with self.lock:
+			return all(self.idle) and self.sent.value == self.received.value
+
+class Partition:
+	'''
+	Hash partitions states among the workers. The hash only depends on the state vector, so
+	every process agrees on the owner of a state. The multipliers of the hash are drawn once per
+	run (with a fixed seed), and the workers inherit them when they are forked.
+	'''
+	def __init__(self, num_species : int, num_workers : int):
+		self.num_workers = np.uint64(num_workers)
+		self.multipliers = np.random.default_rng(0).integers(1, 2**63, size=num_species, dtype=np.uint64) | np.uint64(1)
+
+	def owners(self, vecs : np.ndarray) -> np.ndarray:
+		'''
+		Returns the rank of the worker that owns each state vector (row) of vecs
+		'''
+		vecs = np.atleast_2d(vecs).astype(np.uint64)
+		h = np.sum(vecs * self.multipliers, axis=1, dtype=np.uint64)
+		h ^= h >> np.uint64(29)
+		return (h % self.num_workers).astype(np.int64)
+
+def worker(rank : int, num_workers : int, crn, number : int, batch_size : int, expand_all_states : bool, packed_keys : bool, partition : Partition, inboxes : list, results, shared : SharedSearch):
+	'''
+	Runs explore() in a worker process. If it fails, stops the other workers and sends the
+	traceback to the coordinator instead.
+	'''
+	try:
+		explore(rank, num_workers, crn, number, batch_size, expand_all_states, packed_keys, partition, inboxes, results, shared)
+	except Exception:
+		shared.stop.value = 1
+		for q in inboxes:
+			q.cancel_join_thread()
+		results.put({"rank" : rank, "error" : traceback.format_exc()})
+
+def explore(rank : int, num_workers : int, crn, number : int, batch_size : int, expand_all_states : bool, packed_keys : bool, partition : Partition, inboxes : list, results, shared : SharedSearch):
+	'''
+	Explores the states owned by this worker. States are received in batches from the inbox,
+	expanded in priority order, and successors owned by other workers are sent to their
+	inboxes. When the search stops, sends the local state space (with its transitions, whose
+	targets are given as state vectors) to the coordinator.
+	'''
+	n = len(crn.init_state)
+	store = StateStore(n, encoder=StateEncoder(crn) if packed_keys else None)
+	pq = Frontier()
+	inbox = inboxes[rank]
+	# Keys of the states already sent to other workers, so they are only sent once
+	sent_keys = set()
+	edge_src = []
+	edge_dst = []
+	edge_rate = []
+	abs_src = []
+	abs_rate = []
+	sat_idxs = []
+	deadlock_idxs = []
+	num_explored = 0
+	parent = os.getppid()
+	# Stop if the coordinator is gone (e.g., killed), so workers are not orphaned
+	while not shared.stop.value and os.getppid() == parent:
+		# Receive states from other workers
+		block = pq.empty() or not shared.should_expand(pq.heap[0][:2])
+		while True:
+			try:
+				vecs, orders, epsilons = inbox.get(timeout=POLL_INTERVAL) if block else inbox.get_nowait()
+			except queue.Empty:
+				break
+			block = False
+			with shared.lock:
+				shared.idle[rank] = 0
+			for vec, order, epsilon in zip(vecs, orders, epsilons):
+				if store.find(vec) is None:
+					idx = store.add(vec, order, epsilon)
+					pq.put((int(order), float(epsilon)), idx)
+			with shared.lock:
+				shared.received.value += 1
+		if pq.empty():
+			shared.best[2 * rank] = np.inf
+			shared.best[2 * rank + 1] = np.inf
+			with shared.lock:
+				shared.idle[rank] = 1
+			if shared.finished():
+				shared.stop.value = 1
+			continue
+		shared.best[2 * rank], shared.best[2 * rank + 1] = pq.heap[0][0], pq.heap[0][1]
+		# Leave the lower priority states until the other workers catch up
+		if not shared.should_expand(pq.heap[0][:2]):
+			continue
+		to_expand = []
+		while not pq.empty() and not shared.stop.value and len(to_expand) < batch_size:
+			curr_idx = pq.get()
+			num_explored += 1
+			vec = store.vecs[curr_idx]
+			if crn.satisfies(vec):
+				sat_idxs.append(curr_idx)
+				store.exit_rate[curr_idx] = 1.0
+				store.perimeter[curr_idx] = False
+				with shared.lock:
+					shared.num_satstates.value += 1
+					if shared.num_satstates.value >= number:
+						shared.stop.value = 1
+				continue
+			to_expand.append(State(vec.copy(), curr_idx))
+		outgoing = [[] for _ in range(num_workers)]
+		for curr_state_data, (successors, total_expanded_rate, total_full_rate) in zip(to_expand, State.successors_batch(to_expand, all_successors=expand_all_states)):
+			idx = curr_state_data.idx
+			store.perimeter[idx] = False
+			if total_full_rate <= 0.0:
+				# A true deadlock, which gets a self-loop when the results are merged
+				store.exit_rate[idx] = 1.0
+				deadlock_idxs.append(idx)
+				continue
+			# The rate of the successors that were not expanded (or all of it, if none were)
+			# goes to the absorbing state
+			if total_full_rate > total_expanded_rate:
+				abs_src.append(idx)
+				abs_rate.append(total_full_rate - total_expanded_rate)
+			store.exit_rate[idx] = total_full_rate
+			if len(successors) == 0:
+				continue
+			vecs = np.array([s.vec for s, _ in successors])
+			for s, rate, owner in zip([s for s, _ in successors], [r for _, r in successors], partition.owners(vecs)):
+				edge_src.append(idx)
+				edge_dst.append(s.vec)
+				edge_rate.append(rate)
+				if owner == rank:
+					if store.find(s.vec) is None:
+						next_idx = store.add(s.vec, s.order, s.epsilon[0])
+						pq.put(s.priority, next_idx)
+					continue
+				key = store.key(s.vec)
+				if key not in sent_keys:
+					sent_keys.add(key)
+					outgoing[owner].append(s)
+		# Send the remote successors in one batch per worker
+		for owner, states in enumerate(outgoing):
+			if len(states) == 0:
+				continue
+			with shared.lock:
+				shared.sent.value += 1
+			inboxes[owner].put((np.array([s.vec for s in states]), np.array([s.order for s in states]), np.array([s.epsilon[0] for s in states])))
+	# Do not wait for batches nobody will receive before exiting
+	for q in inboxes:
+		q.cancel_join_thread()
+	size = len(store)
+	results.put({
+		"rank" : rank,
+		"vecs" : store.vecs[:size],
+		"order" : store.order[:size],
+		"epsilon" : store.epsilon[:size],
+		"perimeter" : store.perimeter[:size],
+		"exit_rate" : store.exit_rate[:size],
+		"sat_idxs" : np.array(sat_idxs, dtype=np.int64),
+		"deadlock_idxs" : np.array(deadlock_idxs, dtype=np.int64),
+		"edge_src" : np.array(edge_src, dtype=np.int64),
+		"edge_dst" : np.array(edge_dst, dtype=store.dtype).reshape(-1, n),
+		"edge_rate" : np.array(edge_rate),
+		"abs_src" : np.array(abs_src, dtype=np.int64),
+		"abs_rate" : np.array(abs_rate),
+		"num_explored" : num_explored
+	})
+
+def min_probability_parallel(crn, dep, number=1, num_workers=2, print_when_done=False, time_bound=None, expand_all_states=False, single_order=False, batch_size=EXPAND_BATCH, packed_keys=False, backend=solver.STORM):
+	'''
+	Parallel version of solver.min_probability_subsp. States are hash partitioned among
+	num_workers worker processes, each of which owns a frontier and a visited-state index for
+	its states. Successors owned by other workers are exchanged in batches over queues, and the
+	best order at the top of every frontier is shared so that no worker runs too far ahead of
+	the global priority order. Each worker pops and expands up to batch_size states at once.
+
+	Since the workers only approximately follow the global priority order, the states explored
+	(and so the bound) may differ from a serial run, and from run to run.
+
+	Once `number` satisfying states are found (or there is nothing left to explore), the local
+	state spaces are merged into solver.state_store and checked with solver.finalize_and_check.
+	Any states still in flight are dropped, so their rate goes to the absorbing state, which
+	keeps the lower bound sound.
+
+	Workers are forked, so they inherit the CRN (whose rates may be lambdas) and the static
+	variables of State.
+	'''
+	State.initialize_static_vars(crn, dep, single_order=single_order)
+	ctx = multiprocessing.get_context("fork")
+	shared = SharedSearch(ctx, num_workers)
+	inboxes = [ctx.Queue() for _ in range(num_workers)]
+	results = ctx.Queue()
+	partition = Partition(len(crn.init_state), num_workers)
+	# Seed the owner of the initial state
+	init_state = State(np.array(crn.init_state))
+	owner = partition.owners(init_state.vec)[0]
+	shared.sent.value += 1
+	inboxes[owner].put((np.array([init_state.vec]), np.array([init_state.order]), np.array([init_state.epsilon[0]])))
+	workers = [ctx.Process(target=worker, args=(rank, num_workers, crn, number, batch_size, expand_all_states, packed_keys, partition, inboxes, results, shared)) for rank in range(num_workers)]
+	for w in workers:
+		w.start()
+	# Results must be read before joining, or the workers may block on the queue
+	worker_results = sorted([results.get() for _ in range(num_workers)], key=lambda r : r["rank"])
+	for w in workers:
+		w.join()
+	for r in worker_results:
+		if "error" in r:
+			raise Exception(f"Worker {r['rank']} failed:\n{r['error']}")
+	return merge_and_check(crn, worker_results, print_when_done, time_bound, packed_keys, backend)
+
+def merge_and_check(crn, worker_results : list, print_when_done : bool, time_bound, packed_keys : bool, backend):
+	'''
+	Merges the local state spaces of the workers into solver.state_store (with the initial
+	state at index 1) and a CsrMatrixBuilder, then checks the CTMC
+	'''
+	store = StateStore(len(crn.init_state), encoder=StateEncoder(crn) if packed_keys else None)
+	solver.state_store = store
+	store.add(np.array(crn.init_state))
+	matrixBuilder = CsrMatrixBuilder()
+	sat_states = []
+	deadlock_idxs = [0]
+	num_explored = 0
+	global_idxs = []
+	for r in worker_results:
+		num_explored += r["num_explored"]
+		idxs = np.zeros(len(r["vecs"]), dtype=np.int64)
+		# Local index 0 is the absorbing state
+		for i in range(1, len(r["vecs"])):
+			idx = store.find(r["vecs"][i])
+			if idx is None:
+				idx = store.add(r["vecs"][i], r["order"][i], r["epsilon"][i])
+			store.perimeter[idx] = r["perimeter"][i]
+			store.exit_rate[idx] = r["exit_rate"][i]
+			idxs[i] = idx
+		global_idxs.append(idxs)
+	for r, idxs in zip(worker_results, global_idxs):
+		for idx in idxs[r["sat_idxs"]]:
+			sat_states.append(int(idx))
+			deadlock_idxs.append(int(idx))
+			matrixBuilder.add_next_value(idx, idx, 1.0)
+		for idx in idxs[r["deadlock_idxs"]]:
+			matrixBuilder.add_next_value(idx, idx, 1.0)
+		matrixBuilder.add_values(idxs[r["abs_src"]], np.zeros(len(r["abs_src"]), dtype=np.int64), r["abs_rate"])
+		# Transitions to states that were still in flight go to the absorbing state
+		dsts = np.array([store.find(vec) for vec in r["edge_dst"]], dtype=object)
+		dsts = np.array([0 if d is None else d for d in dsts], dtype=np.int64)
+		matrixBuilder.add_values(idxs[r["edge_src"]], dsts, r["edge_rate"])
+	if print_when_done:
+		print(f"Explored {len(store)} states (expanded {num_explored}) with {len(worker_results)} workers. Found {len(sat_states)} satisfying states.")
+	if len(sat_states) == 0:
+		print(f"Could not find any satisfying states!")
+		return
+	solver.sanity_check()
+	bounds, _ = solver.finalize_and_check(matrixBuilder, sat_states, deadlock_idxs, time_bound, crn, backend=backend)
+	return bounds
@@ -48,23 +48,20 @@ def create_transition(transition_line, species_idxes):
 			is_consumer = True
 			break
 		transition_vector[species_idxes[product]] += 1
-	# Is 1.0 iff is reactant
-	rate_mul_vector = np.array([float(elem < 0) for elem in transition_vector])
+	# Is 1 iff is reactant. Kept integral so the powers in the rate law are exact
+	rate_mul_vector = np.array([int(elem < 0) for elem in transition_vector])
 	# The rate, from rate constant k and reactants A, B, is k * A^count(A) * B^count(B)
-	rate_finder = lambda state : rate_const * np.prod([state[i] ** rate_mul_vector[i] for i in range(len(rate_mul_vector))])
-	if always_enabled:
-		return Transition(transition_vector
-					, lambda state : True
-					, rate_finder
-					, tname
-					, rate_const)
-	reactant_idxes = [species_idxes[reactant] for reactant in reactants]
+	rate_finder = lambda state : rate_const * np.prod(np.power(state, rate_mul_vector))
+	reactant_idxes = [] if always_enabled else [species_idxes[reactant] for reactant in reactants]
 	# Require all reactants to be strictly greater than zero
+	enabled = lambda state : bool(np.all(np.asarray(state)[reactant_idxes] > 0))
 	return Transition(transition_vector
-				, lambda state : np.all([state[i] > 0 for i in reactant_idxes])
+				, enabled
 				, rate_finder
 				, tname
-				, rate_const)
+				, rate_const
+				, reactant_idxes
+				, rate_mul_vector)
 
 def parse_ragtimer(filename):
 	with open(filename, 'r') as rag:
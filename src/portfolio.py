@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from parser import parse_dependency_ragtimer, create_piped
+from subspace import Subspace
+import solver
+
+# The heuristic variants that can be run in a portfolio, with the arguments of
+# main.subspace_priority_solver that make them up
+VARIANTS = {
+	"single-order" : { "single_order" : True },
+	"subspace" : { },
+	"piped" : { "piped" : True },
+	"agnostic" : { "agnostic" : True },
+	"expand-all" : { "all_expand" : True }
+}
+
+# How often (in seconds) each variant reports its bounds
+REPORT_INTERVAL = 1.0
+
+def exit_with_parent(parent : int):
+	'''
+	Exits the (variant) process if the coordinator is gone (e.g., killed), so it is not orphaned
+	'''
+	while os.getppid() == parent:
+		time.sleep(0.5)
+	os._exit(1)
+
+def run_variant(name : str, filename : str, number : int, results, time_bound=None, agnostic=False, piped=False, all_expand=False, single_order=False, use_rate_const=False, backend=solver.STORM, check_interval=REPORT_INTERVAL, budget=None):
+	'''
+	Runs one variant in a worker process (in anytime mode, until it finds `number` satisfying
+	states), sending each of its bounds to the coordinator as (name, bounds, number of states,
+	seconds since it started). Sends (name, None, ...) when it is done, or (name, traceback) if
+	it fails.
+	'''
+	# The variants would all print at once, so only the coordinator prints
+	sys.stdout = open(os.devnull, "w")
+	threading.Thread(target=exit_with_parent, args=(os.getppid(),), daemon=True).start()
+	start_time = time.time()
+	try:
+		dep, crn = parse_dependency_ragtimer(filename, agnostic=agnostic)
+		if piped:
+			Subspace.initialize_piped(create_piped(crn, use_rate_const))
+		report = lambda bounds, num_states : results.put((name, tuple(float(b) for b in bounds), num_states, time.time() - start_time))
+		solver.min_probability_subsp(crn, dep, number=number, time_bound=time_bound, expand_all_states=all_expand, single_order=single_order, backend=backend, check_interval=check_interval, budget=budget, report=report)
+		results.put((name, None, 0, time.time() - start_time))
+	except Exception:
+		results.put((name, traceback.format_exc()))
+
+def run_portfolio(filename : str, number : int, variants : list = None, time_bound=None, backend=solver.STORM, target=None, time_limit=None, use_rate_const=False, check_interval=REPORT_INTERVAL):
+	'''
+	Runs several heuristic variants (see VARIANTS) at once, each in its own process and in
+	anytime mode (stopping after `number` satisfying states), and keeps the best lower and upper
+	bounds any of them have found. Since every variant's Pmin is a lower bound and its Pmax an
+	upper bound on the same probability, the best bounds are the largest Pmin and the smallest
+	Pmax.
+
+	Stops (and terminates the variants still running) once the best lower bound reaches target,
+	time_limit seconds have passed, or every variant is done. Returns the best (Pmin, Pmax).
+	'''
+	if variants is None:
+		variants = list(VARIANTS.keys())
+	for name in variants:
+		if name not in VARIANTS:
+			raise Exception(f"Unknown variant {name}. Must be one of {', '.join(VARIANTS.keys())}")
+	# Forked so that nothing needs to be pickled
+	ctx = multiprocessing.get_context("fork")
+	results = ctx.Queue()
+	processes = {}
+	for name in variants:
+		processes[name] = ctx.Process(target=run_variant, args=(name, filename, number, results)
+				, kwargs=dict(time_bound=time_bound, use_rate_const=use_rate_const, backend=backend, check_interval=check_interval, budget=time_limit, **VARIANTS[name]))
+		processes[name].start()
+	start_time = time.time()
+	best_lower = (0.0, None)
+	best_upper = (1.0, None)
+	running = set(variants)
+	while len(running) > 0:
+		if time_limit is not None and time.time() - start_time >= time_limit:
+			print(f"Time limit of {time_limit} s is up")
+			break
+		try:
+			result = results.get(timeout=0.1)
+		except queue.Empty:
+			continue
+		name = result[0]
+		if len(result) == 2:
+			print(f"Variant {name} failed:\n{result[1]}")
+			running.discard(name)
+			continue
+		_, bounds, num_states, elapsed = result
+		if bounds is None:
+			print(f"Variant {name} is done ({elapsed:.3f} s)")
+			running.discard(name)
+			continue
+		pmin, pmax = bounds
+		improved = False
+		if pmin > best_lower[0] or best_lower[1] is None:
+			best_lower = (pmin, name)
+			improved = True
+		if pmax < best_upper[0] or best_upper[1] is None:
+			best_upper = (pmax, name)
+			improved = True
+		if improved:
+			print(f"[{name}] Pmin >= {pmin}, Pmax <= {pmax} ({num_states} states, {elapsed:.3f} s). Best: [{best_lower[0]}, {best_upper[0]}]")
+		if target is not None and best_lower[0] >= target:
+			print(f"Reached target lower bound {target}")
+			break
+	# Cancel the laggards
+	for name in running:
+		processes[name].terminate()
+	for process in processes.values():
+		process.join()
+	print(f"Pmin = {best_lower[0]} (from {best_lower[1]})")
+	print(f"Pmax = {best_upper[0]} (from {best_upper[1]})")
+	print(f"Gap = {best_upper[0] - best_lower[0]}")
+	return best_lower[0], best_upper[0]
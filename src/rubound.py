@@ -1,6 +1,11 @@
 '''
 Restrictive upper bound calculator
 
+NOTE: this is unfinished. The search for an (exact) upper bound from the solution of the
+reaction counts (see test_get_ubound) was never written. The general upper bound (Pmax), which
+treats all of the probability mass that leaves the explored states as satisfying, is computed
+alongside the lower bound on the partial CTMC in solver.finalize_and_check.
+
 Requires:
 
  - No "don't-cares". We are looking for a specific state
@@ -8,6 +13,7 @@ Requires:
 '''
 
 import numpy as np
+from numpy.linalg import LinAlgError
 
 from crn import *
 
@@ -28,18 +34,6 @@ def get_rhs(crn):
 	s = np.matrix(s).T
 	return np.append(s, -s0, axis=1)
 
-def search_from_result(crn, sol, x=8):
-	# If all of the transition rates are constant and all transitions are always enabled,
-	# we can calculate the upper bound exactly
-	if crn.all_rates_const and crn.all_trans_always_enabled:
-		print(f"Good news! we can get an exact probability!")
-		# TODO: calculate permutations without repetition and find the path probability of a single
-		# path. Afterward, multiply the two to get the exact upper bound
-	elif crn.all_rates_const:
-		# TODO
-	else:
-		# Can we compute here?
-
 def test_get_ubound(crn):
 	R = get_rmatrix(crn)
 	ss0 = get_rhs(crn)
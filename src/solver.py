@@ -1,249 +1,339 @@
 from distance import *
 from crn import *
 from subspace import *
+from frontier import Frontier, SpillingFrontier
+from store import StateStore, StateEncoder, PropensityCache
+from spill import SPILL_LIMIT
+from checkpoint import save_checkpoint, load_checkpoint, CHECKPOINT_INTERVAL
+from sparse import CsrMatrixBuilder, assert_exit_rates
+import ctmc
 
+import os
 import sys
-import math
+import tempfile
+import time
 
-import queue
 import random
 
-from stormpy import SparseMatrixBuilder, StateLabeling, SparseModelComponents
-import stormpy
+# Backends for checking the partial CTMC. stormpy is only imported when it is used.
+STORM = "storm"
+NATIVE = "native"
+BACKENDS = [STORM, NATIVE]
 
 DESIRED_NUMBER_STATES=2
 ABSORBING_INDEX=0
 
 PRINT_FREQUENCY=100000
 
-all_states = []
-state_ids = {}
+# Slack allowed above 1.0 in the results of the solver
+PROBABILITY_TOLERANCE=1e-9
 
-class Entry:
-	def __init__(self, col : int, val : float):
-		self.col : int = col
-		self.val : float = val
+# In anytime mode, the relative change in the bound below which exploration stops
+ANYTIME_RTOL=1e-3
 
-	def __eq__(self, other):
-		return other.col == self.col
+state_store = None
 
-	def __gt__(self, other):
-		return self.col > other.col
-
-	def __le__(self, other):
-		return not self > other
-
-	def __lt__(self, other):
-		return self.col < other.col
-
-	def __ge__(self, other):
-		return not self < other
-
-	def __str__(self):
-		return f"{self.col}:{self.val}"
-
-class RandomAccessSparseMatrixBuilder:
+def min_probability_subsp(crn, dep, number=1, print_when_done=False, write_when_done=False, time_bound=None, expand_all_states=False, single_order=False, batch_size=None, packed_keys=False, backend=STORM, check_every=None, check_interval=None, rtol=ANYTIME_RTOL, budget=None, report=None, propensity_cache=None, spill_dir=None, spill_limit=SPILL_LIMIT, checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL, resume=False):
 	'''
-	A wrapper class for random entry into storm's sparse matrix builder
-	'''
-	def __init__(self):
-		# Self loop for the absorbing state
-		self.from_list = [[Entry(0, 1.0)]]
-		self.exit_rates = [1.0]
+	Explores the state space in priority order until `number` satisfying states are found, then
+	computes lower and upper bounds on the probability of reaching them, either with stormpy or
+	with the native solver in ctmc.py (see BACKENDS).
 
-	def add_next_value(self, row : int, col : int, val : float):
-		while len(self.from_list) <= row:
-			self.from_list.append([])
-		self.from_list[row].append(Entry(col, val))
+	If batch_size is set, up to batch_size states are popped from the queue at once, and their
+	propensities, successors and subspace distances are all computed as single array operations.
 
-	def to_smb(self):
-		'''
-		Creates a stormpy.SparseMatrixBuilder
-		'''
-		matrix_builder = SparseMatrixBuilder()
-		for row in range(len(self.from_list)):
-			self.from_list[row].sort()
-			if len(self.from_list[row]) == 0:
-				matrix_builder.add_next_value(row, row, 1.0)
-			for entry in self.from_list[row]:
-				col = entry.col
-				val = entry.val
-				if row == col:
-					assert(len(self.from_list[row]) == 1)
-					matrix_builder.add_next_value(row, col, 1.0)
-					break
-				matrix_builder.add_next_value(row, col, val)
-		return matrix_builder
+	If packed_keys is set, the visited-state index is keyed on state vectors packed into
+	integers (see StateEncoder) rather than on their bytes.
 
-	def build(self):
-		'''
-		Creates a stormpy SparseMatrix
-		'''
-		matrix_builder = self.to_smb()
-		return matrix_builder.build()
+	If check_every (a number of expanded states) or check_interval (in seconds) is set, runs in
+	anytime mode: the bound is re-checked periodically as the partial CTMC grows (warm starting
+	from the previous solution with the native backend). Exploration stops once a check changes
+	the bound by less than rtol (relative), or, unless `number` is None, once `number`
+	satisfying states are found.
 
-	def size(self):
-		return len(self.from_list)
+	If budget is set, exploration stops after budget seconds (in either mode), and the partial
+	CTMC explored so far is checked.
 
-	def add_exit_rate(self, idx : int, rate : float):
-		while len(self.exit_rates) <= idx:
-			self.exit_rates.append(None)
-		self.exit_rates[idx] = rate
+	If report is given, it is called with the (Pmin, Pmax) bounds and the number of states
+	after every check (including the final one).
 
-	def assert_all_entries_correct(self):
-		# assert(len(self.exit_rates) == len(self.from_list))
-		for i in range(len(self.from_list)):
-			# print(f"{i}: {self.exit_rates[i]}, {[str(entry) for entry in self.from_list[i]]}")
-			if len(self.from_list[i]) == 0:
-				self.exit_rates[i] = None
-				assert(self.exit_rates[i] is None)
-				continue
-			max_entry = max(self.from_list[i])
-			max_rate = max_entry.val
-			if not self.exit_rates[i] >= max_rate:
-				print(f"Error: {self.exit_rates[i]} < {max_rate} (state index {i})")
-			assert(self.exit_rates[i] >= max_rate or math.isclose(max_rate, self.exit_rates[i]))
+	If propensity_cache (a number of states) is set, the propensities of perimeter states are
+	kept in a PropensityCache of that size, so they are evaluated once rather than at every check
+	and again when the state is expanded.
 
-def min_probability_subsp(crn, dep, number=1, print_when_done=False, write_when_done=False, time_bound=None, expand_all_states=False, single_order=False):
-	global all_states
-	global state_ids
+	If spill_dir is set, runs in external memory mode: the frontier (see SpillingFrontier) and the
+	state store and its index (see StateStore) keep at most spill_limit entries each in memory, and
+	spill the rest to a temporary directory in spill_dir. Packed keys are not used in this mode.
+
+	If checkpoint (a path) is set, the exploration is saved there every checkpoint_interval
+	seconds and when it stops (see checkpoint.py). If resume is set and the checkpoint exists,
+	the exploration continues from it rather than from the initial state. The checkpoint must be
+	of the same model, explored with the same options.
+	'''
+	global state_store
+	start_time = time.time()
+	anytime = check_every is not None or check_interval is not None
+	if number is None:
+		number = np.inf
 	State.initialize_static_vars(crn, dep, single_order=single_order)
-	state_ids = {}
-	all_states = []
-	# Add the absorbing state
-	matrixBuilder = RandomAccessSparseMatrixBuilder()
-	last_index = ABSORBING_INDEX + 1
-	all_states.append(None)
+	# The absorbing state is index 0 in the store
+	cache = None if propensity_cache is None else PropensityCache(crn, propensity_cache)
+	# The store keeps the subspace residuals of the states, so popped states are not projected again
+	residual_shape = State.transition_residuals.shape[1:] if len(State.subspaces) > 0 else None
+	if spill_dir is None:
+		state_store = StateStore(len(crn.init_state), encoder=StateEncoder(crn) if packed_keys else None, propensity_cache=cache, residual_shape=residual_shape)
+		# Min queue of state indexes
+		pq = Frontier()
+	else:
+		# Removed (along with everything spilled) when the search is done
+		spill = tempfile.TemporaryDirectory(dir=spill_dir, prefix="wayfarer-")
+		print(f"Spilling states beyond {spill_limit} in memory to {spill.name}")
+		state_store = StateStore(len(crn.init_state), propensity_cache=cache, spill_dir=os.path.join(spill.name, "store"), spill_limit=spill_limit, residual_shape=residual_shape)
+		pq = SpillingFrontier(os.path.join(spill.name, "frontier"), limit=spill_limit)
+	matrixBuilder = CsrMatrixBuilder()
 	# Other stuff
-	boundary = crn.boundary
 	sat_states = []
-	# Min queue
-	pq = queue.PriorityQueue()
 	curr_state = None
-	# Create and enqueue
-	init_state = crn.init_state
-	init_state = State(init_state, last_index)
-	all_states.append(init_state)
-	pq.put((init_state))
-	last_index += 1
 	deadlock_idxs = [0]
 	# The number of explored and satisfying states
 	num_satstates = 0
 	num_explored = 0
-	while (not pq.empty()) and num_satstates < number:
-		num_explored += 1
-		if num_explored % PRINT_FREQUENCY == 0:
-			print(f"Explored {num_explored} states. Have {num_satstates} satisfying")
-		curr_state_data = pq.get()
-		# print(f"Exploring state with index {curr_state_data.idx}")
-		curr_state = curr_state_data.vec
-		if satisfies(curr_state, boundary):
-			# print(f"Found satisfying state {tuple(curr_state)}")
-			num_satstates += 1
-			sat_states.append(curr_state_data.idx)
-			# We will create a self-loop later, so declare the total exit rate as 1.0
-			matrixBuilder.add_exit_rate(curr_state_data.idx, 1.0)
-			matrixBuilder.add_next_value(curr_state_data.idx, curr_state_data.idx, 1.0)
-			deadlock_idxs.append(curr_state_data.idx)
-			curr_state_data.perimeter = False
-			continue
-
-		# Total expanded rate: the rate of transitions we EXPANDED in the graph
-		# Total full rate: the total rate of all POSSIBLE enabled transitions from this state.
-		successors, total_expanded_rate = curr_state_data.successors(all_successors=expand_all_states)
-		total_full_rate = curr_state_data.get_total_outgoing_rate()
-		assert(total_full_rate >= total_expanded_rate)
-		if len(successors) == 0:
-			print("No successors")
-			# Introduce a self-loop
-			matrixBuilder.add_next_value(curr_state_data.idx, curr_state_data.idx, 1.0)
-			continue
-		# If this is true there are some transitions we didn't expand that we must lead
-		# to the absorbing state. We do this since we only take reactions in that subspace
-		if total_full_rate > total_expanded_rate:
-			matrixBuilder.add_next_value(curr_state_data.idx, 0, total_full_rate - total_expanded_rate)
-		matrixBuilder.add_exit_rate(curr_state_data.idx, total_full_rate)
-		for s, rate in successors:
-			next_state = s.vec
-			# If the state is new, we explore it
-			next_state_tuple = tuple(next_state)
-			if next_state_tuple not in state_ids:
-				next_index = len(all_states)
-				all_states.append(s)
-				assert(last_index == next_index)
-				# Assign new index
-				state_ids[next_state_tuple] = last_index
-				s.idx = last_index
-				last_index += 1
-				next_state_tuple = tuple(next_state)
-				# Only explore new states
-				pq.put(s)
-			# If this state already exists, use the state data we already have
-			else:
-				s = all_states[state_ids[next_state_tuple]]
-			assert(s.idx is not None)
-			# Place the transition in the matrix
-			matrixBuilder.add_next_value(curr_state_data.idx, s.idx, rate)
+	# Seconds spent exploring before this run (if resumed)
+	elapsed = 0.0
+	# The options that change which states are explored, which a resumed run must share
+	checkpoint_options = { "single_order" : single_order, "expand_all_states" : expand_all_states, "agnostic" : dep.agnostic, "piped" : Subspace.piped_inv is not None }
+	if resume and checkpoint is not None and os.path.exists(checkpoint):
+		sat_states, deadlock_idxs, num_explored, elapsed = load_checkpoint(checkpoint, crn, state_store, pq, matrixBuilder, checkpoint_options)
+		num_satstates = len(sat_states)
+		print(f"Resumed from {checkpoint}: {len(state_store)} states (expanded {num_explored}), {num_satstates} satisfying, {elapsed:.3f} s")
+	else:
+		# Create and enqueue
+		init_state = State(crn.init_state)
+		init_state.idx = state_store.add(init_state.vec, init_state.order, init_state.epsilon[0], init_state.residual)
+		pq.put(init_state.priority, init_state.idx)
+	last_checkpoint_time = start_time
+	# State of the anytime checks
+	last_check_explored = 0
+	last_check_time = start_time
+	bounds = None
+	x = None
+	converged = False
+	while (not pq.empty()) and num_satstates < number and not converged:
+		# Pop the next state (or the next batch_size states)
+		to_expand = []
+		while (not pq.empty()) and num_satstates < number and len(to_expand) < (1 if batch_size is None else batch_size):
+			num_explored += 1
+			if num_explored % PRINT_FREQUENCY == 0:
+				print(f"Explored {num_explored} states. Have {num_satstates} satisfying")
+			curr_idx = pq.get()
+			# print(f"Exploring state with index {curr_idx}")
+			curr_state = state_store.vecs[curr_idx]
+			if crn.satisfies(curr_state):
+				# print(f"Found satisfying state {tuple(curr_state)}")
+				num_satstates += 1
+				sat_states.append(curr_idx)
+				# We will create a self-loop later, so declare the total exit rate as 1.0
+				state_store.exit_rate[curr_idx] = 1.0
+				matrixBuilder.add_next_value(curr_idx, curr_idx, 1.0)
+				deadlock_idxs.append(curr_idx)
+				state_store.perimeter[curr_idx] = False
+				continue
+			# The successors' residuals are computed incrementally from the stored residual
+			residual = None if state_store.residuals is None else state_store.residuals[curr_idx].copy()
+			to_expand.append(State(curr_state.copy(), curr_idx, residual=residual))
+		cache = state_store.propensity_cache
+		if batch_size is None:
+			expanded = []
+			for curr_state_data in to_expand:
+				# Expanded states are never evaluated again, so they leave the cache
+				propensities = None if cache is None else cache.pop(curr_state_data.idx)
+				# Total expanded rate: the rate of transitions we EXPANDED in the graph
+				# Total full rate: the total rate of all POSSIBLE enabled transitions from this state.
+				expanded.append(curr_state_data.expand(all_successors=expand_all_states, propensities=propensities))
+		else:
+			propensities = None
+			if cache is not None and len(to_expand) > 0:
+				propensities = cache.pop_batch([s.idx for s in to_expand], np.array([s.vec for s in to_expand]))
+			expanded = State.successors_batch(to_expand, all_successors=expand_all_states, propensities=propensities)
+		for curr_state_data, (successors, total_expanded_rate, total_full_rate) in zip(to_expand, expanded):
+			state_store.perimeter[curr_state_data.idx] = False
+			add_successors(matrixBuilder, pq, curr_state_data, successors, total_expanded_rate, total_full_rate)
+		now = time.time()
+		out_of_time = budget is not None and now - start_time >= budget
+		if anytime:
+			due = (check_every is not None and num_explored - last_check_explored >= check_every) \
+					or (check_interval is not None and now - last_check_time >= check_interval)
+			if (due or out_of_time) and num_satstates > 0:
+				last_check_explored = num_explored
+				new_bounds, x = finalize_and_check(matrixBuilder, sat_states, deadlock_idxs, time_bound, crn, backend=backend, x0=x, verbose=False)
+				last_check_time = time.time()
+				print(f"Pmin >= {new_bounds[0]}, Pmax <= {new_bounds[1]} ({len(state_store)} states, expanded {num_explored}, {last_check_time - start_time:.3f} s)")
+				converged = bounds is not None and abs(new_bounds[0] - bounds[0]) <= rtol * new_bounds[0]
+				bounds = new_bounds
+				if report is not None:
+					report(bounds, len(state_store))
+		if checkpoint is not None and now - last_checkpoint_time >= checkpoint_interval:
+			save_checkpoint(checkpoint, crn, state_store, pq, matrixBuilder, sat_states, deadlock_idxs, num_explored, elapsed + now - start_time, checkpoint_options)
+			last_checkpoint_time = time.time()
+		if out_of_time:
+			print(f"Time budget of {budget} s is up")
+			break
+	if checkpoint is not None:
+		save_checkpoint(checkpoint, crn, state_store, pq, matrixBuilder, sat_states, deadlock_idxs, num_explored, elapsed + time.time() - start_time, checkpoint_options)
+		print(f"Saved checkpoint to {checkpoint}")
 	if print_when_done:
-		print(f"Explored {len(matrixBuilder.from_list)} states (expanded {num_explored}). Found {num_satstates} satisfying states.")
+		print(f"Explored {len(state_store)} states (expanded {num_explored}). Found {num_satstates} satisfying states.")
+		if state_store.propensity_cache is not None:
+			cache = state_store.propensity_cache
+			print(f"Propensity cache: {cache.hits} hits, {cache.misses} misses ({len(cache)} cached)")
 	if num_satstates == 0:
 		print(f"Could not find any satisfying states!")
 		return
 	sanity_check()
-	finalize_and_check(matrixBuilder, sat_states, deadlock_idxs, time_bound, crn) #, sat_states)
+	if anytime and last_check_explored == num_explored:
+		# The last check was on the final model
+		print_bounds(bounds)
+		return bounds
+	bounds, _ = finalize_and_check(matrixBuilder, sat_states, deadlock_idxs, time_bound, crn, backend=backend, x0=x)
+	if report is not None:
+		report(bounds, len(state_store))
+	return bounds
+
+def add_successors(matrixBuilder : CsrMatrixBuilder, pq : Frontier, curr_state_data : State, successors : list, total_expanded_rate : float, total_full_rate : float):
+	'''
+	Places the transitions from an expanded state in the matrix, and enqueues any successors
+	we have not seen before.
+	'''
+	global state_store
+	# The expanded rate is summed separately, so allow for rounding
+	assert(total_full_rate >= total_expanded_rate * (1.0 - PROBABILITY_TOLERANCE))
+	if total_full_rate <= 0.0:
+		# A true deadlock (nothing is enabled), so introduce a self-loop
+		state_store.exit_rate[curr_state_data.idx] = 1.0
+		matrixBuilder.add_next_value(curr_state_data.idx, curr_state_data.idx, 1.0)
+		return
+	# If this is true there are some transitions we didn't expand that we must lead
+	# to the absorbing state. We do this since we only take reactions in that subspace
+	# (or we ignored some successors). If every successor was left out, all of the rate
+	# goes to the absorbing state.
+	if total_full_rate > total_expanded_rate:
+		matrixBuilder.add_next_value(curr_state_data.idx, 0, total_full_rate - total_expanded_rate)
+	state_store.exit_rate[curr_state_data.idx] = total_full_rate
+	for s, rate in successors:
+		# If the state is new, we explore it
+		next_idx = state_store.find(s.vec)
+		if next_idx is None:
+			# Assign new index
+			next_idx = state_store.add(s.vec, s.order, s.epsilon[0], s.residual)
+			# Only explore new states
+			pq.put(s.priority, next_idx)
+		# Place the transition in the matrix
+		matrixBuilder.add_next_value(curr_state_data.idx, next_idx, rate)
 
 
 # This can become a lemma when we eventually use Nagini to verify this
 def sanity_check():
 	print("Performing sanity check...", end="")
-	global all_states
+	global state_store
 	# Check our indecies
-	idx = 0
-	for state in all_states:
-		assert(state is None or state.idx == idx)
-		idx += 1
+	assert(len(state_store.index) == len(state_store) - 1)
+	for idx in range(1, len(state_store)):
+		assert(state_store.find(state_store.vecs[idx]) == idx)
 	print("done.")
 
-def finalize_and_check(matrixBuilder : RandomAccessSparseMatrixBuilder, satisfying_state_idxs : list, deadlock_idxs : list, time_bound : int, crn : Crn = None): #, sat_states : list = None):
-	global state_ids
+def finalize_and_check(matrixBuilder : CsrMatrixBuilder, satisfying_state_idxs : list, deadlock_idxs : list, time_bound : int, crn : Crn = None, backend=STORM, x0=None, verbose=True): #, sat_states : list = None):
+	'''
+	Closes the perimeter of the partial CTMC and checks it. Neither the builder, the store nor
+	the lists passed in are modified, so exploration can continue afterwards (as in anytime mode).
+
+	All of the probability mass that leaves the explored states goes to the absorbing state, so
+	the probability of reaching a satisfying state is a lower bound (Pmin), and the probability
+	of reaching either a satisfying or the absorbing state is an upper bound (Pmax). Returns
+	(Pmin, Pmax) from the initial state, and (for the native backend) the solution vectors, which
+	can warm start the next check.
+	'''
+	global state_store
+	matrixBuilder = matrixBuilder.copy()
+	satisfying_state_idxs = list(satisfying_state_idxs)
+	deadlock_idxs = list(deadlock_idxs)
+	size = len(state_store)
+	exit_rates = state_store.exit_rate[:size].copy()
 	# First, connect all terminal states to absorbing
-	global all_states
 	# NOTE: in the paper, we flush the queue, however here, we go through all states and connect all PERIMETER
 	# states to the absorbing, which is the same thing.
-	num_perim_satstates = 0
-	for state in all_states[1::]:
-		if state.perimeter:
-			if satisfies(state.vec, crn.boundary):
-				# print(f"Found satisfying state {tuple(curr_state)}")
-				num_perim_satstates += 1
-				# sat_states.append(state.idx)
-				satisfying_state_idxs.append(state.idx)
-				# We will create a self-loop later, so declare the total exit rate as 1.0
-				matrixBuilder.add_exit_rate(state.idx, 1.0)
-				matrixBuilder.add_next_value(state.idx, state.idx, 1.0)
-				deadlock_idxs.append(state.idx)
-				state.perimeter = False
-				continue
-			# Expand the state and create transitions ONLY TO EXISTING STATES
-			successors, total_exit_rate = state.successors(True)
-			total_full_rate = state.get_total_outgoing_rate()
-			# states not expanded will go to the absorbing state
-			rate_to_abs = total_full_rate - total_exit_rate
-			for s, rate in successors:
-				stup = s #tuple(s.vec)
-				if stup in state_ids:
-					next_idx = state_ids[stup]
-					matrixBuilder.add_next_value(state.idx, next_idx, rate)
-				else:
-					rate_to_abs += rate
-			if rate_to_abs > 0.0:
-				matrixBuilder.add_next_value(state.idx, 0, rate_to_abs)
-			matrixBuilder.add_exit_rate(state.idx, total_full_rate)
-	if num_perim_satstates > 0:
+	# All of the perimeter states are handled at once, as arrays
+	perimeter = state_store.perimeter_idxs()
+	vecs = state_store.vecs[perimeter]
+	sat = crn.satisfies(vecs)
+	num_perim_satstates = int(np.sum(sat))
+	# We will create a self-loop later, so declare the total exit rate as 1.0
+	sat_idxs = perimeter[sat]
+	satisfying_state_idxs.extend(sat_idxs.tolist())
+	deadlock_idxs.extend(sat_idxs.tolist())
+	exit_rates[sat_idxs] = 1.0
+	matrixBuilder.add_values(sat_idxs, sat_idxs, np.ones(len(sat_idxs)))
+	# Expand the other states and create transitions ONLY TO EXISTING STATES
+	perimeter, vecs = perimeter[~sat], vecs[~sat]
+	if state_store.propensity_cache is None:
+		enabled, rates = crn.propensities(vecs)
+	else:
+		enabled, rates = state_store.propensity_cache.get_batch(perimeter, vecs)
+	shape = (len(perimeter), len(crn.transitions))
+	enabled = enabled.reshape(shape) & State.update_mask(state_store.order[perimeter])
+	rates = rates.reshape(shape)
+	rows, transitions = np.nonzero(enabled)
+	succ_rates = rates[rows, transitions]
+	next_idxs = state_store.find_batch(vecs[rows] + crn.stoichiometry[transitions])
+	found = next_idxs >= 0
+	matrixBuilder.add_values(perimeter[rows[found]], next_idxs[found], succ_rates[found])
+	# states not expanded (and successors that were never explored) will go to the absorbing state
+	total_full_rate = np.sum(rates, axis=1)
+	total_exit_rate = np.bincount(rows, weights=succ_rates, minlength=len(perimeter))
+	rate_to_abs = total_full_rate - total_exit_rate + np.bincount(rows[~found], weights=succ_rates[~found], minlength=len(perimeter))
+	to_abs = np.flatnonzero(rate_to_abs > 0.0)
+	matrixBuilder.add_values(perimeter[to_abs], np.zeros(len(to_abs), dtype=np.int64), rate_to_abs[to_abs])
+	exit_rates[perimeter] = total_full_rate
+	if num_perim_satstates > 0 and verbose:
 		print(f"We found an additional {num_perim_satstates} satisfying states in the perimeter state indecies!")
-	matrix = matrixBuilder.build()
-	matrixBuilder.assert_all_entries_correct()
-	labeling = StateLabeling(matrixBuilder.size())
+	row_ptr, cols, vals = matrixBuilder.to_csr(size)
+	# States that were never expanded (i.e., have a self loop) get an exit rate of 1.0
+	exit_rates = np.where(np.isnan(exit_rates), 1.0, exit_rates)
+	assert_exit_rates(row_ptr, vals, exit_rates)
+	if backend == NATIVE:
+		return check_native(row_ptr, cols, vals, satisfying_state_idxs, time_bound, x0=x0, verbose=verbose)
+	return check_storm(row_ptr, cols, vals, exit_rates, satisfying_state_idxs, deadlock_idxs, time_bound, verbose=verbose), None
+
+def check_native(row_ptr, cols, vals, satisfying_state_idxs : list, time_bound : int, x0=None, verbose=True):
+	'''
+	Computes the probability of reaching a satisfying state from the CSR arrays with ctmc.py.
+	x0 may be the solution of a smaller model (whose states are a prefix of this one's).
+	'''
+	size = len(row_ptr) - 1
+	if verbose:
+		print(f"Matrix built (size {size})")
+		prop_bound = "" if time_bound is None else f" within {time_bound}"
+		print(f"Checking model natively for reachability{prop_bound}")
+	if x0 is not None:
+		# New states start from 0
+		x0 = np.concatenate([x0, np.zeros((size - len(x0), x0.shape[1]))])
+	# Both bounds come from the same solve, with one column each
+	x = ctmc.reachability(row_ptr, cols, vals, satisfying_state_idxs, time_bound=time_bound, x0=x0, absorbing=ABSORBING_INDEX)
+	assert(np.min(x) >= 0.0 and np.max(x) <= 1.0 + PROBABILITY_TOLERANCE)
+	bounds = (x[1, 0], x[1, 1])
+	if verbose:
+		print_bounds(bounds)
+	return bounds, x
+
+def check_storm(row_ptr, cols, vals, exit_rates, satisfying_state_idxs : list, deadlock_idxs : list, time_bound : int, verbose=True):
+	'''
+	Builds the CTMC in stormpy and checks `P=? [ true U "satisfy" ]` (the lower bound) and
+	`P=? [ true U ("satisfy" | "absorbing") ]` (the upper bound) on it
+	'''
+	import stormpy
+	from stormpy import StateLabeling, SparseModelComponents
+	size = len(row_ptr) - 1
+	matrix = build_storm_matrix(row_ptr, cols, vals)
+	labeling = StateLabeling(size)
 	# Add initial state labeling
 	labeling.add_label("init")
 	labeling.add_label_to_state("init", 1)
@@ -258,17 +348,43 @@ def finalize_and_check(matrixBuilder : RandomAccessSparseMatrixBuilder, satisfyi
 		labeling.add_label_to_state("deadlock", idx)
 	components = SparseModelComponents(matrix, labeling, {}, rate_transitions=True)
 	prop_bound = "" if time_bound is None else f"[0, {time_bound}]"
-	chk_property = f"P=? [ true U{prop_bound} \"satisfy\" ]"
-	exit_rates = [rate if rate is not None else 1.0 for rate in matrixBuilder.exit_rates]
-	components.exit_rates = exit_rates
-	# print(f"Exit rates size = {len(exit_rates)}. Model size = {matrixBuilder.size()}")
+	chk_properties = [f"P=? [ true U{prop_bound} \"satisfy\" ]", f"P=? [ true U{prop_bound} (\"satisfy\" | \"absorbing\") ]"]
+	components.exit_rates = exit_rates.tolist()
+	# print(f"Exit rates size = {len(exit_rates)}. Model size = {size}")
 	model = stormpy.storage.SparseCtmc(components)
-	print(model)
-	print(f"Matrix built (size {matrixBuilder.size()})")
-	print(f"Checking model with formula `{chk_property}`")
-	prop = stormpy.parse_properties(chk_property)[0] # stormpy.Property("Lower Bound", )
+	if verbose:
+		print(model)
+		print(f"Matrix built (size {size})")
 	env = stormpy.Environment()
 	env.solver_environment.native_solver_environment.precision = stormpy.Rational(1e-100)
-	result = stormpy.check_model_sparse(model, prop, only_initial_states=True)
-	assert(result.min >= 0.0 and result.max <= 1.0)
-	print(f"Pmin = {result.at(1)}")
+	bounds = []
+	for chk_property in chk_properties:
+		if verbose:
+			print(f"Checking model with formula `{chk_property}`")
+		prop = stormpy.parse_properties(chk_property)[0] # stormpy.Property("Lower Bound", )
+		result = stormpy.check_model_sparse(model, prop, only_initial_states=True)
+		# Probabilities near 1 may be slightly over due to rounding
+		assert(result.min >= 0.0 and result.max <= 1.0 + PROBABILITY_TOLERANCE)
+		bounds.append(min(result.at(1), 1.0))
+	bounds = tuple(bounds)
+	if verbose:
+		print_bounds(bounds)
+	return bounds
+
+def print_bounds(bounds : tuple):
+	pmin, pmax = bounds
+	print(f"Pmin = {pmin}")
+	print(f"Pmax = {pmax}")
+	print(f"Gap = {pmax - pmin}")
+
+def build_storm_matrix(row_ptr, cols, vals):
+	'''
+	Creates a stormpy SparseMatrix from CSR arrays in one pass over the (already sorted) entries
+	'''
+	from stormpy import SparseMatrixBuilder
+	size = len(row_ptr) - 1
+	matrix_builder = SparseMatrixBuilder(size, size, len(vals), True)
+	rows = np.repeat(np.arange(size), np.diff(row_ptr)).tolist()
+	for row, col, val in zip(rows, cols.tolist(), vals.tolist()):
+		matrix_builder.add_next_value(row, col, val)
+	return matrix_builder.build()
@@ -0,0 +1,99 @@
+import numpy as np
+
+class CsrMatrixBuilder:
+	'''
+	Builds the rate matrix of the partial CTMC. Entries may be added in any order: they are
+	appended as (row, col, rate) triples to growable typed arrays, and only sorted (with a single
+	lexsort) when the compressed sparse row (CSR) arrays are requested.
+	'''
+	def __init__(self, capacity : int = 1024):
+		self.rows = np.zeros(capacity, dtype=np.int64)
+		self.cols = np.zeros(capacity, dtype=np.int64)
+		self.vals = np.zeros(capacity)
+		self.count = 0
+		# Self loop for the absorbing state
+		self.add_next_value(0, 0, 1.0)
+
+	def add_next_value(self, row : int, col : int, val : float):
+		if self.count == len(self.rows):
+			self.grow(self.count + 1)
+		self.rows[self.count] = row
+		self.cols[self.count] = col
+		self.vals[self.count] = val
+		self.count += 1
+
+	def add_values(self, rows, cols, vals):
+		'''
+		Appends many entries at once
+		'''
+		n = len(rows)
+		if self.count + n > len(self.rows):
+			self.grow(self.count + n)
+		self.rows[self.count:self.count + n] = rows
+		self.cols[self.count:self.count + n] = cols
+		self.vals[self.count:self.count + n] = vals
+		self.count += n
+
+	def copy(self):
+		'''
+		A copy of the builder, to which entries can be added without changing this one
+		'''
+		builder = CsrMatrixBuilder.__new__(CsrMatrixBuilder)
+		builder.rows = self.rows.copy()
+		builder.cols = self.cols.copy()
+		builder.vals = self.vals.copy()
+		builder.count = self.count
+		return builder
+
+	def grow(self, needed : int):
+		capacity = max(needed, 2 * len(self.rows))
+		self.rows = np.resize(self.rows, capacity)
+		self.cols = np.resize(self.cols, capacity)
+		self.vals = np.resize(self.vals, capacity)
+
+	def triples(self):
+		'''
+		The (rows, cols, vals) arrays of the entries added so far, in the order they were added
+		'''
+		return self.rows[:self.count], self.cols[:self.count], self.vals[:self.count]
+
+	def to_csr(self, size : int):
+		'''
+		Creates the CSR arrays (row_ptr, cols, vals) of a size x size matrix. Does not modify
+		the builder, so it may be called again after more entries are added.
+
+		Duplicate entries are summed. Rows with no entries get a self-loop, and a row with
+		a self-loop (i.e., a satisfying or deadlock state) must contain only that self-loop,
+		which is given a rate of 1.0.
+		'''
+		rows, cols, vals = self.triples()
+		order = np.lexsort((cols, rows))
+		rows, cols, vals = rows[order], cols[order], vals[order]
+		# Sum duplicate entries
+		if len(rows) > 0:
+			starts = np.flatnonzero(np.concatenate([[True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])]))
+			rows, cols, vals = rows[starts], cols[starts], np.add.reduceat(vals, starts)
+		counts = np.bincount(rows, minlength=size)
+		loops = rows == cols
+		assert(np.all(counts[rows[loops]] == 1))
+		vals[loops] = 1.0
+		empty = np.flatnonzero(counts == 0)
+		if len(empty) > 0:
+			rows = np.concatenate([rows, empty])
+			cols = np.concatenate([cols, empty])
+			vals = np.concatenate([vals, np.ones(len(empty))])
+			order = np.lexsort((cols, rows))
+			rows, cols, vals = rows[order], cols[order], vals[order]
+			counts[empty] = 1
+		row_ptr = np.concatenate([[0], np.cumsum(counts)])
+		return row_ptr, cols, vals
+
+def assert_exit_rates(row_ptr, vals, exit_rates):
+	'''
+	Checks that the exit rate of every row is at least as large as its largest entry
+	'''
+	max_rates = np.maximum.reduceat(vals, row_ptr[:-1])
+	bad = np.flatnonzero(~((exit_rates >= max_rates) | np.isclose(max_rates, exit_rates)))
+	for i in bad:
+		print(f"Error: {exit_rates[i]} < {max_rates[i]} (state index {i})")
+	assert(len(bad) == 0)
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+
+# External memory structures for explorations that do not fit in RAM. Everything is written
+# to files in a directory given by the caller, and read back through memory maps.
+
+# The default number of entries kept in memory (per structure) before spilling to disk
+SPILL_LIMIT = 1 << 20
+# Bloom filter sizing: about a 1% false positive rate
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+MASK64 = (1 << 64) - 1
+
+def mix64(h : int) -> int:
+	'''
+	The splitmix64 finalizer, used to derive a second hash for double hashing
+	'''
+	h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+	h = (h ^ (h >> 27)) * 0x94d049bb133111eb & MASK64
+	return h ^ (h >> 31)
+
+class BloomFilter:
+	'''
+	A Bloom filter over byte keys, with k positions per key derived from two hashes by double
+	hashing. Hashes are only stable within a process, so filters are never written to disk.
+	'''
+	def __init__(self, num_keys : int, bits_per_key : int = BLOOM_BITS_PER_KEY, num_hashes : int = BLOOM_HASHES):
+		self.num_bits = max(64, num_keys * bits_per_key)
+		self.num_hashes = num_hashes
+		self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+
+	def positions(self, keys) -> np.ndarray:
+		'''
+		A (len(keys) x num_hashes) array of the bit positions of each key
+		'''
+		h1 = np.array([hash(key) & MASK64 for key in keys], dtype=np.uint64).reshape(-1, 1)
+		h2 = np.array([mix64(int(h)) | 1 for h in h1.ravel()], dtype=np.uint64).reshape(-1, 1)
+		return (h1 + np.arange(self.num_hashes, dtype=np.uint64) * h2) % np.uint64(self.num_bits)
+
+	def add_batch(self, keys):
+		positions = self.positions(keys).ravel()
+		np.bitwise_or.at(self.bits, positions >> np.uint64(3), np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8)))
+
+	def __contains__(self, key) -> bool:
+		h1 = hash(key) & MASK64
+		h2 = mix64(h1) | 1
+		for i in range(self.num_hashes):
+			# Wraps around like the uint64 arithmetic of positions()
+			position = ((h1 + i * h2) & MASK64) % self.num_bits
+			if not (self.bits[position >> 3] >> (position & 7)) & 1:
+				return False
+		return True
+
+class SpillingIndex:
+	'''
+	A map from fixed-width byte keys to integers (e.g., the visited-state index of a
+	StateStore) that keeps at most limit entries in a dict. When the dict is full, its entries are
+	written to disk as a sorted run (a key array and a value array, both memory mapped), with a
+	Bloom filter in front of it, so a lookup only searches the runs that may hold its key.
+	Entries can not be removed or changed once added.
+	'''
+	def __init__(self, directory : str, width : int, limit : int = SPILL_LIMIT):
+		self.directory = directory
+		os.makedirs(directory, exist_ok=True)
+		self.dtype = np.dtype(f"S{width}")
+		self.limit = limit
+		self.memory = {}
+		# (keys, values, bloom filter) of each run, oldest first
+		self.runs = []
+		self.num_on_disk = 0
+
+	def get(self, key, default=None):
+		value = self.memory.get(key)
+		if value is not None:
+			return value
+		for keys, values, bloom in reversed(self.runs):
+			if key not in bloom:
+				continue
+			query = np.array(key, dtype=self.dtype)
+			i = np.searchsorted(keys, query)
+			if i < len(keys) and keys[i] == query:
+				return int(values[i])
+		return default
+
+	def __contains__(self, key) -> bool:
+		return self.get(key) is not None
+
+	def __setitem__(self, key, value : int):
+		self.memory[key] = value
+		if len(self.memory) >= self.limit:
+			self.spill()
+
+	def __len__(self):
+		return len(self.memory) + self.num_on_disk
+
+	def spill(self):
+		'''
+		Writes the in-memory entries to disk as a new sorted run
+		'''
+		if len(self.memory) == 0:
+			return
+		keys = np.array(list(self.memory.keys()), dtype=self.dtype)
+		values = np.fromiter(self.memory.values(), dtype=np.int64, count=len(keys))
+		order = np.argsort(keys, kind="stable")
+		path = os.path.join(self.directory, f"run{len(self.runs)}")
+		np.save(f"{path}.keys.npy", keys[order])
+		np.save(f"{path}.values.npy", values[order])
+		bloom = BloomFilter(len(keys))
+		bloom.add_batch(self.memory.keys())
+		self.runs.append((np.load(f"{path}.keys.npy", mmap_mode="r"), np.load(f"{path}.values.npy", mmap_mode="r"), bloom))
+		self.num_on_disk += len(keys)
+		self.memory = {}
+
+def mapped_array(path : str, shape, dtype) -> np.memmap:
+	'''
+	Creates a zero-filled array of the given shape (a tuple or a length) backed by the file at path
+	'''
+	return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape if isinstance(shape, tuple) else (shape,))
+
+def resize_mapped(array : np.memmap, path : str, shape) -> np.memmap:
+	'''
+	Returns a copy of array with a larger first dimension, backed by the file at path (which must
+	not be the file backing array, which is removed)
+	'''
+	resized = mapped_array(path, shape, array.dtype)
+	resized[:len(array)] = array
+	os.remove(array.filename)
+	return resized
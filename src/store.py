@@ -0,0 +1,326 @@
+from collections import OrderedDict
+import os
+
+import numpy as np
+
+from crn import Crn
+from spill import SpillingIndex, SPILL_LIMIT, mapped_array, resize_mapped
+
+# The number of extra bits given to each species that can change, on top of what is
+# needed for the initial state, boundary and largest update
+HEADROOM_BITS = 8
+
+# The default number of propensity vectors kept by a PropensityCache
+PROPENSITY_CACHE_SIZE = 65536
+
+class StateEncoder:
+	'''
+	Packs a state vector into a single integer key, with a fixed number of bits per species.
+	The bit widths are derived from the initial state, the boundary and the reaction vectors.
+	Species are packed into as few 64-bit words as possible, so on most models the key is one
+	machine word. If a state has a species count outside of its width, its key falls back to the
+	fixed-size bytes of the vector. Since ints and bytes never compare equal, both kinds of keys
+	can share one index.
+	'''
+	def __init__(self, crn : Crn, headroom_bits : int = HEADROOM_BITS, dtype=np.int32):
+		self.dtype = np.dtype(dtype)
+		init_state = np.asarray(crn.init_state)
+		max_steps = np.max(np.abs(crn.stoichiometry), axis=0) if len(crn.transitions) > 0 else np.zeros(len(init_state), dtype=int)
+		bounds = [max(b.to_num(), 0) for b in crn.boundary]
+		# At most 62 bits per species, so that the limit of each (1 << width) fits in an int64
+		widths = [min(62, max(int(init_state[i]).bit_length(), int(bounds[i]).bit_length(), int(max_steps[i]).bit_length())
+				+ (headroom_bits if max_steps[i] > 0 else 0)) for i in range(len(init_state))]
+		# Greedily assign species (in order) to words
+		words = []
+		shifts = []
+		word = 0
+		used = 0
+		for w in widths:
+			if used + w > 64:
+				word += 1
+				used = 0
+			words.append(word)
+			shifts.append(used)
+			used += w
+		self.num_words = word + 1
+		self.words = np.array(words, dtype=np.int64)
+		self.word_starts = np.searchsorted(self.words, np.arange(self.num_words))
+		self.shifts = np.array(shifts, dtype=np.uint64)
+		self.limits = np.left_shift(np.int64(1), np.array(widths, dtype=np.int64))
+		self.masks = (self.limits - 1).astype(np.uint64)
+
+	def encode(self, vec):
+		'''
+		Returns the key of a state vector
+		'''
+		vec = np.asarray(vec)
+		if not np.all((vec >= 0) & (vec < self.limits)):
+			return vec.astype(self.dtype).tobytes()
+		# The bits of different species never overlap, so adding them is the same as or-ing them
+		packed = np.add.reduceat(vec.astype(np.uint64) << self.shifts, self.word_starts)
+		if self.num_words == 1:
+			return int(packed[0])
+		return int.from_bytes(packed.tobytes(), "little")
+
+	def decode(self, key) -> tuple:
+		'''
+		Returns the state vector (as a tuple) of a key
+		'''
+		if isinstance(key, bytes):
+			return tuple(np.frombuffer(key, dtype=self.dtype).astype(int))
+		packed = np.frombuffer(key.to_bytes(8 * self.num_words, "little"), dtype=np.uint64)
+		return tuple(((packed[self.words] >> self.shifts) & self.masks).astype(int))
+
+class PropensityCache:
+	'''
+	A bounded LRU cache of the (enabled, rates) propensity vectors of states, keyed by their
+	index in the StateStore. Perimeter states are re-evaluated every time the perimeter is
+	closed (see solver.finalize_and_check), and again when they are eventually expanded, so
+	this saves evaluating the rate laws on them more than once. Only states whose propensities
+	are actually evaluated (at a check, or when they are expanded) are cached.
+
+	Hits and misses count lookups (get, get_batch, pop and pop_batch) that did and did not find
+	their state cached.
+	'''
+	def __init__(self, crn : Crn, max_size : int = PROPENSITY_CACHE_SIZE):
+		self.crn = crn
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, idx : int, vec):
+		'''
+		Returns the (enabled, rates) propensity vectors of the state with index idx (whose
+		vector is vec), evaluating and caching them if they are not cached
+		'''
+		entry = self.entries.get(idx)
+		if entry is not None:
+			self.entries.move_to_end(idx)
+			self.hits += 1
+			return entry
+		self.misses += 1
+		entry = self.crn.propensities(vec)
+		self.entries[idx] = entry
+		if len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+		return entry
+
+	def get_batch(self, idxs, vecs):
+		'''
+		Batched version of get(): returns the (k x transitions) enabled and rates arrays of the
+		states with indexes idxs (whose vectors are the rows of vecs), evaluating the ones that
+		are not cached with a single call
+		'''
+		num_transitions = len(self.crn.transitions)
+		enabled = np.zeros((len(idxs), num_transitions), dtype=bool)
+		rates = np.zeros((len(idxs), num_transitions))
+		missing = []
+		for i, idx in enumerate(idxs):
+			entry = self.entries.get(idx)
+			if entry is None:
+				missing.append(i)
+				continue
+			self.entries.move_to_end(idx)
+			enabled[i], rates[i] = entry
+		self.hits += len(idxs) - len(missing)
+		self.misses += len(missing)
+		if len(missing) > 0:
+			enabled[missing], rates[missing] = self.crn.propensities(vecs[missing])
+			for i in missing:
+				self.entries[idxs[i]] = (enabled[i], rates[i])
+			while len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+		return enabled, rates
+
+	def pop(self, idx : int):
+		'''
+		Removes the propensity vectors of a state (e.g., once it is expanded, so they are no
+		longer needed) and returns them, or None if they are not cached
+		'''
+		entry = self.entries.pop(idx, None)
+		if entry is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return entry
+
+	def pop_batch(self, idxs, vecs):
+		'''
+		Batched version of pop(): removes the propensity vectors of the states with indexes idxs
+		(whose vectors are the rows of vecs) and returns them as (k x transitions) enabled and
+		rates arrays, evaluating the ones that are not cached with a single call
+		'''
+		enabled, rates = self.get_batch(idxs, vecs)
+		for idx in idxs:
+			self.entries.pop(idx, None)
+		return enabled, rates
+
+	def __len__(self):
+		return len(self.entries)
+
+class StateStore:
+	'''
+	A compact, array-backed store of the states discovered during exploration. Rather than
+	one Python object per state, each state is a row in a growable 2-D array of state vectors,
+	with parallel arrays for its order, (lowest) epsilon, perimeter flag and exit rate. States are
+	found through a hash index over the packed bytes of their state vector, or, if given a
+	StateEncoder, over the single integer the encoder packs them into. Optionally, the propensity
+	vectors of the states may be cached in a PropensityCache.
+
+	If residual_shape is given, the store also keeps the subspace residuals of each state (an
+	array of that shape, see State.subspace_residuals), so a state popped from the frontier does
+	not need to be projected again.
+
+	If spill_dir is given, the arrays are memory mapped files in spill_dir, and the index is a
+	SpillingIndex that keeps at most spill_limit states in memory (so it can not use packed keys).
+
+	Index 0 is reserved for the absorbing state, which has no vector and is not in the index.
+	'''
+	def __init__(self, num_species : int, capacity : int = 1024, dtype=np.int32, encoder : StateEncoder = None, propensity_cache : PropensityCache = None, spill_dir : str = None, spill_limit : int = SPILL_LIMIT, residual_shape : tuple = None):
+		self.num_species = num_species
+		self.dtype = np.dtype(dtype)
+		self.encoder = encoder
+		self.propensity_cache = propensity_cache
+		self.spill_dir = spill_dir
+		self.residual_shape = None if residual_shape is None else tuple(residual_shape)
+		self.residuals = None
+		self.size = 0
+		if spill_dir is None:
+			self.vecs = np.zeros((capacity, num_species), dtype=self.dtype)
+			self.order = np.zeros(capacity, dtype=np.int32)
+			self.epsilon = np.zeros(capacity)
+			self.perimeter = np.zeros(capacity, dtype=bool)
+			# NaN until the state is expanded
+			self.exit_rate = np.full(capacity, np.nan)
+			if self.residual_shape is not None:
+				self.residuals = np.zeros((capacity,) + self.residual_shape)
+			self.index = {}
+		else:
+			if encoder is not None:
+				raise Exception("A StateStore that spills to disk can not use packed keys")
+			os.makedirs(spill_dir, exist_ok=True)
+			self.vecs = mapped_array(self.array_path("vecs", capacity), (capacity, num_species), self.dtype)
+			self.order = mapped_array(self.array_path("order", capacity), capacity, np.int32)
+			self.epsilon = mapped_array(self.array_path("epsilon", capacity), capacity, np.float64)
+			self.perimeter = mapped_array(self.array_path("perimeter", capacity), capacity, bool)
+			self.exit_rate = mapped_array(self.array_path("exit_rate", capacity), capacity, np.float64)
+			if self.residual_shape is not None:
+				self.residuals = mapped_array(self.array_path("residuals", capacity), (capacity,) + self.residual_shape, np.float64)
+			self.index = SpillingIndex(os.path.join(spill_dir, "index"), num_species * self.dtype.itemsize, spill_limit)
+		# The absorbing state
+		self.size = 1
+		self.perimeter[0] = False
+		self.exit_rate[0] = 1.0
+
+	def __len__(self):
+		return self.size
+
+	def key(self, vec) -> bytes:
+		'''
+		The key of a state vector in the index
+		'''
+		if self.encoder is not None:
+			return self.encoder.encode(vec)
+		return np.asarray(vec, dtype=self.dtype).tobytes()
+
+	def find(self, vec):
+		'''
+		Returns the index of a state vector, or None if it has not been stored
+		'''
+		return self.index.get(self.key(vec))
+
+	def find_batch(self, vecs) -> np.ndarray:
+		'''
+		Batched version of find(): returns the index of each row of the (k x species) array
+		vecs, or -1 for rows that have not been stored. The keys of all of the rows are made at
+		once (slices of a single buffer, unless there is an encoder) and looked up in the index,
+		so this never touches the stored vectors.
+		'''
+		vecs = np.ascontiguousarray(vecs, dtype=self.dtype).reshape(-1, self.num_species)
+		if self.encoder is None:
+			raw = vecs.tobytes()
+			width = self.num_species * self.dtype.itemsize
+			keys = (raw[i:i + width] for i in range(0, len(raw), width))
+		else:
+			keys = (self.encoder.encode(vec) for vec in vecs)
+		get = self.index.get
+		return np.fromiter((get(key, -1) for key in keys), dtype=np.int64, count=len(vecs))
+
+	def __contains__(self, vec):
+		return self.key(vec) in self.index
+
+	def add(self, vec, order : int = 0, epsilon : float = 0.0, residual=None) -> int:
+		'''
+		Adds a new state to the store (as a perimeter state) and returns its index. The state
+		must not already be in the store. If the store keeps residuals, the state's residual must
+		be given.
+		'''
+		if self.size == len(self.vecs):
+			self.grow()
+		idx = self.size
+		self.vecs[idx] = vec
+		self.order[idx] = order
+		self.epsilon[idx] = epsilon
+		self.perimeter[idx] = True
+		self.exit_rate[idx] = np.nan
+		if self.residuals is not None:
+			self.residuals[idx] = residual
+		self.index[self.key(vec)] = idx
+		self.size += 1
+		return idx
+
+	def load(self, vecs, order, epsilon, perimeter, exit_rate, residuals=None):
+		'''
+		Appends many states at once with all of their data (e.g., from a checkpoint), and indexes
+		them. None of them may already be in the store. If the store keeps residuals, they must
+		be given.
+		'''
+		start = self.size
+		while self.size + len(vecs) > len(self.vecs):
+			self.grow()
+		end = start + len(vecs)
+		self.vecs[start:end] = vecs
+		self.order[start:end] = order
+		self.epsilon[start:end] = epsilon
+		self.perimeter[start:end] = perimeter
+		self.exit_rate[start:end] = exit_rate
+		if self.residuals is not None:
+			self.residuals[start:end] = residuals
+		for idx in range(start, end):
+			self.index[self.key(self.vecs[idx])] = idx
+		self.size = end
+
+	def grow(self):
+		'''
+		Doubles the capacity of all of the arrays
+		'''
+		capacity = 2 * len(self.vecs)
+		if self.spill_dir is not None:
+			self.vecs = resize_mapped(self.vecs, self.array_path("vecs", capacity), (capacity, self.num_species))
+			self.order = resize_mapped(self.order, self.array_path("order", capacity), capacity)
+			self.epsilon = resize_mapped(self.epsilon, self.array_path("epsilon", capacity), capacity)
+			self.perimeter = resize_mapped(self.perimeter, self.array_path("perimeter", capacity), capacity)
+			self.exit_rate = resize_mapped(self.exit_rate, self.array_path("exit_rate", capacity), capacity)
+			if self.residuals is not None:
+				self.residuals = resize_mapped(self.residuals, self.array_path("residuals", capacity), (capacity,) + self.residual_shape)
+			return
+		self.vecs = np.resize(self.vecs, (capacity, self.num_species))
+		self.order = np.resize(self.order, capacity)
+		self.epsilon = np.resize(self.epsilon, capacity)
+		self.perimeter = np.resize(self.perimeter, capacity)
+		self.exit_rate = np.resize(self.exit_rate, capacity)
+		if self.residuals is not None:
+			self.residuals = np.resize(self.residuals, (capacity,) + self.residual_shape)
+
+	def array_path(self, name : str, capacity : int) -> str:
+		'''
+		The file backing one of the arrays (at some capacity) of a StateStore that spills
+		'''
+		return os.path.join(self.spill_dir, f"{name}.{capacity}.npy")
+
+	def perimeter_idxs(self) -> np.ndarray:
+		'''
+		The indexes of all states that have not been expanded
+		'''
+		return np.flatnonzero(self.perimeter[:self.size])
@@ -14,6 +14,9 @@ from distance import vass_distance
 from crn import *
 
 DONT_CARE = -1
+# Subspace distances below this are numerical noise from the pseudoinverse, and are treated
+# as zero (see also DepGraph.create_offset_vector)
+ZERO_TOLERANCE = 1e-9
 
 class Subspace:
 	mask = None      # (target > DONT_CARE).astype(float)
@@ -45,6 +48,15 @@ class Subspace:
 			return float(np.linalg.norm(Subspace.piped_inv * vec))
 		return float(np.linalg.norm(np.multiply(vec, Subspace.mask)))
 
+	def norm_batch(vecs) -> np.ndarray:
+		'''
+		Batched version of Subspace.norm. Takes a (k x species) array with one vector per row and
+		returns the k norms
+		'''
+		if Subspace.piped_inv is not None:
+			return np.linalg.norm(vecs @ np.asarray(Subspace.piped_inv).T, axis=1)
+		return np.linalg.norm(vecs * np.asarray(Subspace.mask).ravel(), axis=1)
+
 
 	# Type of elements in transitions: crn.Transition
 	def __init__(self, transitions, excluded_transitions, last_layer = None):
@@ -71,6 +83,24 @@ class Subspace:
 		# still produce a valid projection matrix
 		self.P = A * np.linalg.pinv(A.T * A) * A.T
 		self.rank = np.linalg.matrix_rank(self.P)
+		# An orthonormal basis Q of the subspace, so that P = Q * Q.T. The residual
+		# P * vec - vec can then be computed as Q * (Q.T * vec) - vec in O(species * rank)
+		# rather than O(species^2)
+		U, _, _ = np.linalg.svd(np.asarray(A, dtype=float), full_matrices=False)
+		self.Q = U[:, :self.rank]
+		# Indexes of the transitions into the CRN's transition list, so we can pick
+		# them out of the propensity vector. A transition may be listed more than once
+		# (e.g., in an agnostic dependency graph), but must only be expanded once
+		self.transition_idxs = Subspace.unique_idxs(transitions)
+		self.excluded_idxs = Subspace.unique_idxs(excluded_transitions)
+		self.last_layer_idxs = None if last_layer is None else Subspace.unique_idxs(last_layer)
+
+	@staticmethod
+	def unique_idxs(transitions) -> np.ndarray:
+		'''
+		The indexes of the transitions, without duplicates, in the order they are listed
+		'''
+		return np.array(list(dict.fromkeys(t.idx for t in transitions)), dtype=np.int64)
 
 	def get_update_vectors(self, crn=None):
 		'''
@@ -86,6 +116,17 @@ class Subspace:
 		else:
 			return self.transitions
 
+	def get_update_idxs(self, crn=None):
+		'''
+		Same as get_update_vectors, but returns the indexes of the transitions
+		'''
+		if crn is not None:
+			return np.arange(len(crn.transitions))
+		if self.last_layer_idxs is not None:
+			return self.last_layer_idxs
+		else:
+			return self.transition_idxs
+
 	# @Pure
 	def contains(self, other, test_vec): # -> bool:
 		# Check if contains
@@ -100,7 +141,16 @@ class Subspace:
 	def dist(self, vec): # -> float:
 		# Requires(len(vec) == len(Subspace.mask))
 		# Ensures(Result() >= 0.0)
-		return Subspace.norm(self.P * vec - vec)
+		vec = np.asarray(vec).ravel()
+		return float(self.dist_batch(vec[np.newaxis, :])[0])
+
+	def dist_batch(self, adjs) -> np.ndarray:
+		'''
+		Batched version of dist. Takes a (k x species) array of adjusted states, one per row
+		'''
+		dists = Subspace.norm_batch((adjs @ self.Q) @ self.Q.T - adjs)
+		dists[dists < ZERO_TOLERANCE] = 0.0
+		return dists
 
 
 	def __str__(self):
@@ -117,6 +167,20 @@ class State:
 	init : np.matrix = None
 	crn : Crn = None
 	total_offset : np.matrix = None
+	# Flat (1-D array) copies of the target and the offset, so states never need np.matrix copies
+	target_vec : np.ndarray = None
+	offset_vec : np.ndarray = None
+	# The orthonormal bases of all subspaces stacked side by side (species x sum of ranks),
+	# and the column each subspace's basis starts at. These let us compute the residuals of
+	# all of the subspaces with one matrix product (see State.subspace_dists)
+	stacked_basis : np.ndarray = None
+	basis_starts : np.ndarray = None
+	# The norm weighting applied to the residuals: either the mask vector or piped_inv
+	residual_weight : np.ndarray = None
+	# The (weighted) residual of each transition's update vector in each subspace,
+	# (transitions x weights x subspaces). Since the residual is linear, the residual of
+	# a successor is the residual of its parent plus the residual of the transition
+	transition_residuals : np.ndarray = None
 	@staticmethod
 	def initialize_static_vars(crn : Crn, dep, single_order=False):
 		if not single_order:
@@ -137,19 +201,81 @@ class State:
 		else:
 			State.total_offset = State.init + dep.create_offset_vector(State.subspaces[len(State.subspaces) - 1], State.subspaces[0])
 		# print("offset\n", State.total_offset - State.init)
+		State.initialize_residual_operators()
 		print(f"{dep}")
 
-	def __init__(self, vec, idx=None):
+	@staticmethod
+	def initialize_residual_operators():
+		'''
+		Precomputes the stacked subspace bases and the weighting of the residuals. Must be
+		called after Subspace.mask and (if used) Subspace.piped_inv are set.
+		'''
+		num_species = len(State.crn.boundary)
+		State.target_vec = np.asarray(State.target, dtype=float).ravel()
+		State.offset_vec = np.asarray(State.total_offset, dtype=float).ravel()
+		# A subspace of rank zero gets a zero column, so its projection is zero
+		bases = [s.Q if s.rank > 0 else np.zeros((num_species, 1)) for s in State.subspaces]
+		State.stacked_basis = np.column_stack(bases) if len(bases) > 0 else np.zeros((num_species, 0))
+		State.basis_starts = np.cumsum([0] + [b.shape[1] for b in bases[:-1]])
+		if Subspace.piped_inv is not None:
+			State.residual_weight = np.asarray(Subspace.piped_inv)
+		else:
+			State.residual_weight = np.asarray(Subspace.mask).ravel()
+		State.transition_residuals = State.subspace_residuals(State.crn.stoichiometry.astype(float))
+
+	@staticmethod
+	def subspace_residuals(adjs) -> np.ndarray:
+		'''
+		Computes the weighted residual P * adj - adj of each adjusted state (one per row of
+		adjs) in each subspace in one stacked call. Returns a (states x weights x subspaces) array.
+		'''
+		if len(State.subspaces) == 0:
+			return np.zeros((len(adjs), 0, 0))
+		# Projection onto every subspace at once: (states x species x subspaces)
+		coefs = adjs @ State.stacked_basis
+		proj = np.add.reduceat(coefs[:, np.newaxis, :] * State.stacked_basis[np.newaxis, :, :], State.basis_starts, axis=2)
+		residuals = proj - adjs[:, :, np.newaxis]
+		if State.residual_weight.ndim == 2:
+			return np.einsum("ij,kjl->kil", State.residual_weight, residuals)
+		return residuals * State.residual_weight[np.newaxis, :, np.newaxis]
+
+	@staticmethod
+	def residual_dists(residuals) -> np.ndarray:
+		'''
+		Turns the output of subspace_residuals into a (states x subspaces) array of distances,
+		where distances that are only numerical noise are zeroed.
+		'''
+		# The norms over the middle axis, in one pass (which np.linalg.norm does not do)
+		dists = np.sqrt(np.einsum("kws,kws->ks", residuals, residuals))
+		dists[dists < ZERO_TOLERANCE] = 0.0
+		return dists
+
+	@staticmethod
+	def subspace_dists(adjs) -> np.ndarray:
+		'''
+		Computes the distance of each adjusted state (one per row of adjs) to each subspace
+		in one stacked call. Returns a (states x subspaces) array.
+		'''
+		return State.residual_dists(State.subspace_residuals(adjs))
+
+	def __init__(self, vec, idx=None, order=None, epsilon=None, residual=None):
 		'''
 		Constructor for a new State element. Members within the State class:
-		1. vec (type: np.matrix) : the actual vector representing the state values
+		1. vec (type: np.ndarray) : the actual vector representing the state values
 		for a particular state in the state space.
-		2. adj (type: np.matrix) : the ADJUSTED state. I.e., the state minus the
+		2. adj (type: np.ndarray) : the ADJUSTED state. I.e., the state minus the
 		initial state.
 		3. order (type : int) : The number of subspaces we must pass through in order
 		to reach the smallest subspace.
 		4. epsilon (type list(int)) : The list of nonzero subspace distances, starting
 		with the largest and working towards the smallest
+
+		5. residual (type : np.ndarray) : The weighted residuals of adj in each subspace
+		(see State.subspace_residuals).
+
+		If order and epsilon are given (e.g., by State.from_batch), they are not recomputed.
+		If the residual is given (e.g., from the parent state and the transition taken to
+		get here), it is not recomputed either.
 		'''
 		# Requires(type(State.init) == np.matrix)
 		# Requires(type(State.target) == np.matrix)
@@ -158,13 +284,74 @@ class State:
 		# Ensures(self.order >= -1)
 		# Ensures(len(self.epsilon) == len(State.subspaces) + 1)
 		self.vec = vec
-		self.vecm = np.matrix(vec).T
-		self.adj = self.vecm - State.total_offset # State.init
+		self.adj = vec - State.offset_vec # State.init
+		if residual is None:
+			residual = State.subspace_residuals(self.adj[np.newaxis, :])[0]
+		self.residual = residual
 		self.order : int = 0
-		self.__compute_order()
+		if order is None:
+			self.__compute_order()
+		else:
+			self.order = order
+			self.epsilon = epsilon
+		# The priority in the frontier. Computed once so the frontier never needs to call
+		# the comparators below
+		self.priority : tuple = (self.order, self.epsilon[0])
 		self.perimeter = True
 		self.idx = idx
 
+	@staticmethod
+	def from_batch(vecs, residuals=None):
+		'''
+		Creates a State for each row of the (k x species) array vecs, computing the
+		orders and epsilons of all of them at once. If the residuals of the states are
+		already known, they may be passed in as well.
+		'''
+		vecs = np.asarray(vecs)
+		if len(vecs) == 0:
+			return []
+		dists_to_target = Subspace.norm_batch(vecs - State.target_vec)
+		if residuals is None:
+			residuals = State.subspace_residuals(vecs - State.offset_vec)
+		# One column per subspace
+		eps = State.residual_dists(residuals)
+		# The order is the number of subspace distances before the first zero one
+		nonzero = np.column_stack([eps != 0, np.zeros(len(vecs), dtype=bool)])
+		orders = np.argmin(nonzero, axis=1)
+		states = []
+		for i in range(len(vecs)):
+			if dists_to_target[i] == 0.0:
+				states.append(State(vecs[i], order=-1, epsilon=[0.0], residual=residuals[i]))
+				continue
+			order = int(orders[i])
+			epsilon = [float(ep) for ep in eps[i, order - 1::-1]] if order > 0 else []
+			epsilon.append(float(dists_to_target[i]))
+			states.append(State(vecs[i], order=order, epsilon=epsilon, residual=residuals[i]))
+		return states
+
+	@staticmethod
+	def priority_batch(vecs, residuals=None) -> tuple:
+		'''
+		Computes just the priorities (order, epsilon[0]) of each row of the (k x species) array
+		vecs, without creating States. If the residuals of the states are already known, they
+		may be passed in as well. Returns a tuple of the k orders and the k epsilons.
+		'''
+		vecs = np.asarray(vecs, dtype=float)
+		dists_to_target = Subspace.norm_batch(vecs - State.target_vec)
+		if residuals is None:
+			residuals = State.subspace_residuals(vecs - State.offset_vec)
+		eps = State.residual_dists(residuals)
+		if eps.shape[1] == 0:
+			orders = np.zeros(len(vecs), dtype=int)
+			epsilons = dists_to_target
+		else:
+			nonzero = np.column_stack([eps != 0, np.zeros(len(vecs), dtype=bool)])
+			orders = np.argmin(nonzero, axis=1)
+			# The distance to the first subspace with a distance of zero (or to the target)
+			epsilons = np.where(orders > 0, eps[np.arange(len(vecs)), np.maximum(orders - 1, 0)], dists_to_target)
+		at_target = dists_to_target == 0.0
+		return np.where(at_target, -1, orders), np.where(at_target, 0.0, epsilons)
+
 	def __compute_order(self):
 		'''
 		Computes the order and epsilon vector of the state
@@ -175,15 +362,14 @@ class State:
 		# Ensures(type(self.epsilon == list[float]))
 		# Ensures(len(self.epsilon) >= 1)
 		# Ensures(Forall(int, lambda i : (Implies(i > 0 and i < len(State.subspaces), self.epsilon[i] >= self.epsilon[i - 1]))))
-		dist_to_target = Subspace.norm(self.vecm - State.target)
+		dist_to_target = float(Subspace.norm_batch((self.vec - State.target_vec)[np.newaxis, :])[0])
 		if dist_to_target == 0.0:
 			self.epsilon : list = [0.0]
 			self.order = -1
 			return
 		self.epsilon = [dist_to_target]
 		self.order = 0
-		for s in State.subspaces:
-			ep = s.dist(self.adj)
+		for ep in State.residual_dists(self.residual[np.newaxis])[0]:
 			if ep == 0:
 				return
 			self.epsilon.insert(0, ep)
@@ -196,18 +382,121 @@ class State:
 		that one only includes the outgoing rates of the transitions of the current
 		subspace
 		'''
-		vec = self.vec
-		transitions = State.crn.transitions
-		total_rate = 0.0
-		for t in transitions:
-			if t.enabled(vec):
-				total_rate += t.rate_finder(vec)
-		return total_rate
+		_, rates = State.crn.propensities(self.vec)
+		return float(np.sum(rates))
+
+	def get_update_idxs(self, all_successors : bool = False):
+		'''
+		Returns the subspace whose transitions we expand from this state (None if
+		there are no subspaces) and the indexes of the transitions to expand
+		'''
+		if len(State.subspaces) == 0:
+			return None, np.arange(len(State.crn.transitions))
+		subspace = State.subspaces[max(0, len(State.subspaces) - (self.order + 2))]
+		if all_successors:
+			return subspace, subspace.get_update_idxs(State.crn)
+		return subspace, subspace.get_update_idxs()
+
+	@staticmethod
+	def update_mask(orders, all_successors : bool = False) -> np.ndarray:
+		'''
+		Batched version of get_update_idxs(): returns a (k x transitions) mask of the
+		transitions expanded from states with the given orders
+		'''
+		orders = np.asarray(orders)
+		mask = np.zeros((len(orders), len(State.crn.transitions)), dtype=bool)
+		if len(State.subspaces) == 0:
+			mask[:] = True
+			return mask
+		for order in np.unique(orders):
+			subspace = State.subspaces[max(0, len(State.subspaces) - (int(order) + 2))]
+			row = np.zeros(len(State.crn.transitions), dtype=bool)
+			row[subspace.get_update_idxs(State.crn if all_successors else None)] = True
+			mask[orders == order] = row
+		return mask
+
+	@staticmethod
+	def keep_successor(state, next_state, subspace) -> bool:
+		'''
+		Due to the cycle-free nature of the dependency graph, we can ignore successors with a
+		higher distance if both the current state and successor have order 0 (are in the last
+		subspace). Note: this only works if the last subspace has rank 1
+		'''
+		return not (subspace is not None and subspace.rank == 1 and state.order == 0 and \
+			next_state.epsilon[len(next_state.epsilon) - 1] > state.epsilon[len(state.epsilon) - 1])
+
+	def expand(self, all_successors : bool = False, only_tuples : bool = False, propensities : tuple = None):
+		'''
+		Expands the state with a single evaluation of the propensity vector. Returns a tuple
+		(successors, total_expanded_rate, total_full_rate), where successors is a list of
+		(successor, rate) pairs, total_expanded_rate is the total rate of those successors and
+		total_full_rate is the rate of ALL enabled transitions. So total_full_rate -
+		total_expanded_rate is the rate of everything we did not expand.
+
+		If only_tuples is set, the successors are tuples rather than States, and none of them
+		are ignored. If the (enabled, rates) propensity vectors of the state are already known
+		(e.g., from a PropensityCache), they may be passed in.
+		'''
+		# If we get the successors, we are no longer a perimeter state
+		self.perimeter = False
+		enabled, rates = State.crn.propensities(self.vec) if propensities is None else propensities
+		total_full_rate = float(np.sum(rates))
+		subspace, update_idxs = self.get_update_idxs(all_successors)
+		update_idxs = update_idxs[enabled[update_idxs]]
+		next_vecs = self.vec + State.crn.stoichiometry[update_idxs]
+		if only_tuples:
+			succ = [(tuple(vec), rates[i]) for vec, i in zip(next_vecs, update_idxs)]
+			return succ, float(np.sum(rates[update_idxs])), total_full_rate
+		# Rather than recomputing the residuals, update them along the transitions
+		next_states = State.from_batch(next_vecs, self.residual + State.transition_residuals[update_idxs])
+		succ = [(next_state, rates[i]) for next_state, i in zip(next_states, update_idxs) if State.keep_successor(self, next_state, subspace)]
+		return succ, float(sum(rate for _, rate in succ)), total_full_rate
+
+	@staticmethod
+	def successors_batch(states, all_successors : bool = False, propensities : tuple = None):
+		'''
+		Batched version of expand(). Evaluates the propensities of all of the states at once
+		and creates all of their successors with a single call to State.from_batch. Returns a
+		list with a (successors, total_expanded_rate, total_full_rate) tuple for each state.
 
-	def successors(self, only_tuples : bool = False, all_successors : bool = False): # -> tuple:
+		If the (k x transitions) enabled and rates arrays of the states are already known (e.g.,
+		from a PropensityCache), they may be passed in.
+		'''
+		if len(states) == 0:
+			return []
+		vecs = np.array([s.vec for s in states])
+		enabled, rates = State.crn.propensities(vecs) if propensities is None else propensities
+		subspaces = []
+		chosen = []
+		for i in range(len(states)):
+			# If we get the successors, we are no longer a perimeter state
+			states[i].perimeter = False
+			subspace, update_idxs = states[i].get_update_idxs(all_successors)
+			subspaces.append(subspace)
+			chosen.append(update_idxs[enabled[i, update_idxs]])
+		counts = [len(c) for c in chosen]
+		rows = np.repeat(np.arange(len(states)), counts)
+		cols = np.concatenate(chosen)
+		# The residuals of the successors are updated incrementally from their parents'
+		parent_residuals = np.array([s.residual for s in states])
+		next_states = State.from_batch(vecs[rows] + State.crn.stoichiometry[cols]
+				, parent_residuals[rows] + State.transition_residuals[cols])
+		succs = [[] for _ in states]
+		for k in range(len(next_states)):
+			i = rows[k]
+			if State.keep_successor(states[i], next_states[k], subspaces[i]):
+				succs[i].append((next_states[k], rates[i, cols[k]]))
+		return [(succ, float(sum(rate for _, rate in succ)), float(np.sum(rates[i]))) for i, succ in enumerate(succs)]
+
+	def successors(self, only_tuples : bool = False, all_successors : bool = False, reactions : bool = False): # -> tuple:
 		'''
 		Only returns the successors using the vectors in the dependency graph
 		that get us closer to the target.
+
+		The rate returned also includes the excluded transitions of the subspace. To get the
+		total rate of ALL enabled transitions as well, use expand().
+
+		If reactions is set, each successor is a (successor, rate, reaction index) triple.
 		'''
 		# Requires(type(State.init) == np.matrix)
 		# Requires(type(State.target) == np.matrix)
@@ -234,17 +523,20 @@ class State:
 			else:
 				update_vectors = subspace.get_update_vectors() # State.crn)
 		# print(f"Update vectors {[str(vec) for vec in update_vectors]}")
+		# Evaluate all transitions at once, then pick out the ones we need
+		enabled, rates = State.crn.propensities(self.vec)
 		for t in update_vectors:
 			# print(f"Update vector: {t.name} vec {t.vector}...", end="")
-			if t.enabled(self.vec):
-				rate = t.rate_finder(self.vec)
+			if enabled[t.idx]:
+				rate = rates[t.idx]
 				total_outgoing_rate += rate
 				if only_tuples:
-					succ.append((tuple(self.vec + t.vector), rate))
+					succ.append((tuple(self.vec + t.vector), rate, t.idx) if reactions else (tuple(self.vec + t.vector), rate))
 					continue
 				# print("enabled")
 				# print("Update", t.vector)
-				next_state = State(self.vec + t.vector)
+				# Rather than recomputing the residual, update it along the transition
+				next_state = State(self.vec + t.vector, residual=self.residual + State.transition_residuals[t.idx])
 				# The rate finder works on the current state, not the next
 				# print("vec", self.vec)
 				# print("new vec", next_state.vec)
@@ -255,20 +547,20 @@ class State:
 				if subspace is not None and subspace.rank == 1 and self.order == 0 and \
 					next_state.epsilon[len(next_state.epsilon) - 1] > self.epsilon[len(self.epsilon) - 1]:
 					continue
-				succ.append((next_state, rate))
+				succ.append((next_state, rate, t.idx) if reactions else (next_state, rate))
 			# else:
 			# 	print("not enabled")
 		# Compute this rate using ALL transitions, not just the ones we use for successors
 		if subspace is not None:
 			for t in subspace.excluded_transitions:
-				if t.enabled(self.vec):
-					rate = t.rate_finder(self.vec)
-					total_outgoing_rate += rate
+				if enabled[t.idx]:
+					total_outgoing_rate += rates[t.idx]
 		# print([s[0].vec for s in succ])
 		# print(f"For state {self.vec}, successors are {[state.vec for state, rate in succ]}")
 		return succ, total_outgoing_rate
 
 	# Comparators. ONLY COMPARES THE ORDER AND THE LOWEST VALUE FOR EPSILON
+	# (i.e., the priority). The search itself uses the priority tuple directly
 	# @Pure
 	def __gt__(self, other):
 		# Requires(len(self.epsilon) == len(other.epsilon))
@@ -0,0 +1,250 @@
+import gzip
+import math
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+# Writing and reading counterexample traces. Traces are written one at a time as they are found
+# (rather than all at the end), either as text (the format of print_counterexamples) or in a
+# compact binary format:
+#
+#   header: MAGIC, VERSION (one byte), the number of species and of reactions (varints), then
+#           the vector of each reaction (zigzag varints)
+#   trace:  the log probability (little endian float64), the start (initial) state (a varint per
+#           species), the number of steps and the index of the reaction of each step (varints)
+#
+# Either may be compressed with gzip or zstd (if the zstandard module is installed). Like
+# print_counterexamples, a text file starts with the number of traces, so the text traces are
+# spooled to a temporary file (next to the trace file) and copied after it on closing.
+
+TEXT = "text"
+BINARY = "binary"
+FORMATS = [TEXT, BINARY]
+
+GZIP = "gzip"
+ZSTD = "zstd"
+COMPRESSIONS = [GZIP, ZSTD]
+
+DEFAULT_TRACE_FILE = "traces.wayfarer"
+
+MAGIC = b"WFTR"
+VERSION = 2
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def write_varint(out : bytearray, value : int):
+	'''
+	Appends an unsigned LEB128 varint
+	'''
+	while value >= 0x80:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+def read_varint(stream) -> int:
+	'''
+	Reads an unsigned LEB128 varint, or returns None at the end of the stream
+	'''
+	value = 0
+	shift = 0
+	while True:
+		byte = stream.read(1)
+		if len(byte) == 0:
+			if shift == 0:
+				return None
+			raise Exception("Truncated varint in trace file")
+		value |= (byte[0] & 0x7f) << shift
+		if byte[0] < 0x80:
+			return value
+		shift += 7
+
+def zigzag(value : int) -> int:
+	return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+def unzigzag(value : int) -> int:
+	return (value >> 1) if value & 1 == 0 else -((value + 1) >> 1)
+
+def log_sum(log_probabilities) -> float:
+	'''
+	The log of the sum of probabilities given as logs (log-sum-exp), without leaving log space
+	'''
+	log_probabilities = np.asarray(log_probabilities, dtype=float)
+	if len(log_probabilities) == 0:
+		return -math.inf
+	return float(np.logaddexp.reduce(log_probabilities))
+
+def format_probability(log_probability : float) -> str:
+	'''
+	A probability given as a log, printed as a float if it is one, or in scientific notation
+	(computed in log space) if it underflows
+	'''
+	probability = math.exp(log_probability)
+	if probability >= np.finfo(float).tiny or log_probability == -math.inf:
+		return str(probability)
+	log10 = log_probability / math.log(10)
+	exponent = math.floor(log10)
+	return f"{10 ** (log10 - exponent)}e{exponent}"
+
+def parse_probability(text : str) -> float:
+	'''
+	The log of a probability printed by format_probability (up to its rounding)
+	'''
+	mantissa, _, exponent = text.partition("e")
+	mantissa = float(mantissa)
+	if mantissa == 0.0:
+		return -math.inf
+	return math.log(mantissa) + (int(exponent) * math.log(10) if exponent != "" else 0.0)
+
+class Trace:
+	'''
+	A counterexample trace, stored as its initial state and the indexes of the reactions along
+	it. The states are only reconstructed (by replaying the reaction vectors) when asked for.
+	'''
+	def __init__(self, init_state, reactions, stoichiometry):
+		self.init_state = tuple(int(v) for v in init_state)
+		self.reactions = np.asarray(reactions, dtype=np.int64)
+		self.stoichiometry = stoichiometry
+
+	def __len__(self):
+		'''
+		The number of states in the trace
+		'''
+		return len(self.reactions) + 1
+
+	def states(self) -> list:
+		'''
+		The states of the trace (as tuples), from the satisfying state back to the initial state
+		'''
+		steps = np.asarray(self.stoichiometry)[self.reactions].reshape(len(self.reactions), -1)
+		vecs = np.cumsum(np.vstack([np.array(self.init_state, dtype=np.int64).reshape(1, -1), steps]), axis=0)
+		return [tuple(int(v) for v in vec) for vec in vecs[::-1]]
+
+def open_stream(path : str, mode : str, compression : str = None):
+	'''
+	Opens a (binary) file, compressed or not. On reading, the compression is detected from the
+	first bytes of the file.
+	'''
+	if mode == "rb":
+		with open(path, "rb") as f:
+			start = f.read(4)
+		compression = GZIP if start.startswith(GZIP_MAGIC) else ZSTD if start == ZSTD_MAGIC else None
+	if compression is None:
+		return open(path, mode)
+	if compression == GZIP:
+		return gzip.open(path, mode)
+	if compression == ZSTD:
+		try:
+			import zstandard
+		except ImportError:
+			raise Exception("zstd compression needs the zstandard module. Please install it or use gzip")
+		return zstandard.open(path, mode)
+	raise Exception(f"Unknown compression {compression}. Must be one of {', '.join(COMPRESSIONS)}")
+
+class TraceWriter:
+	'''
+	Writes counterexample traces (Traces) to a file as soon as they are found
+	'''
+	def __init__(self, path : str, crn, fmt : str = TEXT, compression : str = None):
+		if fmt not in FORMATS:
+			raise Exception(f"Unknown trace format {fmt}. Must be one of {', '.join(FORMATS)}")
+		self.path = path
+		self.fmt = fmt
+		self.stoichiometry = crn.stoichiometry
+		self.count = 0
+		self.log_lower_bound = -math.inf
+		self.stream = open_stream(path, "wb", compression)
+		if fmt == TEXT:
+			self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+			return
+		header = bytearray(MAGIC)
+		header.append(VERSION)
+		write_varint(header, self.stoichiometry.shape[1])
+		write_varint(header, self.stoichiometry.shape[0])
+		for v in self.stoichiometry.ravel():
+			write_varint(header, zigzag(int(v)))
+		self.stream.write(header)
+
+	def write(self, log_probability : float, trace : Trace):
+		self.count += 1
+		self.log_lower_bound = np.logaddexp(self.log_lower_bound, log_probability)
+		if self.fmt == TEXT:
+			line = [f"Counterexample size {len(trace)} (esimated probability {format_probability(log_probability)})"]
+			states = trace.states()
+			for i in range(len(states)):
+				additional_message = " (satisfying state)" if i == 0 else " (initial state)" if i == len(states) - 1 else ""
+				line.append(f"State: {states[i]}{additional_message}")
+			self.spool.write((" ".join(line) + " \n").encode())
+			return
+		record = bytearray(struct.pack("<d", log_probability))
+		for v in trace.init_state:
+			write_varint(record, v)
+		write_varint(record, len(trace.reactions))
+		for reaction in trace.reactions:
+			write_varint(record, int(reaction))
+		self.stream.write(record)
+
+	def close(self):
+		if self.fmt == TEXT:
+			self.stream.write(f"Finished finding {self.count} counterexamples\n".encode())
+			self.spool.seek(0)
+			shutil.copyfileobj(self.spool, self.stream)
+			self.spool.close()
+			self.stream.write(f"Total lower bound probability: {format_probability(self.log_lower_bound)}\n".encode())
+		self.stream.close()
+		print(f"Wrote {self.count} traces to {self.path}")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def read_text_traces(stream, path : str):
+	'''
+	Lazily iterates over the traces of a text trace file (see read_traces)
+	'''
+	for line in stream:
+		line = line.decode()
+		if not line.startswith("Counterexample size"):
+			continue
+		match = re.match(r"Counterexample size (\d+) \(esimated probability ([^)]*)\)", line)
+		if match is None:
+			raise Exception(f"Malformed trace in {path}: {line.strip()}")
+		states = [tuple(int(v) for v in state.split(",") if v.strip() != "") for state in re.findall(r"State: \(([^)]*)\)", line)]
+		if len(states) != int(match.group(1)):
+			raise Exception(f"Truncated trace in {path}: {line.strip()}")
+		yield parse_probability(match.group(2)), states
+
+def read_traces(path : str, states : bool = True):
+	'''
+	Lazily iterates over the traces of a trace file. Yields (log probability, trace), with the
+	trace as a list of state tuples from the satisfying state back to the initial state (which
+	are replayed from the reaction vectors in a binary file), or if states is not set, as a Trace.
+	Text files only have the states (and the probabilities as printed), so states must be set.
+	'''
+	with open_stream(path, "rb") as stream:
+		if stream.read(len(MAGIC)) != MAGIC:
+			if not states:
+				raise Exception(f"{path} is not a binary trace file, so it has no reactions")
+			with open_stream(path, "rb") as text:
+				yield from read_text_traces(text, path)
+			return
+		version = stream.read(1)[0]
+		if version != VERSION:
+			raise Exception(f"Unsupported trace file version {version}")
+		num_species = read_varint(stream)
+		num_reactions = read_varint(stream)
+		stoichiometry = np.array([unzigzag(read_varint(stream)) for _ in range(num_species * num_reactions)], dtype=np.int64).reshape(num_reactions, num_species)
+		while True:
+			log_probability = stream.read(8)
+			if len(log_probability) == 0:
+				return
+			log_probability = struct.unpack("<d", log_probability)[0]
+			init_state = tuple(read_varint(stream) for _ in range(num_species))
+			trace = Trace(init_state, [read_varint(stream) for _ in range(read_varint(stream))], stoichiometry)
+			yield log_probability, trace.states() if states else trace
+
@@ -0,0 +1,118 @@
+import multiprocessing
+
+import numpy as np
+
+# Random exploration with many walkers at once. Rather than simulating one trace at a time,
+# a batch of walkers is advanced in lockstep as a (walkers x species) array: each step evaluates
+# the propensities of every walker still running with one call, and samples every walker's
+# next reaction at once from the cumulative sums of its selection weights.
+
+# The default number of walkers simulated in each batch
+NUM_WALKERS = 4096
+
+# How walkers choose their next reaction: uniformly among the enabled reactions (like the
+# original random exploration), or in proportion to the reaction rates (i.e., like the embedded
+# DTMC of the CTMC)
+UNIFORM = "uniform"
+PROPORTIONAL = "proportional"
+SELECTIONS = [UNIFORM, PROPORTIONAL]
+
+# The CRN of the batches run by worker processes. Set before the workers are forked, so it
+# never needs to be pickled.
+worker_crn = None
+
+def sample_reactions(weights : np.ndarray, rng : np.random.Generator) -> np.ndarray:
+	'''
+	Samples one column of each row of a (k x transitions) array of non-negative weights, in
+	proportion to the weights. Every row must have a positive sum.
+	'''
+	cumulative = np.cumsum(weights, axis=1)
+	u = rng.random(len(weights)) * cumulative[:, -1]
+	# The first column whose cumulative sum is above u, which always has a positive weight
+	return np.minimum(np.sum(cumulative <= u[:, np.newaxis], axis=1), weights.shape[1] - 1)
+
+def simulate_batch(crn, num_walkers : int, trace_length : int, selection : str, rng : np.random.Generator) -> list:
+	'''
+	Simulates num_walkers walkers from the initial state for at most trace_length steps each.
+	A walker stops when it reaches a satisfying state, or in a deadlock. Returns (log
+	probability, reaction indexes) of every walker that reached a satisfying state, where the
+	probability is that of the trace in the embedded DTMC (whatever the selection), and the
+	reaction indexes are an int32 array.
+	'''
+	if selection not in SELECTIONS:
+		raise Exception(f"Unknown selection {selection}. Must be one of {', '.join(SELECTIONS)}")
+	states = np.tile(np.asarray(crn.init_state, dtype=np.int64), (num_walkers, 1))
+	reactions = np.zeros((num_walkers, trace_length), dtype=np.int32)
+	log_probs = np.zeros(num_walkers)
+	running = np.arange(num_walkers)
+	found = []
+	for step in range(trace_length):
+		if len(running) == 0:
+			break
+		enabled, rates = crn.propensities(states[running])
+		total_rates = rates.sum(axis=1)
+		weights = rates if selection == PROPORTIONAL else enabled.astype(float)
+		# Deadlocked walkers (with nothing enabled, or only reactions with zero rate) stop
+		live = (total_rates > 0.0) & (weights.sum(axis=1) > 0.0)
+		running, rates, total_rates, weights = running[live], rates[live], total_rates[live], weights[live]
+		if len(running) == 0:
+			break
+		chosen = sample_reactions(weights, rng)
+		chosen_rates = rates[np.arange(len(running)), chosen]
+		with np.errstate(divide="ignore"):
+			log_probs[running] += np.log(chosen_rates) - np.log(total_rates)
+		reactions[running, step] = chosen
+		states[running] += crn.stoichiometry[chosen]
+		satisfied = crn.satisfies(states[running])
+		for walker in running[satisfied]:
+			found.append((log_probs[walker], reactions[walker, :step + 1].copy()))
+		running = running[~satisfied]
+	return found
+
+def run_batch(args : tuple) -> list:
+	'''
+	Runs simulate_batch on worker_crn in a worker process, with args (num_walkers,
+	trace_length, selection, seed sequence)
+	'''
+	num_walkers, trace_length, selection, seed = args
+	return simulate_batch(worker_crn, num_walkers, trace_length, selection, np.random.default_rng(seed))
+
+def random_walks(crn, number : int, trace_length : int = 100, num_walkers : int = NUM_WALKERS, selection : str = UNIFORM, workers : int = None, seed : int = None):
+	'''
+	Runs batches of walkers until `number` distinct satisfying traces are found, and lazily
+	yields each distinct trace as (log probability, reaction indexes) as soon as it is found.
+	Traces are deduplicated by their reactions through a hash set.
+
+	With workers, each round runs one batch on every worker process (forked, with their own
+	seeds) at once.
+	'''
+	global worker_crn
+	seeds = np.random.SeedSequence(seed)
+	seen = set()
+	num_found = 0
+	num_batches = 0
+	pool = None
+	if workers is not None and workers > 1:
+		worker_crn = crn
+		pool = multiprocessing.get_context("fork").Pool(workers)
+	try:
+		while num_found < number:
+			if pool is None:
+				batches = [simulate_batch(crn, num_walkers, trace_length, selection, np.random.default_rng(seeds.spawn(1)[0]))]
+			else:
+				batches = pool.map(run_batch, [(num_walkers, trace_length, selection, s) for s in seeds.spawn(workers)])
+			num_batches += len(batches)
+			for log_prob, trace in (t for batch in batches for t in batch):
+				key = trace.tobytes()
+				if key in seen:
+					continue
+				seen.add(key)
+				num_found += 1
+				yield log_prob, trace
+				if num_found >= number:
+					break
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	print(f"Simulated {num_batches * num_walkers} walkers in {num_batches} batches")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+from parser import parse_dependency_ragtimer
+import solver
+
+import os
+import tempfile
+
+from test_ctmc import TOY_RAGTIMER
+
+def solve(ragtimer : str, tmp_dir : str, number : int, **kwargs) -> tuple:
+	'''
+	Parses the model in ragtimer (RAGTIMER text) and explores it until `number` satisfying states
+	are found (expanding all successors unless told otherwise, since the subspaces of the toy
+	model only lead to one). Returns the bounds and the number of states.
+	'''
+	kwargs.setdefault("expand_all_states", True)
+	path = os.path.join(tmp_dir, "model.ragtimer")
+	with open(path, "w") as f:
+		f.write(ragtimer)
+	dep, crn = parse_dependency_ragtimer(path)
+	bounds = solver.min_probability_subsp(crn, dep, number=number, backend=solver.NATIVE, **kwargs)
+	return bounds, len(solver.state_store)
+
+def rejected(ragtimer : str, tmp_dir : str, checkpoint : str, **kwargs) -> bool:
+	'''
+	Whether resuming from the checkpoint is rejected
+	'''
+	try:
+		solve(ragtimer, tmp_dir, 8, checkpoint=checkpoint, resume=True, **kwargs)
+	except Exception as e:
+		return "Checkpoint" in str(e)
+	return False
+
+def test_resume():
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		expected = solve(TOY_RAGTIMER, tmp_dir, 8)
+		# With the store and frontier in memory, and spilled to disk
+		for spill in [{}, { "spill_dir" : tmp_dir, "spill_limit" : 4 }]:
+			checkpoint = os.path.join(tmp_dir, "checkpoint.npz")
+			if os.path.exists(checkpoint):
+				os.remove(checkpoint)
+			first = solve(TOY_RAGTIMER, tmp_dir, 2, checkpoint=checkpoint, **spill)
+			assert(first[1] < expected[1])
+			# Continues with a larger number, as if the first run had not stopped
+			assert(solve(TOY_RAGTIMER, tmp_dir, 8, checkpoint=checkpoint, resume=True, **spill) == expected)
+
+def test_mismatch():
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		checkpoint = os.path.join(tmp_dir, "checkpoint.npz")
+		solve(TOY_RAGTIMER, tmp_dir, 2, checkpoint=checkpoint)
+		assert(not rejected(TOY_RAGTIMER, tmp_dir, checkpoint))
+		# Other search options
+		assert(rejected(TOY_RAGTIMER, tmp_dir, checkpoint, single_order=True))
+		assert(rejected(TOY_RAGTIMER, tmp_dir, checkpoint, expand_all_states=False))
+		# Another rate constant, and another bound
+		assert(rejected(TOY_RAGTIMER.replace("R3	A	>	D	1.0", "R3	A	>	D	2.0"), tmp_dir, checkpoint))
+		assert(rejected(TOY_RAGTIMER.replace("-1	-1	4	-1", "-1	-1	5	-1"), tmp_dir, checkpoint))
+
+if __name__=="__main__":
+	test_resume()
+	test_mismatch()
+	print("Checkpoints resume the same exploration and reject other models and options")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+from parser import parse_dependency_ragtimer
+import ctmc
+import solver
+
+import os
+import tempfile
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
+from scipy.sparse.linalg import spsolve
+
+# The toy model (in RAGTIMER format): the bounds of the native backend must match storm's
+TOY_RAGTIMER = '''A	B	C	D
+10	5	0	0
+-1	-1	4	-1
+R1	A	B	>	C	0.5
+R2	C	>	A	B	0.1
+R3	A	>	D	1.0
+R4	D	>	A	0.3
+R5	B	>	0	0.05
+'''
+
+ABSORBING = 0
+TOLERANCE = 1e-8
+
+def random_ctmc(size=40, density=0.1, seed=1):
+	'''
+	A random CTMC as a CSR rate matrix, with an absorbing state (index 0, with a self loop), a few
+	targets, and some states that can reach neither (a closed class among the last ones)
+	'''
+	rng = np.random.default_rng(seed)
+	rates = sp.random(size, size, density=density, random_state=rng, format="lil") * 5.0
+	closed = size - 5
+	rates[0, :] = 0.0
+	rates[0, 0] = 1.0
+	# The closed class only has transitions among itself
+	rates[closed:, :closed] = 0.0
+	for i in range(closed, size):
+		rates[i, closed + (i - closed + 1) % (size - closed)] = 1.0
+	# Every other state can leave (in part to the absorbing state)
+	for i in range(1, closed):
+		rates[i, 0] += 0.1
+	rates = rates.tocsr()
+	rates.sort_indices()
+	targets = np.array([3, 7, 11])
+	return rates, targets
+
+def direct_reachability(rates : sp.csr_matrix, targets) -> np.ndarray:
+	'''
+	The probability of eventually reaching the targets, by a direct sparse solve of the
+	embedded DTMC on the states that can reach them (found by a dense fixed point)
+	'''
+	size = rates.shape[0]
+	adjacency = rates.toarray() > 0.0
+	can_reach = np.zeros(size, dtype=bool)
+	can_reach[targets] = True
+	while True:
+		next_reach = can_reach | (adjacency.astype(int) @ can_reach.astype(int) > 0)
+		if np.array_equal(next_reach, can_reach):
+			break
+		can_reach = next_reach
+	x = np.zeros(size)
+	x[targets] = 1.0
+	maybe = np.flatnonzero(can_reach)
+	maybe = maybe[~np.isin(maybe, targets)]
+	exit_rates = np.asarray(rates.sum(axis=1)).ravel()
+	P = sp.diags(1.0 / exit_rates[maybe]) @ rates[maybe]
+	A = sp.eye(len(maybe)) - P[:, maybe]
+	b = np.asarray(P[:, targets].sum(axis=1)).ravel()
+	x[maybe] = spsolve(A.tocsc(), b)
+	return x
+
+def bounded_reachability(rates : sp.csr_matrix, targets, time_bound : float) -> np.ndarray:
+	'''
+	The probability of reaching the targets within time_bound, from the matrix exponential of
+	the generator with the targets made absorbing
+	'''
+	R = rates.toarray()
+	R[targets, :] = 0.0
+	Q = R - np.diag(R.sum(axis=1))
+	return scipy.linalg.expm(Q * time_bound)[:, targets].sum(axis=1)
+
+def test_unbounded():
+	rates, targets = random_ctmc()
+	with_absorbing = np.append(targets, ABSORBING)
+	expected = np.column_stack([direct_reachability(rates, targets), direct_reachability(rates, with_absorbing)])
+	for method in ctmc.METHODS:
+		x = ctmc.reachability(rates.indptr, rates.indices, rates.data, targets, method=method)
+		assert(np.allclose(x, expected[:, 0], rtol=TOLERANCE, atol=TOLERANCE))
+		x = ctmc.reachability(rates.indptr, rates.indices, rates.data, targets, method=method, absorbing=ABSORBING)
+		assert(np.allclose(x, expected, rtol=TOLERANCE, atol=TOLERANCE))
+		# Warm started from the solution
+		x = ctmc.reachability(rates.indptr, rates.indices, rates.data, targets, method=method, x0=x, absorbing=ABSORBING)
+		assert(np.allclose(x, expected, rtol=TOLERANCE, atol=TOLERANCE))
+
+def test_uniformization():
+	rates, targets = random_ctmc()
+	with_absorbing = np.append(targets, ABSORBING)
+	# A short bound, and one long enough that the steps before the left truncation point are
+	# skipped by squaring
+	for time_bound in [0.5, 40.0]:
+		expected = np.column_stack([bounded_reachability(rates, targets, time_bound), bounded_reachability(rates, with_absorbing, time_bound)])
+		x = ctmc.reachability(rates.indptr, rates.indices, rates.data, targets, time_bound=time_bound, absorbing=ABSORBING)
+		assert(np.allclose(x, expected, rtol=1e-6, atol=1e-10))
+
+def toy_bounds(backend : str, time_bound=None) -> tuple:
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		path = os.path.join(tmp_dir, "toy.ragtimer")
+		with open(path, "w") as f:
+			f.write(TOY_RAGTIMER)
+		dep, crn = parse_dependency_ragtimer(path)
+	return solver.min_probability_subsp(crn, dep, number=3, time_bound=time_bound, backend=backend)
+
+def test_storm():
+	try:
+		import stormpy
+	except ImportError:
+		print("stormpy is not installed, skipping the comparison with storm")
+		return
+	# The bounds of the initial state (index 1) of the random CTMC
+	rates, targets = random_ctmc()
+	exit_rates = np.asarray(rates.sum(axis=1)).ravel()
+	for time_bound in [None, 0.5]:
+		storm_bounds = solver.check_storm(rates.indptr, rates.indices, rates.data, exit_rates, targets, [], time_bound, verbose=False)
+		x = ctmc.reachability(rates.indptr, rates.indices, rates.data, targets, time_bound=time_bound, absorbing=ABSORBING)
+		assert(np.allclose(x[1], storm_bounds, rtol=1e-6, atol=1e-12))
+	for time_bound in [None, 5]:
+		storm_bounds = toy_bounds(solver.STORM, time_bound)
+		native_bounds = toy_bounds(solver.NATIVE, time_bound)
+		assert(np.allclose(native_bounds, storm_bounds, rtol=1e-6, atol=1e-12))
+
+if __name__=="__main__":
+	test_unbounded()
+	test_uniformization()
+	test_storm()
+	print("The native CTMC solver matches the direct solve and storm")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+from crn import *
+from importance import Estimate, estimate_probability, DISTANCE
+
+import math
+
+# The model of test_k_best_paths.py. Only a few walkers reach its boundary within a few steps
+crn = Crn([
+	# Transition system
+	Transition(
+		[1, 0]
+		, lambda state : state[0] < 6
+		, lambda state : 2.0
+		)
+	, Transition(
+		[-1, 0]
+		, lambda state : state[0] > 0
+		, lambda state : 1.0
+		)
+	, Transition(
+		[0, 1]
+		, lambda state : state[1] < 6
+		, lambda state : 0.5
+		)
+	, Transition(
+		[1, 1]
+		, lambda state : state[0] < 6 and state[1] < 6
+		, lambda state : 0.2
+		)
+	]
+	# The satisfying condition
+	, [Bound(3, BoundTypes.GREATER_THAN), Bound(2, BoundTypes.GREATER_THAN)]
+	# The initial state
+	, np.array([0, 0])
+)
+
+def bounded_probability(trace_length : int) -> float:
+	'''
+	The probability of reaching a satisfying state within trace_length steps of the embedded
+	DTMC, by dynamic programming over the distribution of the walkers that have not reached one
+	'''
+	distribution = {tuple(crn.init_state) : 1.0}
+	reached = 0.0
+	for _ in range(trace_length):
+		next_distribution = {}
+		for state, probability in distribution.items():
+			enabled, rates = crn.propensities(np.array(state))
+			total_rate = rates[enabled].sum()
+			for reaction in np.flatnonzero(enabled):
+				next_state = tuple(int(v) for v in np.array(state) + crn.stoichiometry[reaction])
+				next_probability = probability * rates[reaction] / total_rate
+				if crn.satisfies(next_state):
+					reached += next_probability
+				else:
+					next_distribution[next_state] = next_distribution.get(next_state, 0.0) + next_probability
+		distribution = next_distribution
+	return reached
+
+def test_matches_dynamic_programming(trace_length=6, num_samples=40000):
+	expected = bounded_probability(trace_length)
+	assert(0.0 < expected < 0.1)
+	# Unbiased, and biased toward the boundary
+	for bias in [0.0, 0.5]:
+		estimate = estimate_probability(crn, num_samples=num_samples, trace_length=trace_length, heuristic=DISTANCE, bias=bias, num_walkers=5000, seed=1)
+		assert(estimate.num_samples == num_samples)
+		assert(abs(math.exp(estimate.log_mean()) - expected) < 4.0 * math.exp(estimate.log_std_error()))
+		assert(estimate.relative_error() < 0.1)
+
+def check_estimate(ratios : np.ndarray, log_scale=0.0, batch_size=7):
+	'''
+	Adds the ratios (multiplied by exp(log_scale), as log ratios of the hits) to an Estimate in
+	batches, and compares its mean and standard error with numpy's
+	'''
+	estimate = Estimate()
+	for start in range(0, len(ratios), batch_size):
+		batch = ratios[start:start + batch_size]
+		estimate.add(len(batch), np.log(batch[batch > 0.0]) + log_scale)
+	assert(estimate.num_hits == np.count_nonzero(ratios))
+	std_error = np.std(ratios, ddof=1) / math.sqrt(len(ratios))
+	if estimate.num_hits == 0:
+		assert(estimate.log_mean() == -math.inf and estimate.log_std_error() == -math.inf)
+		return
+	assert(math.isclose(estimate.log_mean(), math.log(np.mean(ratios)) + log_scale, abs_tol=1e-9))
+	assert(math.isclose(estimate.log_std_error(), math.log(std_error) + log_scale, abs_tol=1e-9))
+
+def test_standard_error():
+	rng = np.random.default_rng(0)
+	# No hits, a single hit (whose standard error is about ratio / sqrt(n), not zero), and many
+	check_estimate(np.zeros(1000))
+	one_hit = np.zeros(1000)
+	one_hit[10] = 1e-3
+	check_estimate(one_hit)
+	estimate = Estimate()
+	estimate.add(1000, np.log([1e-3]))
+	assert(math.isclose(math.exp(estimate.log_std_error()), 1e-6, rel_tol=1e-3))
+	many_hits = np.where(rng.random(1000) < 0.3, np.exp(rng.normal(-20.0, 2.0, 1000)), 0.0)
+	check_estimate(many_hits)
+	# Every sample a hit, with ratios whose squares underflow a float
+	check_estimate(np.exp(rng.normal(0.0, 1.0, 100)), log_scale=-400.0)
+
+if __name__=="__main__":
+	test_matches_dynamic_programming()
+	test_standard_error()
+	print("Importance sampling matches dynamic programming")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+from crn import *
+import counterexample
+
+import math
+
+# A small model with many paths of different probabilities to the boundary (including cycles)
+crn = Crn([
+	# Transition system
+	Transition(
+		[1, 0]
+		, lambda state : state[0] < 6
+		, lambda state : 2.0
+		)
+	, Transition(
+		[-1, 0]
+		, lambda state : state[0] > 0
+		, lambda state : 1.0
+		)
+	, Transition(
+		[0, 1]
+		, lambda state : state[1] < 6
+		, lambda state : 0.5
+		)
+	, Transition(
+		[1, 1]
+		, lambda state : state[0] < 6 and state[1] < 6
+		, lambda state : 0.2
+		)
+	]
+	# The satisfying condition
+	, [Bound(3, BoundTypes.GREATER_THAN), Bound(2, BoundTypes.GREATER_THAN)]
+	# The initial state
+	, np.array([0, 0])
+)
+
+def replay_log_probability(trace) -> float:
+	'''
+	The log probability of a trace in the embedded DTMC, recomputed from its reactions
+	'''
+	log_prob = 0.0
+	state = np.array(trace.init_state)
+	for reaction in trace.reactions:
+		enabled, rates = crn.propensities(state)
+		log_prob += math.log(rates[reaction] / rates[enabled].sum())
+		state = state + crn.stoichiometry[reaction]
+	return log_prob
+
+def non_increasing(log_probs) -> bool:
+	'''
+	Whether the log probabilities are in non-increasing order, up to rounding (paths of the same
+	probability may be summed in a different order)
+	'''
+	return all(a >= b or math.isclose(a, b, rel_tol=1e-12) for a, b in zip(log_probs, log_probs[1:]))
+
+def test_k_best_paths_order(number=20, k=100):
+	counterexample.find_counterexamples(crn, number=number)
+	# There are fewer than `number` satisfying states, so the whole model is explored, and there
+	# are infinitely many paths (through cycles)
+	assert(len(counterexample.satisfying_ids) < number)
+	assert(len(counterexample.counterexamples) == number)
+	paths = list(counterexample.k_best_paths(counterexample.satisfying_ids, k))
+	assert(len(paths) == k)
+	log_probs = [log_prob for log_prob, _ in paths]
+	assert(non_increasing(log_probs))
+	assert([log_prob for log_prob, _ in counterexample.counterexamples] == log_probs[:number])
+	assert(len(set(tuple(trace.reactions) for _, trace in paths)) == k)
+	for log_prob, trace in paths:
+		assert(crn.satisfies(trace.states()[0]))
+		assert(math.isclose(log_prob, replay_log_probability(trace), rel_tol=1e-9))
+
+def test_fewer_paths(number=5):
+	# The search stops at `number` satisfying states, but paths end at the first satisfying state
+	# they reach, so some of them are not the end of any counterexample
+	counterexample.find_counterexamples(crn, number=number)
+	assert(len(counterexample.satisfying_ids) == number)
+	assert(0 < len(counterexample.counterexamples) <= number)
+	log_probs = [log_prob for log_prob, _ in counterexample.counterexamples]
+	assert(non_increasing(log_probs))
+
+if __name__=="__main__":
+	test_k_best_paths_order()
+	test_fewer_paths()
+	print("k best paths are in order of probability")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+from crn import *
+from traces import log_sum, format_probability, parse_probability
+import counterexample
+
+import math
+
+import test1
+import test2
+
+# The lower bounds in notes/notes.md: distance only on test1.py, and wayfarer on test2.py (the
+# second, more challenging test), and a bound of random exploration on test1.py
+NOTES_BOUNDS = [(test1.crn, 3, 3.3845545545021705e-15), (test2.crn, 10, 6.852600255650947e-75)]
+NOTES_RANDOM_BOUND = 3.618909437343446e-75
+
+def replay_probability(crn, trace) -> float:
+	'''
+	The probability of a trace in the embedded DTMC, multiplied out in linear space
+	'''
+	probability = 1.0
+	state = np.array(trace.init_state)
+	for reaction in trace.reactions:
+		enabled, rates = crn.propensities(state)
+		probability *= rates[reaction] / rates[enabled].sum()
+		state = state + crn.stoichiometry[reaction]
+	return probability
+
+def test_bounds_match_notes():
+	for crn, number, bound in NOTES_BOUNDS:
+		counterexample.find_counterexamples(crn, number=number)
+		log_probs = [log_prob for log_prob, _ in counterexample.counterexamples]
+		# The k best paths are at least as probable as the single traceback of the notes
+		assert(log_sum(log_probs) >= math.log(bound))
+		for log_prob, trace in counterexample.counterexamples:
+			assert(math.isclose(log_prob, math.log(replay_probability(crn, trace)), rel_tol=1e-9))
+
+def test_format_probability():
+	for bound in [bound for _, _, bound in NOTES_BOUNDS] + [NOTES_RANDOM_BOUND]:
+		assert(math.isclose(float(format_probability(math.log(bound))), bound, rel_tol=1e-12))
+		assert(math.isclose(parse_probability(format_probability(math.log(bound))), math.log(bound), rel_tol=1e-12))
+		# Products of such bounds underflow a float, but not their logs
+		log_product = 50 * math.log(bound)
+		assert(math.exp(log_product) == 0.0)
+		assert(math.isclose(parse_probability(format_probability(log_product)), log_product, rel_tol=1e-12))
+		assert(math.isclose(log_sum([log_product] * 4), log_product + math.log(4), rel_tol=1e-12))
+
+if __name__=="__main__":
+	test_bounds_match_notes()
+	test_format_probability()
+	print("Log space bounds match notes/notes.md")
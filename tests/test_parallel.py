@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+from parser import parse_dependency_ragtimer
+from parallel import Partition, min_probability_parallel
+import solver
+
+import os
+import tempfile
+
+import numpy as np
+
+from test_ctmc import TOY_RAGTIMER
+
+# Enough satisfying states that the toy model is explored completely
+ALL_STATES = 10 ** 6
+
+def toy_model() -> tuple:
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		path = os.path.join(tmp_dir, "toy.ragtimer")
+		with open(path, "w") as f:
+			f.write(TOY_RAGTIMER)
+		return parse_dependency_ragtimer(path)
+
+def test_partition(num_states=2000, num_workers=3):
+	vecs = np.random.default_rng(0).integers(0, 100, (num_states, 4))
+	owners = Partition(4, num_workers).owners(vecs)
+	# Another process builds the same partition, and a state alone gets the same owner
+	assert(np.array_equal(owners, Partition(4, num_workers).owners(vecs)))
+	assert(all(Partition(4, num_workers).owners(vec)[0] == owner for vec, owner in zip(vecs[:50], owners)))
+	assert(set(owners) == set(range(num_workers)))
+
+def test_matches_serial():
+	dep, crn = toy_model()
+	for time_bound in [None, 5]:
+		# Once the state space is exhausted, the workers explore the same states as a serial run
+		serial = solver.min_probability_subsp(crn, dep, number=ALL_STATES, time_bound=time_bound, expand_all_states=True, backend=solver.NATIVE)
+		num_states = len(solver.state_store)
+		bounds = min_probability_parallel(crn, dep, number=ALL_STATES, num_workers=2, time_bound=time_bound, expand_all_states=True, backend=solver.NATIVE)
+		assert(len(solver.state_store) == num_states)
+		assert(np.allclose(bounds, serial, rtol=1e-8, atol=1e-12))
+		# Before that, the states explored may differ, but both still bound the exact probability
+		for partial in [solver.min_probability_subsp(crn, dep, number=3, time_bound=time_bound, expand_all_states=True, backend=solver.NATIVE),
+				min_probability_parallel(crn, dep, number=3, num_workers=2, time_bound=time_bound, expand_all_states=True, backend=solver.NATIVE)]:
+			assert(partial[0] <= serial[0] + 1e-8 and partial[1] >= serial[1] - 1e-8)
+
+if __name__=="__main__":
+	test_partition()
+	test_matches_serial()
+	print("The parallel search matches the serial one")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from frontier import Frontier, SpillingFrontier
+from spill import BloomFilter, SpillingIndex
+from store import StateStore
+
+import os
+import tempfile
+
+import numpy as np
+
+def test_frontier_order(num_entries=5000, limit=64):
+	rng = np.random.default_rng(0)
+	# Few orders and a coarse epsilon grid, so there are many buckets and many equal priorities
+	orders = rng.integers(-1, 4, num_entries)
+	epsilons = rng.integers(0, 40, num_entries) * 0.25
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		frontier = Frontier()
+		spilling = SpillingFrontier(os.path.join(tmp_dir, "frontier"), limit=limit)
+		popped, spilled_popped = [], []
+		for i in range(num_entries):
+			frontier.put((int(orders[i]), float(epsilons[i])), i)
+			spilling.put((int(orders[i]), float(epsilons[i])), i)
+			# Pop between the pushes too, so spilled buckets are read back and appended to
+			if rng.random() < 0.3:
+				popped.append(frontier.get())
+				spilled_popped.append(spilling.get())
+		assert(len(os.listdir(os.path.join(tmp_dir, "frontier"))) > 0 and spilling.in_memory <= limit)
+		assert(len(spilling) == len(frontier))
+		while not frontier.empty():
+			popped.append(frontier.get())
+			spilled_popped.append(spilling.get())
+		assert(spilling.empty())
+	assert(spilled_popped == popped)
+
+def test_index_lookups(num_keys=3000, width=8, limit=200):
+	rng = np.random.default_rng(1)
+	keys = [bytes(key) for key in rng.integers(0, 256, (2 * num_keys, width), dtype=np.uint8)]
+	expected = {}
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		index = SpillingIndex(tmp_dir, width, limit)
+		for value, key in enumerate(keys[:num_keys]):
+			if key not in expected:
+				expected[key] = value
+				index[key] = value
+		assert(len(index.runs) > 1 and len(index) == len(expected))
+		# Keys in memory, on disk (in every run) and never added
+		for key in keys:
+			assert(index.get(key) == expected.get(key))
+			assert(index.get(key, -1) == expected.get(key, -1))
+			assert((key in index) == (key in expected))
+
+def test_bloom_filter(num_keys=2000):
+	rng = np.random.default_rng(2)
+	keys = [bytes(key) for key in rng.integers(0, 256, (2 * num_keys, 12), dtype=np.uint8)]
+	added, others = keys[:num_keys], keys[num_keys:]
+	bloom = BloomFilter(num_keys)
+	bloom.add_batch(added)
+	# No false negatives, and about the false positive rate of BLOOM_BITS_PER_KEY
+	assert(all(key in bloom for key in added))
+	assert(sum(key in bloom for key in others) < 0.03 * len(others))
+
+def test_mapped_store(num_states=3000, num_species=3):
+	rng = np.random.default_rng(3)
+	vecs = np.unique(rng.integers(0, 40, (num_states, num_species)), axis=0)
+	rng.shuffle(vecs)
+	residual_shape = (num_species, 2)
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		# A small capacity and limit, so the arrays are grown and the index spills many times
+		store = StateStore(num_species, capacity=16, residual_shape=residual_shape)
+		mapped = StateStore(num_species, capacity=16, spill_dir=tmp_dir, spill_limit=100, residual_shape=residual_shape)
+		for i, vec in enumerate(vecs):
+			residual = np.full(residual_shape, float(i))
+			assert(store.add(vec, i % 5, i * 0.5, residual) == mapped.add(vec, i % 5, i * 0.5, residual))
+		mapped.perimeter[1:len(mapped):2] = False
+		store.perimeter[1:len(store):2] = False
+		assert(isinstance(mapped.vecs, np.memmap) and len(mapped.index.runs) > 0)
+		assert(len(mapped) == len(store) == len(vecs) + 1)
+		for name in ["vecs", "order", "epsilon", "perimeter", "exit_rate", "residuals"]:
+			assert(np.array_equal(getattr(mapped, name)[:len(mapped)], getattr(store, name)[:len(store)], equal_nan=name == "exit_rate"))
+		queries = np.vstack([vecs, rng.integers(40, 50, (100, num_species))])
+		assert(np.array_equal(mapped.find_batch(queries), store.find_batch(queries)))
+		assert(all(mapped.find(vec) == store.find(vec) for vec in queries[::7]))
+		assert(np.array_equal(mapped.perimeter_idxs(), store.perimeter_idxs()))
+
+if __name__=="__main__":
+	test_frontier_order()
+	test_index_lookups()
+	test_bloom_filter()
+	test_mapped_store()
+	print("The spilling structures match their in-memory versions")
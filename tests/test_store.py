@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from crn import *
+from store import StateEncoder
+
+import sys
+import time
+
+def model(init_state, bounds, vectors) -> Crn:
+	'''
+	A CRN with constant rates, an initial state, a boundary of lower bounds and the given
+	reaction vectors
+	'''
+	transitions = [Transition(vector, lambda state : True, lambda state : 1.0) for vector in vectors]
+	return Crn(transitions, [Bound(b, BoundTypes.GREATER_THAN_EQ) for b in bounds], np.array(init_state))
+
+def check_round_trip(encoder : StateEncoder, vecs):
+	keys = [encoder.encode(vec) for vec in vecs]
+	for vec, key in zip(vecs, keys):
+		assert(encoder.decode(key) == tuple(int(v) for v in vec))
+	# Distinct states get distinct keys
+	assert(len(set(keys)) == len(set(tuple(int(v) for v in vec) for vec in vecs)))
+
+def test_widest_species():
+	# Counts that need 62 bits (or more) take the widest width, and the limit does not overflow
+	encoder = StateEncoder(model([2 ** 61, 3], [0, 5], [[-1, 1]]), dtype=np.int64)
+	assert(encoder.limits[0] == 2 ** 62 and encoder.limits[0] > 0)
+	check_round_trip(encoder, np.array([[2 ** 61, 3], [2 ** 62 - 1, 0], [0, 0]], dtype=np.int64))
+	# Counts beyond the width, or negative, fall back to bytes
+	assert(isinstance(encoder.encode(np.array([2 ** 62, 3], dtype=np.int64)), bytes))
+	assert(isinstance(encoder.encode(np.array([5, -1], dtype=np.int64)), bytes))
+	assert(isinstance(encoder.encode(np.array([5, 3], dtype=np.int64)), int))
+
+def test_several_words():
+	# Three species of 62 bits need three words
+	encoder = StateEncoder(model([2 ** 61] * 3, [0, 0, 0], [[1, -1, 0], [0, 1, -1]]), dtype=np.int64)
+	assert(encoder.num_words == 3)
+	rng = np.random.default_rng(0)
+	check_round_trip(encoder, rng.integers(0, 2 ** 62, (200, 3), dtype=np.int64))
+	# Small species share a word
+	encoder = StateEncoder(model([10, 20, 30, 0], [12, 0, 0, 4], [[-1, 1, 0, 0], [0, -1, 1, 0], [0, 0, -1, 1]]))
+	assert(encoder.num_words == 1)
+	check_round_trip(encoder, rng.integers(0, 300, (500, 4)))
+
+def benchmark_encode(num_states=100000, num_species=8):
+	'''
+	Compares building a visited-state index keyed on packed integers with one keyed on tuples:
+	the time to build it, and the memory taken by its keys
+	'''
+	rng = np.random.default_rng(1)
+	vecs = rng.integers(0, 1000, (num_states, num_species))
+	crn = model([500] * num_species, [900] * num_species, np.eye(num_species, dtype=int))
+	encoder = StateEncoder(crn)
+	start = time.perf_counter()
+	packed = { encoder.encode(vec) : i for i, vec in enumerate(vecs) }
+	packed_time = time.perf_counter() - start
+	start = time.perf_counter()
+	tuples = { tuple(vec) : i for i, vec in enumerate(vecs) }
+	tuple_time = time.perf_counter() - start
+	assert(len(packed) == len(tuples))
+	packed_bytes = sum(sys.getsizeof(key) for key in packed)
+	tuple_bytes = sum(sys.getsizeof(key) + sum(sys.getsizeof(v) for v in key) for key in tuples)
+	print(f"Indexed {num_states} states of {num_species} species ({encoder.num_words} words):")
+	print(f"  packed keys {packed_time:.3f} s, {packed_bytes / len(packed):.0f} bytes per key")
+	print(f"  tuples      {tuple_time:.3f} s, {tuple_bytes / len(tuples):.0f} bytes per key")
+
+if __name__=="__main__":
+	test_widest_species()
+	test_several_words()
+	benchmark_encode()
+	print("Packed state keys round trip")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from crn import *
+from traces import *
+import counterexample
+
+import math
+import os
+import tempfile
+
+# The model of test_k_best_paths.py, fully explored so there are many counterexamples
+crn = Crn([
+	# Transition system
+	Transition(
+		[1, 0]
+		, lambda state : state[0] < 6
+		, lambda state : 2.0
+		)
+	, Transition(
+		[-1, 0]
+		, lambda state : state[0] > 0
+		, lambda state : 1.0
+		)
+	, Transition(
+		[0, 1]
+		, lambda state : state[1] < 6
+		, lambda state : 0.5
+		)
+	, Transition(
+		[1, 1]
+		, lambda state : state[0] < 6 and state[1] < 6
+		, lambda state : 0.2
+		)
+	]
+	# The satisfying condition
+	, [Bound(3, BoundTypes.GREATER_THAN), Bound(2, BoundTypes.GREATER_THAN)]
+	# The initial state
+	, np.array([0, 0])
+)
+
+def write_traces(path : str, fmt : str, compression : str = None) -> list:
+	'''
+	Finds counterexamples and writes them to path as they are found. Returns the counterexamples.
+	'''
+	with TraceWriter(path, crn, fmt=fmt, compression=compression) as trace_writer:
+		counterexample.find_counterexamples(crn, number=20, trace_writer=trace_writer)
+	return counterexample.counterexamples
+
+def check_round_trip(fmt : str, compression : str = None):
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		path = os.path.join(tmp_dir, "traces")
+		written = write_traces(path, fmt, compression)
+		read = list(read_traces(path))
+		assert(len(read) == len(written) and len(written) > 0)
+		for (log_prob, trace), (read_log_prob, states) in zip(written, read):
+			assert(states == trace.states())
+			# The text format has the probabilities as printed
+			assert(math.isclose(log_prob, read_log_prob, rel_tol=1e-12 if fmt == TEXT else 0.0))
+		if fmt == BINARY:
+			for (_, trace), (_, read_trace) in zip(written, read_traces(path, states=False)):
+				assert(np.array_equal(trace.reactions, read_trace.reactions) and trace.init_state == read_trace.init_state)
+
+def test_round_trip():
+	for fmt in FORMATS:
+		check_round_trip(fmt)
+		check_round_trip(fmt, GZIP)
+
+def test_text_matches_print():
+	# The text trace file is in the order of print_counterexamples: the number of traces, the
+	# traces, then the lower bound
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		os.chdir(tmp_dir)
+		try:
+			write_traces("written.wayfarer", TEXT)
+			counterexample.print_counterexamples(show_entire_trace=True, write_when_done=True, single_line=True)
+			with open("written.wayfarer") as written, open(DEFAULT_TRACE_FILE) as printed:
+				written_lines, printed_lines = written.readlines(), printed.readlines()
+		finally:
+			os.chdir(cwd)
+	assert(written_lines[0].startswith("Finished finding") and written_lines[-1].startswith("Total lower bound probability"))
+	assert(written_lines == printed_lines)
+
+if __name__=="__main__":
+	test_round_trip()
+	test_text_matches_print()
+	print("Traces round trip through both formats")